@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+'''simulate many build clients and page readers against a running server
+
+Start a server with run.py first, uploads go to projects named loadtest-*.
+'''
+
+import os
+import sys
+import time
+import random
+import threading
+from base64 import b64encode
+from collections import defaultdict
+from argparse import ArgumentParser
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+from urllib.error import URLError, HTTPError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from buildhck.client.services.buildhck import upload_request # pylint: disable=wrong-import-position
+
+STAGES = ['build', 'test', 'package', 'analyze']
+
+class Stats:
+    '''latencies and errors per route'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def record(self, route, latency, error=None):
+        '''record one request'''
+        with self.lock:
+            self.latencies[route].append(latency)
+            if error is not None:
+                self.errors[route][error] += 1
+
+    def report(self, elapsed):
+        '''print table of routes'''
+        print('{:<28} {:>7} {:>8} {:>8} {:>8} {:>8} {:>8}  {}'.format('route', 'count', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'errors'))
+        for route in sorted(self.latencies):
+            latencies = sorted(self.latencies[route])
+            errors = self.errors[route]
+            print('{:<28} {:>7} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}  {}'.format(
+                route, len(latencies), len(latencies) / elapsed,
+                percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99), latencies[-1] * 1000,
+                ', '.join('{}: {} ({:.1%})'.format(error, count, count / len(latencies)) for error, count in sorted(errors.items())) or '-'))
+
+def percentile(latencies, pct):
+    '''get percentile of sorted latencies in milliseconds'''
+    return latencies[min(len(latencies) - 1, len(latencies) * pct // 100)] * 1000
+
+def timed(stats, route, request, body=None):
+    '''send request and record its latency and outcome'''
+    start = time.perf_counter()
+    error = None
+    try:
+        with urlopen(request, body, timeout=60) as response:
+            response.read()
+    except HTTPError as exc:
+        error = exc.code
+    except (URLError, OSError) as exc:
+        error = type(getattr(exc, 'reason', exc)).__name__
+    stats.record(route, time.perf_counter() - start, error)
+
+def build_result(args, client, rand):
+    '''get build result as the client uploads it'''
+    result = {'client': 'loadtest-{}'.format(client), 'branch': 'master',
+              'commit': '{:040x}'.format(rand.getrandbits(160)), 'description': 'load test build'}
+    for stage in STAGES:
+        log = b''.join(b'line %d of %s\n' % (idx, stage.encode()) for idx in range(args.log_size * 1024 // 20))
+        result[stage] = {'status': rand.choice([0, 1, 1, 1]) if stage != 'analyze' else rand.randrange(20),
+                         'log': b64encode(log).decode('UTF-8')}
+    if args.zip_size:
+        result['package']['zip'] = b64encode(os.urandom(args.zip_size * 1024)).decode('UTF-8')
+    return result
+
+def uploader(args, stats, client, deadline):
+    '''upload builds until deadline'''
+    rand = random.Random(client)
+    project = 'loadtest-{}'.format(client % args.projects)
+    system = 'loadtest-{}'.format(client)
+    while time.monotonic() < deadline:
+        request, body = upload_request({'name': project}, build_result(args, client, rand), args.server, system=system)
+        timed(stats, 'POST /build', request, body)
+        time.sleep(rand.uniform(0, 2 * args.think))
+
+def reader(args, stats, idx, deadline):
+    '''read index, badges and logs until deadline'''
+    rand = random.Random(-idx - 1)
+    while time.monotonic() < deadline:
+        client = rand.randrange(args.clients)
+        path = '/build/{}/master/{}'.format(quote('loadtest-{}'.format(client % args.projects)), quote('loadtest-{}'.format(client)))
+        route, url = rand.choice([('GET / (json)', '/'), ('GET / (html)', '/'),
+                                  ('GET status.svg', path + '/status.svg'),
+                                  ('GET build-log.txt', path + '/current/build-log.txt')])
+        request = Request(args.server + url)
+        if route.endswith('(json)'):
+            request.add_header('Accept', 'application/json')
+        timed(stats, route, request)
+        time.sleep(rand.uniform(0, 2 * args.think))
+
+def main():
+    '''main method'''
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-s', '--server', default='http://localhost:9001',
+                        help='server url')
+    parser.add_argument('-c', '--clients', type=int, default=200,
+                        help='number of simulated build clients')
+    parser.add_argument('-r', '--readers', type=int, default=20,
+                        help='number of simulated page readers')
+    parser.add_argument('-p', '--projects', type=int, default=20,
+                        help='number of projects clients build')
+    parser.add_argument('-d', '--duration', type=float, default=30,
+                        help='seconds to run')
+    parser.add_argument('-t', '--think', type=float, default=1,
+                        help='mean seconds each simulated client waits between requests')
+    parser.add_argument('--log-size', type=int, default=64, dest='log_size',
+                        help='size of each stage log in KiB')
+    parser.add_argument('--zip-size', type=int, default=0, dest='zip_size',
+                        help='size of package zip in KiB')
+    args = parser.parse_args()
+
+    stats = Stats()
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=uploader, args=(args, stats, client, deadline), daemon=True) for client in range(args.clients)]
+    threads += [threading.Thread(target=reader, args=(args, stats, idx, deadline), daemon=True) for idx in range(args.readers)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.report(time.monotonic() - start)
+
+if __name__ == '__main__':
+    main()
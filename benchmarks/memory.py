@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+'''measure memory held by build data of a large synthetic tree'''
+
+import os
+import bz2
+import sys
+import json
+import time
+import shutil
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STAGES = ['build', 'test', 'package', 'analyze']
+
+def populate(root, projects, systems, builds):
+    '''write metadata and logs of projects * systems * builds builds'''
+    start = datetime(2015, 1, 1)
+    for pidx in range(projects):
+        for sidx in range(systems):
+            systempath = os.path.join(root, 'project{}'.format(pidx), 'master', 'linux-x86_64-{}'.format(sidx))
+            for bidx in range(builds):
+                date = start + timedelta(hours=bidx)
+                fsdate = date.strftime('%Y%m%d%H%M%S')
+                buildpath = os.path.join(systempath, fsdate)
+                os.makedirs(buildpath)
+                metadata = {'date': date.isoformat() + '.000000', 'client': 'client{}'.format(sidx),
+                            'commit': '{:040x}'.format(bidx), 'description': 'commit number {}'.format(bidx),
+                            'upstream': 'https://example.com/project{}'.format(pidx)}
+                for stage in STAGES:
+                    metadata[stage] = {'status': 1 if stage != 'analyze' else bidx % 7}
+                    with open(os.path.join(buildpath, '{}-log.bz2'.format(stage)), 'wb') as fle:
+                        fle.write(bz2.compress(b'log'))
+                with open(os.path.join(buildpath, 'metadata.bz2'), 'wb') as fle:
+                    fle.write(bz2.compress(json.dumps(metadata).encode('UTF-8')))
+            os.symlink(fsdate, os.path.join(systempath, 'current'))
+
+def main():
+    '''main method'''
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-p', '--projects', type=int, default=20)
+    parser.add_argument('-s', '--systems', type=int, default=5)
+    parser.add_argument('-b', '--builds', type=int, default=100)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='buildhck-memory-')
+    try:
+        root = os.path.join(tmp, 'builds')
+        populate(root, args.projects, args.systems, args.builds)
+
+        from buildhck import buildhck, config
+        config.load({'build_roots': [root], 'journal': os.path.join(tmp, 'journal')})
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        held = [] # keep everything alive, like a warm cache does
+        for project in sorted(os.listdir(root)):
+            for system in sorted(os.listdir(os.path.join(root, project, 'master'))):
+                held.append(buildhck.get_build_data(project, 'master', system, 'current'))
+        elapsed = time.perf_counter() - start
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        count = args.projects * args.systems * args.builds
+        print('builds:  {}'.format(count))
+        print('memory:  {:.1f}MiB ({:.0f} bytes per build)'.format(current / 2**20, current / count))
+        print('load:    {:.2f}s'.format(elapsed))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+'''measure time from interpreter start to first response of the server'''
+
+import os
+import sys
+import statistics
+import subprocess
+from argparse import ArgumentParser
+
+# runs in a fresh interpreter, so module import costs are measured
+PROBE = r'''
+import time
+start = time.perf_counter()
+from buildhck import buildhck
+imported = time.perf_counter()
+from wsgiref.util import setup_testing_defaults
+environ = {'PATH_INFO': '/', 'REQUEST_METHOD': 'GET'}
+setup_testing_defaults(environ)
+body = b''.join(buildhck.application(environ, lambda status, headers, exc_info=None: None))
+assert body
+print(imported - start, time.perf_counter() - start)
+'''
+
+def main():
+    '''main method'''
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--runs', type=int, default=20,
+                        help='number of interpreter spawns')
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+    imports, responses = [], []
+    for _ in range(args.runs):
+        out = subprocess.check_output([sys.executable, '-c', PROBE], env=env, cwd=root)
+        imported, responded = (float(value) for value in out.split()[-2:])
+        imports.append(imported * 1000)
+        responses.append(responded * 1000)
+
+    print('import:         median {:.1f}ms min {:.1f}ms'.format(statistics.median(imports), min(imports)))
+    print('first response: median {:.1f}ms min {:.1f}ms'.format(statistics.median(responses), min(responses)))
+
+if __name__ == '__main__':
+    main()
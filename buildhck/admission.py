@@ -0,0 +1,109 @@
+# pylint: disable=line-too-long
+'''admission control for build uploads, fair between projects and clients
+
+Uploads wait for a slot while at most 'ingest_concurrency' of them and
+'ingest_bytes' of their bodies are being ingested. Waiting uploads are
+admitted round-robin by project and, within a project, by client, so one
+busy project or client can't starve the others. Uploads that can't be
+admitted within 'ingest_wait' seconds, or arrive to a full queue, are
+rejected with 503 and Retry-After.
+
+Limits apply per server process.
+'''
+
+import threading
+from time import monotonic
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from bottle import HTTPError
+from buildhck import config
+
+class Admission:
+    '''slots and byte budget with a two level round-robin queue'''
+
+    def __init__(self, concurrency, budget):
+        self.concurrency = concurrency
+        self.budget = budget
+        self.active = 0
+        self.bytes = 0
+        self.waiting = 0
+        self.queues = OrderedDict() # project -> client -> tickets
+        self.cond = threading.Condition()
+
+    def head(self):
+        '''get ticket admitted next'''
+        clients = next(iter(self.queues.values()))
+        return next(iter(clients.values()))[0]
+
+    def fits(self, size):
+        '''check if upload of size fits, a single upload always does'''
+        if not self.active:
+            return True
+        return self.active < self.concurrency and self.bytes + size <= self.budget
+
+    def dequeue(self, project, client, ticket):
+        '''remove ticket and move its project and client to the back of the line'''
+        clients = self.queues[project]
+        clients[client].remove(ticket)
+        if clients[client]:
+            clients.move_to_end(client)
+        else:
+            del clients[client]
+        if clients:
+            self.queues.move_to_end(project)
+        else:
+            del self.queues[project]
+        self.waiting -= 1
+
+    def acquire(self, project, client, size, timeout, limit):
+        '''wait for turn, returns False if the upload should be rejected'''
+        # pylint: disable=too-many-arguments
+        ticket = object()
+        with self.cond:
+            if self.waiting >= limit:
+                return False
+            self.queues.setdefault(project, OrderedDict()).setdefault(client, deque()).append(ticket)
+            self.waiting += 1
+            deadline = monotonic() + timeout
+            while self.head() is not ticket or not self.fits(size):
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self.dequeue(project, client, ticket)
+                    self.cond.notify_all()
+                    return False
+                self.cond.wait(remaining)
+            self.dequeue(project, client, ticket)
+            self.active += 1
+            self.bytes += size
+            self.cond.notify_all() # next in line may fit as well
+            return True
+
+    def release(self, size):
+        '''give back slot and bytes'''
+        with self.cond:
+            self.active -= 1
+            self.bytes -= size
+            self.cond.notify_all()
+
+_admission = None
+
+def admission():
+    '''get admission state of this process'''
+    global _admission
+    if not _admission:
+        _admission = Admission(config.config.get('ingest_concurrency', 4),
+                               config.config.get('ingest_bytes', 64 * 1024 * 1024))
+    return _admission
+
+@contextmanager
+def admit(project, client, size):
+    '''hold a slot while ingesting upload of size, or abort with 503'''
+    state = admission()
+    if not state.acquire(project, client, size, config.config.get('ingest_wait', 10), config.config.get('ingest_queue', 64)):
+        raise HTTPError(503, 'Server is busy, retry later.', **{'Retry-After': str(config.config.get('ingest_retry_after', 30))})
+    try:
+        yield
+    finally:
+        state.release(size)
+
+#  vim: set ts=8 sw=4 tw=0 :
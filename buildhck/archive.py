@@ -0,0 +1,253 @@
+# pylint: disable=line-too-long
+'''packed per-system archives of old builds
+
+An archive is the files of many builds concatenated, followed by a json
+offset table {fsdate: {filename: [offset, length]}}, the offset of that
+table as 8 byte little endian integer and MAGIC. Single files are read
+with one seek, the archive is never unpacked.
+'''
+
+import os
+import io
+import json
+import struct
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from buildhck import config, cache, journal
+
+MAGIC = b'BHCKPACK'
+TRAILER = struct.Struct('<Q8s')
+ARCHIVE = 'history.pack'
+
+def archive_path(project, branch, system):
+    '''get path to archive of system'''
+    return config.build_directory(project, branch, system, ARCHIVE)
+
+class Slice(io.RawIOBase):
+    '''read-only file object of the bytes of one archived file, read with pread so nothing else is loaded'''
+
+    def __init__(self, fle, offset, length):
+        super().__init__()
+        self.fle = fle
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buf):
+        size = max(0, min(len(buf), self.length - self.position))
+        data = os.pread(self.fle.fileno(), size, self.offset + self.position) if size else b''
+        buf[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.length}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.fle.close()
+        super().close()
+
+@contextmanager
+def locked(project, branch, system):
+    '''hold lock of archive of system while it is read, modified and replaced'''
+    import fcntl
+    from hashlib import sha1
+    key = sha1('/'.join((project, branch, system)).encode('UTF-8')).hexdigest()[:16]
+    lockpath = config.data_directory('locks', '{}.pack.lock'.format(key))
+    os.makedirs(os.path.dirname(lockpath), exist_ok=True)
+    with open(lockpath, 'a') as fle:
+        fcntl.flock(fle, fcntl.LOCK_EX)
+        yield
+
+@cache.cached
+def read_index(project, branch, system):
+    '''get offset table of archive, empty if there is none'''
+    return load_index(project, branch, system)
+
+def load_index(project, branch, system):
+    '''read offset table of archive, bypassing the cache'''
+    try:
+        fle = open(archive_path(project, branch, system), 'rb')
+    except OSError:
+        return {}
+    with fle:
+        fle.seek(-TRAILER.size, os.SEEK_END)
+        offset, magic = TRAILER.unpack(fle.read(TRAILER.size))
+        if magic != MAGIC:
+            raise IOError('{} is not a build archive'.format(archive_path(project, branch, system)))
+        end = fle.tell() - TRAILER.size
+        fle.seek(offset)
+        return json.loads(fle.read(end - offset).decode('UTF-8'))
+
+def resolve(project, branch, system, fsdate):
+    '''resolve current to the fsdate it links to'''
+    if fsdate == 'current':
+        path = config.build_directory(project, branch, system, 'current')
+        return os.readlink(path) if os.path.lexists(path) else None
+    return fsdate
+
+def open_archived(project, branch, system, fsdate, name):
+    '''open archived build file as file object reading its slice of the archive, or None'''
+    # pylint: disable=too-many-arguments
+    entry = read_index(project, branch, system).get(resolve(project, branch, system, fsdate), {}).get(name)
+    if not entry:
+        return None
+    try:
+        fle = open(archive_path(project, branch, system), 'rb')
+    except OSError: # replaced since the index was read
+        return None
+    return io.BufferedReader(Slice(fle, entry[0], entry[1]))
+
+def read_file(project, branch, system, fsdate, name):
+    '''get contents of archived build file, or None'''
+    # pylint: disable=too-many-arguments
+    fle = open_archived(project, branch, system, fsdate, name)
+    if fle is None:
+        return None
+    with fle:
+        return fle.read()
+
+def has_file(project, branch, system, fsdate, name):
+    '''check if build file exists, on disk or archived'''
+    # pylint: disable=too-many-arguments
+    if os.path.exists(config.build_directory(project, branch, system, fsdate, name)):
+        return True
+    return name in read_index(project, branch, system).get(resolve(project, branch, system, fsdate), {})
+
+def open_file(project, branch, system, fsdate, name):
+    '''open build file for binary reading, on disk or archived, or None'''
+    # pylint: disable=too-many-arguments
+    path = config.build_directory(project, branch, system, fsdate, name)
+    if os.path.exists(path):
+        return open(path, 'rb')
+    return open_archived(project, branch, system, fsdate, name)
+
+def has_build(project, branch, system, fsdate):
+    '''check if build exists, on disk or archived'''
+    return os.path.isdir(config.build_directory(project, branch, system, fsdate)) or \
+           resolve(project, branch, system, fsdate) in read_index(project, branch, system)
+
+def fsdates(project, branch, system):
+    '''get fsdates of every build of system, on disk or archived, oldest first'''
+    path = config.build_directory(project, branch, system)
+    found = set(read_index(project, branch, system))
+    if os.path.isdir(path):
+        found.update(name for name in os.listdir(path) if name.isdigit())
+    return sorted(found)
+
+def write(project, branch, system, builds):
+    '''write archive of {fsdate: {filename: (path, offset, length)}} atomically'''
+    path = archive_path(project, branch, system)
+    tmppath = '{}.{}.tmp'.format(path, os.getpid())
+    index = {}
+    with open(tmppath, 'wb') as fle:
+        for fsdate, files in sorted(builds.items()):
+            index[fsdate] = {}
+            for name, data in sorted(files.items()):
+                index[fsdate][name] = [fle.tell(), data[2]]
+                with open(data[0], 'rb') as src:
+                    src.seek(data[1])
+                    left = data[2]
+                    while left:
+                        chunk = src.read(min(left, 1024 * 1024))
+                        if not chunk:
+                            raise IOError('{} was truncated'.format(data[0]))
+                        fle.write(chunk)
+                        left -= len(chunk)
+        offset = fle.tell()
+        fle.write(json.dumps(index).encode('UTF-8'))
+        fle.write(TRAILER.pack(offset, MAGIC))
+        fle.flush()
+        os.fsync(fle.fileno())
+    os.replace(tmppath, path)
+
+def archived_builds(project, branch, system, exclude=()):
+    '''get builds already in archive for write(), with the lock of the archive held'''
+    path = archive_path(project, branch, system)
+    return {fsdate: {name: (path, entry[0], entry[1]) for name, entry in files.items()}
+            for fsdate, files in load_index(project, branch, system).items() if fsdate not in exclude}
+
+def compact(project, branch, system, before):
+    '''pack builds of system older than fsdate before into its archive, saves and deletes of the project wait'''
+    with config.project_lock(project, exclusive=True), locked(project, branch, system):
+        return compact_locked(project, branch, system, before)
+
+def compact_locked(project, branch, system, before):
+    '''pack builds of system older than fsdate before, with the locks of project and archive held'''
+    import shutil
+    current = resolve(project, branch, system, 'current')
+    systempath = config.build_directory(project, branch, system)
+    packed = [fsdate for fsdate in os.listdir(systempath)
+              if fsdate.isdigit() and fsdate < before and fsdate != current]
+    if not packed:
+        return 0
+
+    builds = archived_builds(project, branch, system)
+    for fsdate in packed:
+        buildpath = os.path.join(systempath, fsdate)
+        builds[fsdate] = {}
+        for name in os.listdir(buildpath):
+            path = os.path.join(buildpath, name)
+            builds[fsdate][name] = (path, 0, os.path.getsize(path))
+    write(project, branch, system, builds)
+
+    # archive is in place, so readers find packed builds in either
+    journal.append('compact', project, branch, system)
+    cache.refresh()
+    for fsdate in packed:
+        shutil.rmtree(os.path.join(systempath, fsdate))
+    return len(packed)
+
+def remove(project, branch, system, fsdate):
+    '''remove build from archive'''
+    with locked(project, branch, system):
+        if fsdate not in load_index(project, branch, system):
+            return False
+        builds = archived_builds(project, branch, system, exclude=(fsdate,))
+        if builds:
+            write(project, branch, system, builds)
+        else:
+            os.unlink(archive_path(project, branch, system))
+    cache.clear()
+    return True
+
+def compact_all(days):
+    '''pack builds older than days of every system'''
+    before = (datetime.utcnow() - timedelta(days=days)).strftime('%Y%m%d%H%M%S')
+    packed = 0
+    for root in config.build_roots():
+        for project in os.listdir(root):
+            if project.startswith('.'):
+                continue
+            for branch in os.listdir(os.path.join(root, project)):
+                for system in os.listdir(os.path.join(root, project, branch)):
+                    packed += compact(project, branch, system, before)
+    return packed
+
+def main():
+    '''main method'''
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-d', '--days', type=int, default=None,
+                        help='pack builds older than this many days (default: compact_after_days in config or 30)')
+    args = parser.parse_args()
+
+    config.load()
+    days = args.days if args.days is not None else config.config.get('compact_after_days', 30)
+    print('[PACKED] {} builds'.format(compact_all(days)))
+
+if __name__ == '__main__':
+    main()
+
+#  vim: set ts=8 sw=4 tw=0 :
@@ -0,0 +1,273 @@
+# pylint: disable=line-too-long
+'''asyncio server, connections wait on the event loop and the app runs in threads
+
+Request bodies are read into a spooled file before the app is called,
+bodies over 'upload_max_bytes' are answered with 413 and bodies idle for
+'body_timeout' seconds with 408, and response
+bodies are written with backpressure, so slow or idle clients only hold
+a coroutine. The app, and every read of a response chunk (file
+reads, log decompression), runs in a pool of 'threads' threads. Writes
+run in a separate pool of 'ingest_threads' threads, so busy readers
+can't starve ingest.
+'''
+
+import sys
+import time
+import socket
+from tempfile import SpooledTemporaryFile
+from urllib.parse import unquote_to_bytes
+from bottle import ServerAdapter, server_names, BaseRequest
+from buildhck import config
+
+# request line and header lines longer than this are rejected
+LINE_MAX = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+
+class BadRequest(Exception):
+    '''request can't be parsed, connection is closed after responding'''
+    status = '400 Bad Request'
+
+
+class TooLarge(BadRequest):
+    '''request body is over upload_max_bytes'''
+    status = '413 Request Entity Too Large'
+
+
+class Stalled(BadRequest):
+    '''client sent no part of the request body for body_timeout seconds'''
+    status = '408 Request Timeout'
+
+def call(handler, environ):
+    '''call wsgi app, returns status, headers, first chunks and the rest of the body'''
+    started = []
+    written = []
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and started:
+            raise exc_info[1].with_traceback(exc_info[2])
+        started[:] = [status, headers]
+        return written.append
+
+    result = handler(environ, start_response)
+    iterator = iter(result)
+    first = next(iterator, None) # apps may call start_response on first iteration
+    if first:
+        written.append(first)
+    return started[0], started[1], written, iterator, result
+
+def close(result):
+    '''close wsgi response'''
+    if hasattr(result, 'close'):
+        result.close()
+
+class AsyncioServer(ServerAdapter):
+    '''bottle server adapter serving HTTP/1.1 with asyncio'''
+
+    def run(self, handler):
+        '''serve until interrupted'''
+        import asyncio
+        try:
+            asyncio.run(self.serve(handler))
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self, handler):
+        '''listen and serve connections'''
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        self.pool = ThreadPoolExecutor(int(self.options.get('threads') or 16), thread_name_prefix='buildhck')
+        self.ingest = ThreadPoolExecutor(int(self.options.get('ingest_threads') or 4), thread_name_prefix='buildhck-ingest')
+        self.handler = handler
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        server = await asyncio.start_server(self.connection, self.host, int(self.port), family=family,
+                                            limit=LINE_MAX, backlog=self.options.get('backlog', 1024))
+        async with server:
+            await server.serve_forever()
+
+    async def connection(self, reader, writer):
+        '''serve requests of connection until it closes or idles'''
+        import asyncio
+        keepalive = float(self.options.get('keepalive', 15))
+        peer = writer.get_extra_info('peername') or ('', 0)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.read_head(reader), keepalive)
+                except BadRequest as exc:
+                    await self.reject(writer, exc)
+                    return
+                if not request:
+                    return
+                if not await self.respond(reader, writer, request, peer):
+                    return
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception: # pylint: disable=broad-except
+            import traceback
+            traceback.print_exc() # response is cut short, the client sees the connection close
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def reject(writer, exc):
+        '''respond with status of bad request and close the connection'''
+        writer.write('HTTP/1.1 {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n{}'.format(exc.status, len(str(exc)), exc).encode('latin-1'))
+        await writer.drain()
+
+    async def read_head(self, reader):
+        '''read request line and headers, None if the client closed the connection'''
+        try:
+            line = await reader.readline()
+            if not line:
+                return None
+            method, target, version = line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+            headers = []
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, sep, value = line.decode('latin-1').partition(':')
+                if not sep:
+                    raise BadRequest('Bad header line.')
+                headers.append((name.strip(), value.strip()))
+        except ValueError: # also line over LINE_MAX
+            raise BadRequest('Bad request line or headers.')
+        return method, target, version, headers
+
+    def environ(self, request, peer, body):
+        '''get wsgi environ of request'''
+        method, target, version, headers = request
+        path, _, query = target.partition('?')
+        environ = {'REQUEST_METHOD': method, 'SCRIPT_NAME': '',
+                   'PATH_INFO': unquote_to_bytes(path).decode('latin-1'), 'QUERY_STRING': query,
+                   'SERVER_NAME': self.host, 'SERVER_PORT': str(self.port), 'SERVER_PROTOCOL': version,
+                   'REMOTE_ADDR': peer[0], 'REMOTE_PORT': str(peer[1]),
+                   'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': body,
+                   'wsgi.errors': sys.stderr, 'wsgi.multithread': True,
+                   'wsgi.multiprocess': False, 'wsgi.run_once': False}
+        for name, value in headers:
+            key = name.upper().replace('-', '_')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[key] = value
+            elif 'HTTP_' + key in environ:
+                environ['HTTP_' + key] += ',' + value
+            else:
+                environ['HTTP_' + key] = value
+        return environ
+
+    async def idle(self, read):
+        '''await read of request body, for at most body_timeout seconds'''
+        import asyncio
+        timeout = float(self.options.get('body_timeout', 30))
+        try:
+            return await asyncio.wait_for(read, timeout)
+        except asyncio.TimeoutError:
+            raise Stalled('Request body idle for {:.0f} seconds.'.format(timeout))
+
+    async def read_body(self, reader, writer, environ):
+        '''read request body into spooled file, up to upload_max_bytes'''
+        limit = config.upload_max_bytes()
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise BadRequest('Bad Content-Length.')
+        if length > limit:
+            raise TooLarge('Upload is over {} bytes.'.format(limit))
+        body = SpooledTemporaryFile(max_size=BaseRequest.MEMFILE_MAX)
+        if environ.get('HTTP_EXPECT', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            while True:
+                try:
+                    size = int((await self.idle(reader.readline())).split(b';')[0], 16)
+                except ValueError:
+                    raise BadRequest('Bad chunk size.')
+                if not size:
+                    while (await self.idle(reader.readline())) not in (b'\r\n', b'\n', b''): # trailers
+                        pass
+                    break
+                if body.tell() + size > limit:
+                    body.close()
+                    raise TooLarge('Upload is over {} bytes.'.format(limit))
+                body.write(await self.idle(reader.readexactly(size)))
+                await self.idle(reader.readexactly(2))
+            del environ['HTTP_TRANSFER_ENCODING']
+        else:
+            remaining = length
+            while remaining > 0:
+                chunk = await self.idle(reader.read(min(remaining, CHUNK_SIZE)))
+                if not chunk:
+                    raise ConnectionError('client closed connection')
+                body.write(chunk)
+                remaining -= len(chunk)
+        environ['CONTENT_LENGTH'] = str(body.tell())
+        body.seek(0)
+        return body
+
+    async def respond(self, reader, writer, request, peer):
+        '''read body, call app and write response, returns whether to keep the connection'''
+        # pylint: disable=too-many-locals,too-many-branches
+        import asyncio
+        loop = asyncio.get_running_loop()
+        environ = self.environ(request, peer, None)
+        try:
+            environ['wsgi.input'] = await self.read_body(reader, writer, environ)
+        except BadRequest as exc:
+            await self.reject(writer, exc)
+            return False
+
+        version = environ['SERVER_PROTOCOL']
+        pool = self.pool if environ['REQUEST_METHOD'] in ('GET', 'HEAD') else self.ingest
+        keep = version == 'HTTP/1.1' and environ.get('HTTP_CONNECTION', '').lower() != 'close'
+        start = time.monotonic()
+        try:
+            status, headers, chunks, iterator, result = await loop.run_in_executor(pool, call, self.handler, environ)
+        except Exception: # pylint: disable=broad-except
+            import traceback
+            traceback.print_exc()
+            writer.write(b'HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+            return False
+
+        try:
+            names = {name.lower() for name, _ in headers}
+            chunked = keep and 'content-length' not in names
+            if not keep or 'content-length' not in names and not chunked:
+                headers.append(('Connection', 'close'))
+                keep = False
+            if chunked:
+                headers.append(('Transfer-Encoding', 'chunked'))
+            if 'date' not in names:
+                headers.append(('Date', time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())))
+            head = ['HTTP/1.1 {}'.format(status)] + ['{}: {}'.format(name, value) for name, value in headers]
+            writer.write('{}\r\n\r\n'.format('\r\n'.join(head)).encode('latin-1'))
+
+            sent = 0
+            send = environ['REQUEST_METHOD'] != 'HEAD'
+            while True:
+                for chunk in chunks:
+                    if not chunk or not send:
+                        continue
+                    sent += len(chunk)
+                    writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                    await writer.drain() # backpressure, slow clients only hold this coroutine
+                chunk = await loop.run_in_executor(pool, next, iterator, None)
+                if chunk is None:
+                    break
+                chunks = [chunk]
+            if chunked and send:
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            await loop.run_in_executor(pool, close, result)
+            environ['wsgi.input'].close()
+
+        if not self.quiet:
+            sys.stderr.write('{} - - [{}] "{} {} {}" {} {} {:.1f}ms\n'.format(
+                peer[0], time.strftime('%d/%b/%Y %H:%M:%S'), environ['REQUEST_METHOD'], request[1], version,
+                status.split(' ', 1)[0], sent, (time.monotonic() - start) * 1000))
+        return keep
+
+server_names['asyncio'] = AsyncioServer
+
+#  vim: set ts=8 sw=4 tw=0 :
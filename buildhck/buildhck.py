@@ -2,40 +2,70 @@
 '''automatic build system client/server framework'''
 
 import bottle
-from bottle import BaseTemplate, template as _template
-from bottle import static_file, response, request, redirect, route, abort
+from bottle import BaseTemplate, SimpleTemplate
+from bottle import static_file, response, request, redirect, route, abort, hook
 from buildhck.header import supported_request
-from buildhck import config
+from buildhck import config, cache, journal, trends, archive
+from buildhck.record import BuildRecord, STUSKEYS, SCODEMAP, SCODEFAIL
 from base64 import b64decode
 from datetime import datetime
 from urllib.parse import quote
 import os, re, bz2, json, shutil
-from functools import partial
 
 bottle.BaseRequest.MEMFILE_MAX = 4096 * 1024
 
 ACCEPT = ['text/html', 'application/json']
 
-STUSKEYS = ['build', 'test', 'package', 'analyze']
+RESOURCESMDL = {'wall': 0.0, 'cpu': 0.0, 'maxrss': 0, 'commands': []}
+
+# tokens of resumable uploads holding the log or zip of a stage
+UPLOADSMDL = {'log': '', 'zip': ''}
+
+# analyze warnings counted by category and by file, {} holds counts under any name
+WARNINGSMDL = {'categories': {}, 'files': {}}
 
 BUILDJSONMDL = {'upstream': '',
                 'client': 'unknown client',
                 'commit': 'unknown commit', 'description': '',
                 'force': False,
-                'build': {'status': -1, 'log': ''},
-                'test': {'status': -1, 'log': ''},
-                'package': {'status': -1, 'log': '', 'zip': ''},
-                'analyze': {'status': -1, 'log': ''},
+                'build': {'status': -1, 'log': '', 'resources': RESOURCESMDL, 'uploads': UPLOADSMDL},
+                'test': {'status': -1, 'log': '', 'resources': RESOURCESMDL, 'uploads': UPLOADSMDL},
+                'package': {'status': -1, 'log': '', 'zip': '', 'resources': RESOURCESMDL, 'uploads': UPLOADSMDL},
+                'analyze': {'status': -1, 'log': '', 'resources': RESOURCESMDL, 'uploads': UPLOADSMDL, 'warnings': WARNINGSMDL},
                 'github': {'user': '', 'repo': ''}}
 
 FNFILTERPROG = re.compile(r'[:;*?"<>|()\\]')
 
-SCODEMAP = {-1: 'SKIP', 0: 'FAIL', 1: 'OK'}
+UPLOADTOKENPROG = re.compile(r'^[0-9a-f]{32}$')
+
+# status image urls in serialized builds, closed by an unescaped quote
+STATUSURLPROG = re.compile(r'(/status\.svg)"')
+
+SPARKLINE_BUILDS = 50
 
 def rootpath(*args):
     return os.path.join(os.path.dirname(os.path.abspath(__file__)), *args)
 
-template = partial(_template, template_lookup=(rootpath('views'),))
+TEMPLATES = {}
+
+def compile_templates():
+    '''compile every view once per process, views include each other through the shared cache'''
+    cache = {}
+    for filename in os.listdir(rootpath('views')):
+        name, ext = os.path.splitext(filename)
+        if ext != '.tpl':
+            continue
+        tpl = SimpleTemplate(name=name, lookup=[rootpath('views')])
+        tpl.cache = cache
+        tpl.co # pylint: disable=pointless-statement
+        cache[name] = cache[filename] = tpl
+    TEMPLATES.update(cache)
+
+def template(name, **kwargs):
+    '''render view'''
+    if not TEMPLATES:
+        compile_templates()
+    return TEMPLATES[name].render(**kwargs)
 
 def is_json_request():
     '''check if the request is json'''
@@ -43,7 +73,7 @@ def is_json_request():
 
 def dump_json(dic):
     '''dump json data'''
-    request.content_type = 'application/json'
+    response.content_type = 'application/json'
     return json.dumps(dic)
 
 def remove_control_characters(txt):
@@ -89,85 +119,6 @@ def is_authenticated_for_project(project):
 
     return False
 
-def github_issue(user, repo, subject, body, issueid=None, close=False):
-    '''create/comment/delete github issue'''
-    # pylint: disable=too-many-arguments
-
-    if not config.config['github']:
-        print("no github_token specified, won't handle issue request")
-        return
-
-    if close and not issueid:
-        print("can't close github issue without id")
-        return
-
-    from urllib.request import Request, urlopen
-    from urllib.error import URLError, HTTPError
-
-    data = None
-    handle = None
-    apiroot = 'https://api.github.com'
-
-    if not issueid and not close: # create issue
-        data = {'title': subject, 'body': body}
-        handle = Request('{}/repos/{}/{}/issues'.format(apiroot, quote(user), quote(repo)))
-    elif issueid and not close: # comment
-        data = {'body': body}
-        handle = Request('{}/repos/{}/{}/issues/{}/comments'.format(apiroot, quote(user), quote(repo), issueid))
-    elif issueid and close: # close
-        data = {'state': 'close'}
-        handle = Request('{}/repos/{}/{}/issues/{}'.format(apiroot, quote(user), quote(repo), issueid))
-        handle.get_method = lambda: 'PATCH'
-
-    handle.add_header('Content-Type', 'application/json')
-    handle.add_header('Accept', 'application/vnd.github.v3+json')
-    handle.add_header('Authorization', 'token {}'.format(config.config['github']))
-
-    srvdata = None
-    try:
-        srvdata = urlopen(handle, json.dumps(data).encode('UTF-8'))
-    except HTTPError as exc:
-        print("The server couldn't fulfill the request.")
-        print('Error code: ', exc.code)
-        print(exc.read())
-        return
-    except URLError as exc:
-        print('Failed to reach a server.')
-        print('Reason: ', exc.reason)
-        return
-
-    if not srvdata:
-        return
-
-    if not issueid:
-        issueid = json.loads(srvdata.readall().decode('UTF-8'))['number']
-        print("[GITHUB] issue created ({})".format(issueid))
-    else:
-        print("[GITHUB] issue updated ({})".format(issueid))
-
-    return issueid if not close else None
-
-def handle_github(project, branch, system, fsdate, metadata):
-    '''handle github posthook for build'''
-    github = metadata['github']
-
-    if 'issueid' not in github:
-        github['issueid'] = None
-
-    failed = failure_for_metadata(metadata)
-
-    if not github or (not failed and not github['issueid']):
-        return # nothing to do
-
-    build = get_build_data(project, branch, system, fsdate, get_history=False, in_metadata=metadata)
-    for idx in range(len(build['url'])):
-        build['url'][idx] = absolute_link(build['url'][idx][1:])
-    build['systemimage'] = absolute_link(build['systemimage'][1:])
-
-    subject = template('github_issue', build=build, subject=True)
-    body = template('github_issue', build=build, subject=False)
-    github['issueid'] = github_issue(github['user'], github['repo'], subject, body, github['issueid'], not failed)
-
 def check_github_posthook(data, metadata):
     '''check if github posthook should be used'''
     if not data['github'] or not data['github']['user'] or not data['github']['repo']:
@@ -185,9 +136,12 @@ def check_github_posthook(data, metadata):
 def build_exists(project, branch='', system='', fsdate=''):
     '''check if build dir exists'''
     validate_build(project, branch, system)
-    buildpath = config.build_directory(project, branch, system, fsdate)
+    if fsdate:
+        return archive.has_build(project, branch, system, fsdate)
+    buildpath = config.build_directory(project, branch, system)
     return os.path.exists(buildpath)
 
+@config.project_writer
 def delete_build(project, branch='', system='', fsdate=''):
     '''delete build'''
     # pylint: disable=too-many-branches
@@ -204,26 +158,40 @@ def delete_build(project, branch='', system='', fsdate=''):
                 abort(404, 'Current build does not exist')
         buildpath = os.path.join(buildpath, fsdate)
     parentpath, _ = os.path.split(buildpath)
-    if not os.path.isdir(buildpath):
+    root = config.build_root(project)
+    if os.path.isdir(buildpath):
+        shutil.rmtree(buildpath)
+    elif not fsdate or not archive.remove(project, branch, system, fsdate):
         return False
-    shutil.rmtree(buildpath)
+    remove_from_indexes(project, branch, system, fsdate)
 
     if fsdate and os.path.lexists(currentpath):
         current = os.readlink(currentpath)
         if current == fsdate:
-            latest = os.path.basename(sorted(os.listdir(parentpath))[0])
-            if os.path.lexists(currentpath):
-                os.unlink(currentpath)
-            if latest != 'current':
-                os.symlink(latest, currentpath)
+            os.unlink(currentpath)
+            remaining = archive.fsdates(project, branch, system)
+            if remaining:
+                os.symlink(remaining[-1], currentpath)
 
-    while parentpath != config.build_directory():
+    while parentpath != root:
         if os.path.isdir(parentpath) and not os.listdir(parentpath):
             os.rmdir(parentpath)
         parentpath, _ = os.path.split(parentpath)
 
+    if not os.path.isdir(config.build_directory(project, branch, system)):
+        trends.remove(project, branch, system)
+
+    journal.append('delete', project, branch, system, fsdate)
+    cache.refresh()
     return True
 
+def upload_bytes(value):
+    '''get bytes of uploaded log, base64 in json or a part of multipart upload'''
+    if hasattr(value, 'read'):
+        return value.read()
+    return b64decode(value.encode('UTF-8'))
+
+@config.project_writer
 def save_build(project, branch, system, data):
     '''save build to disk'''
     # pylint: disable=too-many-locals
@@ -257,25 +225,36 @@ def save_build(project, branch, system, data):
     posthook = {}
     posthook['github'] = check_github_posthook(data, metadata)
 
+    logs = {}
     for key, value in data.items():
         if key not in STUSKEYS:
             continue
 
         metadata[key] = {'status': value['status']}
 
+        if 'resources' in value and value['resources']['commands']:
+            metadata[key]['resources'] = value['resources']
+
+        if 'warnings' in value and value['warnings']['categories']:
+            metadata[key]['warnings'] = value['warnings']
+
         if 'log' in value and value['log']:
-            text = remove_control_characters(b64decode(value['log'].encode('UTF-8')).decode('UTF-8'))
+            text = remove_control_characters(upload_bytes(value['log']).decode('UTF-8'))
             buildlog = bz2.compress(text.encode('UTF-8'))
             with open(os.path.join(buildpath, '{}-log.bz2'.format(key)), 'wb') as fle:
                 fle.write(buildlog)
+            logs[key] = text
 
         if 'zip' in value and value['zip']:
-            buildzip = b64decode(value['zip'].encode('UTF-8'))
             with open(os.path.join(buildpath, '{}.zip'.format(key)), 'wb') as fle:
-                fle.write(buildzip)
+                if hasattr(value['zip'], 'read'):
+                    shutil.copyfileobj(value['zip'], fle)
+                else:
+                    fle.write(b64decode(value['zip'].encode('UTF-8')))
 
     with open(os.path.join(buildpath, 'metadata.bz2'), 'wb') as fle:
         if config.config['github'] and posthook['github']:
+            from buildhck.github import handle_github
             handle_github(project, branch, system, fsdate, metadata)
         fle.write(bz2.compress(json.dumps(metadata).encode('UTF-8')))
         if os.path.lexists(currentpath):
@@ -283,14 +262,74 @@ def save_build(project, branch, system, data):
         os.symlink(fsdate, currentpath)
         print("[SAVED] {}".format(project))
 
+    write_json_fragments(BuildRecord(project, branch, system, fsdate, metadata, logs_for_build(project, branch, system, fsdate)))
+    add_to_indexes(project, branch, system, fsdate, metadata, logs)
+    journal.append('save', project, branch, system, fsdate)
+    cache.refresh()
+
+def add_to_indexes(project, branch, system, fsdate, metadata, logs):
+    '''add saved build to the local search index and trends'''
+    # pylint: disable=too-many-arguments
+    from buildhck import search
+    for stage, text in logs.items():
+        search.index_log(project, branch, system, fsdate, stage, text)
+    row = dict(trends.resource_row(metadata, STUSKEYS), **trends.status_row(metadata, STUSKEYS))
+    trends.append(project, branch, system, dict(row, fsdate=int(fsdate)))
+
+def remove_from_indexes(project, branch='', system='', fsdate=''):
+    '''remove deleted build(s) from the local search index and caches'''
+    from buildhck import search, logdiff
+    search.remove(project, branch, system, fsdate)
+    logdiff.remove_cache(project, branch, system)
+    if fsdate and fsdate.isdigit():
+        trends.remove_build(project, branch, system, fsdate)
+
+def apply_journal_entry(entry):
+    '''update local indexes for write of another node'''
+    project, branch, system, fsdate = entry['project'], entry['branch'], entry['system'], entry['fsdate']
+    if entry['op'] == 'delete':
+        remove_from_indexes(project, branch, system, fsdate)
+        if not os.path.isdir(config.build_directory(project, branch, system)):
+            trends.remove(project, branch, system)
+        return
+    if entry['op'] != 'save': # compaction moves builds, indexes stay valid
+        return
+
+    metadata = metadata_for_build(project, branch, system, fsdate)
+    if not metadata: # deleted since
+        return
+    logs = {}
+    for stage in STUSKEYS:
+        fle = archive.open_file(project, branch, system, fsdate, '{}-log.bz2'.format(stage))
+        if fle:
+            with bz2.BZ2File(fle) as log:
+                logs[stage] = log.read().decode('UTF-8')
+    add_to_indexes(project, branch, system, fsdate, metadata, logs)
+
+def backfill_indexes():
+    '''rebuild local search index and trends from the tree'''
+    from buildhck import search
+    search.backfill()
+    trends.backfill(STUSKEYS)
+
+def reject_on_replica():
+    '''abort writes on read-only replicas'''
+    if config.config.get('replica'):
+        abort(403, 'This is a read-only replica.')
+
 def validate_dict(dictionary, model):
     '''validate dictionary using model'''
     for key, value in dictionary.items():
         if key not in model:
             raise ValueError("model does not contain key '{}'".format(key))
+        if isinstance(model[key], float) and isinstance(value, int) and not isinstance(value, bool):
+            continue
         if not isinstance(value, type(model[key])):
             return False
-        if isinstance(value, dict) and not validate_dict(value, model[key]):
+        if isinstance(value, dict) and not model[key]:
+            if not all(isinstance(count, int) and not isinstance(count, bool) for count in value.values()):
+                return False
+        elif isinstance(value, dict) and not validate_dict(value, model[key]):
             return False
     return True
 
@@ -299,28 +338,96 @@ def validate_status_codes(dictionary):
     for key, value in dictionary.items():
         if key == 'analyze' or key not in STUSKEYS:
             continue
-        if -1 < value['status'] > 1:
+        if value['status'] not in SCODEMAP:
             return False
     return True
 
 def init_dict_using_model(dictionary, model):
-    '''set unset values from model dictionary'''
+    '''set unset values from model dictionary, values are copied so the model is never shared'''
+    import copy
     for key, value in model.items():
         if key not in dictionary or (not dictionary[key] and not isinstance(dictionary[key], (int, float, complex))):
-            dictionary[key] = value
+            dictionary[key] = copy.deepcopy(value)
         if isinstance(value, dict) and isinstance(dictionary[key], dict):
             init_dict_using_model(dictionary[key], value)
 
 @route('/build/<project>/<branch>/<system>', ['POST'])
 def got_build(project=None, branch=None, system=None):
     '''got build data from client'''
+    reject_on_replica()
     if not is_authenticated_for_project(project):
         abort(401, 'Not authorized.')
 
+    from buildhck.admission import admit
+    # the slot is held before the body is read or decoded, bodies of unknown length are charged the most they may be
+    size = request.content_length if request.content_length >= 0 else config.upload_max_bytes()
+    with admit(project, request.remote_addr, size):
+        ingest_build(project, branch, system)
+    return 'OK!'
+
+def content_decoders():
+    '''get readers decoding request bodies by Content-Encoding, zstd needs the zstandard module'''
+    import gzip
+    decoders = {'gzip': lambda fle: gzip.GzipFile(fileobj=fle, mode='rb')}
     try:
-        data = request.json
-    except ValueError:
-        data = None
+        import zstandard
+        decoders['zstd'] = lambda fle: zstandard.ZstdDecompressor().stream_reader(fle)
+    except ImportError:
+        pass
+    return decoders
+
+def decode_request_body():
+    '''decode compressed request body into a spooled file, bodies are never in memory at once'''
+    from tempfile import SpooledTemporaryFile
+    encoding = request.get_header('Content-Encoding', 'identity').strip().lower()
+    if encoding == 'identity':
+        return
+    decoders = content_decoders()
+    if encoding not in decoders:
+        raise bottle.HTTPError(415, 'Unsupported Content-Encoding.', **{'Accept-Encoding': ', '.join(sorted(decoders) + ['identity'])})
+
+    limit = config.upload_max_bytes()
+    body = SpooledTemporaryFile(max_size=bottle.BaseRequest.MEMFILE_MAX)
+    try:
+        reader = decoders[encoding](request.body)
+        for chunk in iter(lambda: reader.read(64 * 1024), b''):
+            body.write(chunk)
+            if body.tell() > limit:
+                abort(413, 'Upload is too large.')
+    except (OSError, EOFError, ValueError) as exc: # zstandard errors are ValueErrors
+        abort(400, 'Bad {} body: {}'.format(encoding, exc))
+    request.environ['CONTENT_LENGTH'] = str(body.tell())
+    body.seek(0)
+    request.environ['wsgi.input'] = body
+    for key in ('HTTP_CONTENT_ENCODING', 'HTTP_TRANSFER_ENCODING', 'bottle.request.body'):
+        request.environ.pop(key, None)
+
+def multipart_build():
+    '''get build of multipart upload, the build json in part 'json' and logs and zips in parts named stage.log and stage.zip'''
+    try:
+        parts = request.POST
+        meta = parts.get('json', '')
+        data = json.loads(meta.file.read().decode('UTF-8') if isinstance(meta, bottle.FileUpload) else meta)
+    except (ValueError, bottle.MultipartError):
+        return None, {}
+    files = {}
+    for name, part in parts.allitems():
+        stage, _, kind = name.partition('.')
+        if isinstance(part, bottle.FileUpload) and stage in STUSKEYS and kind in ('log', 'zip'):
+            files[(stage, kind)] = part.file
+    return data, files
+
+def ingest_build(project, branch, system):
+    '''validate and save uploaded build'''
+    decode_request_body()
+    files = {}
+    if request.content_type.startswith('multipart/'):
+        data, files = multipart_build()
+    else:
+        try:
+            data = request.json
+        except ValueError:
+            data = None
 
     if data:
         init_dict_using_model(data, BUILDJSONMDL)
@@ -332,19 +439,90 @@ def got_build(project=None, branch=None, system=None):
                '"commit":"commit sha",\n' \
                '"force":true/false,\n' \
                '"description":"commit description",\n' \
-               '"build":{"status":-1/0/1, "log":"base64"},\n' \
-               '"test":{"status":-1/0/1, "log":"base64"},\n' \
-               '"package":{"status":-1/0/1, "log":"base64", "zip":"base64"},\n' \
-               '"analyze":{"status":number of warnings, "log":"base64"},\n' \
+               '"build":{"status":-1/0/1/2, "log":"base64"},\n' \
+               '"test":{"status":-1/0/1/2, "log":"base64"},\n' \
+               '"package":{"status":-1/0/1/2, "log":"base64", "zip":"base64"},\n' \
+               '"analyze":{"status":number of warnings, "log":"base64", "warnings":{"categories":{"name":count}, "files":{"path":count}}},\n' \
                '"github":{"user":"github user", "repo":"github repository"}\n' \
                '}\n' \
-               'status -1 == skipped\nstatus  0 == failed\nstatus  1 == OK\n' \
+               'status -1 == skipped\nstatus  0 == failed\nstatus  1 == OK\nstatus  2 == timed out\n' \
                'force replaces build if already submitted for the commit\n' \
                'logs and files should be base64 encoded\n' \
+               'or sent raw in multipart parts named stage.log and stage.zip, the json in part json\n' \
+               'or uploaded in resumable chunks to /upload/project/token and given as "uploads":{"log":"token", "zip":"token"}\n' \
                'specify github for post-hook issues\n')
 
-    save_build(project, branch, system, data)
-    return 'OK!'
+    uploads = []
+    for stage in STUSKEYS:
+        for kind, token in data[stage]['uploads'].items():
+            if token:
+                path = upload_path(project, token)
+                if not os.path.isfile(path):
+                    abort(400, 'Upload {} does not exist.'.format(token))
+                files[(stage, kind)] = open(path, 'rb')
+                uploads.append(path)
+
+    for (stage, kind), fle in files.items():
+        data[stage][kind] = fle
+    try:
+        save_build(project, branch, system, data)
+    finally:
+        for fle in files.values():
+            fle.close()
+    for path in uploads:
+        os.remove(path)
+
+def upload_path(project, token):
+    '''get file of resumable upload'''
+    validate_build(project)
+    if not UPLOADTOKENPROG.match(token):
+        abort(400, 'Bad upload token.')
+    return config.data_directory('uploads', project, token)
+
+def expire_uploads(project):
+    '''remove resumable uploads of project not completed in 'upload_expire_days' days'''
+    from time import time
+    directory = config.data_directory('uploads', project)
+    expire = time() - config.config.get('upload_expire_days', 7) * 86400
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        if os.path.getmtime(os.path.join(directory, name)) < expire:
+            os.remove(os.path.join(directory, name))
+
+@route('/upload/<project>/<token>', ['GET'])
+def upload_offset(project=None, token=None):
+    '''get bytes received of resumable upload'''
+    reject_on_replica()
+    if not is_authenticated_for_project(project):
+        abort(401, 'Not authorized.')
+    path = upload_path(project, token)
+    return {'offset': os.path.getsize(path) if os.path.exists(path) else 0}
+
+@route('/upload/<project>/<token>', ['PUT'])
+def upload_chunk(project=None, token=None):
+    '''append chunk to resumable upload, the build references the upload by token once it is complete'''
+    reject_on_replica()
+    if not is_authenticated_for_project(project):
+        abort(401, 'Not authorized.')
+    path = upload_path(project, token)
+    try:
+        offset = int(request.query.get('offset', ''))
+    except ValueError:
+        abort(400, 'Bad offset.')
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if offset != size:
+        abort(409, 'Offset does not match the {} bytes received.'.format(size))
+    if size + max(request.content_length, 0) > config.upload_max_bytes():
+        abort(413, 'Upload is too large.')
+    if not size:
+        expire_uploads(project)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    from buildhck.admission import admit
+    with admit(project, request.remote_addr, max(request.content_length, 0)):
+        body = request.body # read whole before appending, so interrupted chunks are never half written
+        with open(path, 'ab') as fle:
+            shutil.copyfileobj(body, fle)
+    return {'offset': os.path.getsize(path)}
 
 #FIXME: separate views
 
@@ -354,6 +532,7 @@ def got_build(project=None, branch=None, system=None):
 @route('/build/<project>/<branch>/<system>/<fsdate>', ['DELETE'])
 def delete_build_view(project, **kwargs):
     '''got build delete request from client'''
+    reject_on_replica()
     if not is_authenticated_for_project(project):
         abort(401, 'Not authorized.')
     if not delete_build(project, **kwargs):
@@ -368,8 +547,10 @@ def get_build_file(project=None, branch=None, system=None, fsdate=None, bfile=No
     ext = os.path.splitext(bfile)[1]
     path = config.build_directory(project, branch, system, fsdate)
 
-    if not os.path.exists(path):
+    if not archive.has_build(project, branch, system, fsdate):
         abort(404, "Build does not exist.")
+    if not os.path.exists(path):
+        return get_archived_build_file(project, branch, system, fsdate, bfile)
 
     if bfile == 'status.svg':
         response.set_header('Cache-control', 'no-cache')
@@ -382,13 +563,78 @@ def get_build_file(project=None, branch=None, system=None, fsdate=None, bfile=No
     elif ext == '.bz2':
         return static_file(bfile, root=rootpath(path))
     elif ext == '.txt':
-        response.content_type = 'text/plain'
-        path = rootpath(path, bfile.replace('.txt', '.bz2'))
-        if os.path.exists(path):
-            return bz2.BZ2File(path).read()
+        fle = archive.open_file(project, branch, system, fsdate, bfile.replace('.txt', '.bz2'))
+        if fle:
+            response.content_type = 'text/plain'
+            return stream_log(fle)
+    elif bfile.endswith('-log.diff'):
+        return get_build_log_diff(project, branch, system, fsdate, bfile[:-len('-log.diff')])
+
+    abort(404, 'No such file.')
+
+def stream_log(fle):
+    '''yield compressed log decompressed in chunks'''
+    with bz2.BZ2File(fle) as log:
+        yield from iter(lambda: log.read(64 * 1024), b'')
+
+def get_archived_build_file(project, branch, system, fsdate, bfile):
+    '''get file for build packed into the archive of its system'''
+    ext = os.path.splitext(bfile)[1]
+    if bfile == 'status.svg':
+        response.set_header('Cache-control', 'no-cache')
+        response.set_header('Pragma', 'no-cache')
+        if not failure_for_build(project, branch, system, fsdate):
+            return static_file('ok.svg', root=rootpath('media', 'status'))
+        return static_file('fail.svg', root=rootpath('media', 'status'))
+    elif ext in ('.zip', '.bz2'):
+        fle = archive.open_archived(project, branch, system, fsdate, bfile)
+        if fle is not None:
+            response.content_type = 'application/zip' if ext == '.zip' else 'application/x-bzip2'
+            response.set_header('Content-Length', str(fle.seek(0, os.SEEK_END)))
+            fle.seek(0)
+            return fle
+    elif ext == '.txt':
+        fle = archive.open_file(project, branch, system, fsdate, bfile.replace('.txt', '.bz2'))
+        if fle:
+            response.content_type = 'text/plain'
+            return stream_log(fle)
+    elif bfile.endswith('-log.diff'):
+        return get_build_log_diff(project, branch, system, fsdate, bfile[:-len('-log.diff')])
 
     abort(404, 'No such file.')
 
+def last_good_build(project, branch, system, fsdate):
+    '''get fsdate of most recent passing build before fsdate'''
+    for old_fsdate in reversed(archive.fsdates(project, branch, system)):
+        if old_fsdate >= fsdate:
+            continue
+        metadata = metadata_for_build(project, branch, system, old_fsdate)
+        if metadata and not failure_for_metadata(metadata):
+            return old_fsdate
+    return None
+
+def get_build_log_diff(project, branch, system, fsdate, stage):
+    '''get unified diff of stage log against the last good build'''
+    if fsdate == 'current':
+        fsdate = os.readlink(config.build_directory(project, branch, system, 'current'))
+
+    logname = '{}-log.bz2'.format(stage)
+    if not archive.has_file(project, branch, system, fsdate, logname):
+        abort(404, 'No such file.')
+
+    basefsdate = last_good_build(project, branch, system, fsdate)
+    if not basefsdate or not archive.has_file(project, branch, system, basefsdate, logname):
+        abort(404, 'No passing build to compare against.')
+
+    from buildhck import logdiff
+    response.content_type = 'text/plain'
+    cachepath = logdiff.cache_path(project, branch, system, fsdate, basefsdate, stage)
+    if os.path.exists(cachepath):
+        return static_file(os.path.basename(cachepath), root=os.path.dirname(cachepath), mimetype='text/plain')
+    basefle = archive.open_file(project, branch, system, basefsdate, logname)
+    fle = archive.open_file(project, branch, system, fsdate, logname)
+    return logdiff.stream_diff(basefle, fle, '{}/{}-log.txt'.format(basefsdate, stage), '{}/{}-log.txt'.format(fsdate, stage), cachepath)
+
 @route('/build/<project>/<branch>/<system>/<bfile>')
 def get_build_file_short(project=None, branch=None, system=None, bfile=None):
     '''short version of get build file'''
@@ -419,7 +665,7 @@ def failure_for_metadata(metadata):
     for key, value in metadata.items():
         if key == 'analyze' or key not in STUSKEYS:
             continue
-        if value['status'] == 0:
+        if value['status'] in SCODEFAIL:
             return True
     return False
 
@@ -448,132 +694,171 @@ def fsdate_for_build(project, branch, system, fsdate):
     '''get fsdate for build'''
     return fsdate_for_metadata(metadata_for_build(project, branch, system, fsdate))
 
-def parse_links_for_build(project, branch, system, fsdate, metadata):
-    '''get status links array for build'''
-    systempath = config.build_directory(project, branch, system, fsdate)
-
-    for key in STUSKEYS:
-        if os.path.exists(os.path.join(systempath, '{}-log.bz2'.format(key))):
-            metadata[key]['url'] = quote('/build/{}/{}/{}/{}/{}-log.txt'.format(project, branch, system, fsdate, key))
-        else:
-            metadata[key]['url'] = '#'
-
-def status_image_link_for_build(project, branch, system, fsdate):
-    '''get status image for build'''
-    import time
-    return '{}?{}'.format(quote('/build/{}/{}/{}/{}/status.svg'.format(project, branch, system, fsdate)), time.time())
-
-def metadata_for_build(project, branch, system, fsdate):
-    '''get metadata for build'''
-    metadata = {}
-    path = config.build_directory(project, branch, system, fsdate, 'metadata.bz2')
-    if os.path.exists(path):
+def logs_for_build(project, branch, system, fsdate):
+    '''get bit per stage in STUSKEYS that has a log'''
+    logs = 0
+    for idx, key in enumerate(STUSKEYS):
+        if archive.has_file(project, branch, system, fsdate, '{}-log.bz2'.format(key)):
+            logs |= 1 << idx
+    return logs
+
+def read_metadata(project, branch, system, fsdate):
+    '''get decompressed metadata for build, or None'''
+    fle = archive.open_file(project, branch, system, fsdate, 'metadata.bz2')
+    if fle:
         try:
-            bz2data = bz2.BZ2File(path).read()
+            with bz2.BZ2File(fle) as metadata:
+                bz2data = metadata.read()
         except EOFError:
             bz2data = None
         if bz2data:
-            metadata = json.loads(bz2data.decode('UTF-8'))
-    return metadata
-
-def icon_for_system(system):
-    '''get link to icon for system'''
-    icon = 'platform/unknown.svg'
-    if 'linux' in system.lower():
-        icon = '/platform/linux.svg'
-    if 'darwin' in system.lower():
-        icon = '/platform/darwin.svg'
-    if 'win32' in system.lower() or 'win64' in system.lower():
-        icon = '/platform/windows.svg'
-    if 'bsd' in system.lower():
-        icon = '/platform/bsd.svg'
-    return icon
+            return json.loads(bz2data.decode('UTF-8'))
+    return None
+
+@cache.cached
+def build_record(project, branch, system, fsdate):
+    '''get compact record for build, or None'''
+    metadata = read_metadata(project, branch, system, fsdate)
+    if not metadata or not metadata.get('date'):
+        return None
+    return BuildRecord(project, branch, system, fsdate, metadata, logs_for_build(project, branch, system, fsdate))
+
+def metadata_for_build(project, branch, system, fsdate):
+    '''get metadata for build'''
+    record = build_record(project, branch, system, fsdate)
+    return record.metadata() if record else {}
 
 def get_build_data(project, branch, system, fsdate, get_history=True, in_metadata=None):
     '''get data for build'''
     # pylint: disable=too-many-arguments
-
-    metadata = {}
     if in_metadata:
-        for key, value in in_metadata.items():
-            metadata[key] = value
+        if not in_metadata.get('date'):
+            return None
+        record = BuildRecord(project, branch, system, fsdate, in_metadata, logs_for_build(project, branch, system, fsdate))
     else:
-        metadata = metadata_for_build(project, branch, system, fsdate)
-    if not metadata:
-        return
-    date = date_for_metadata(metadata)
-    if not date:
-        return
-
-    for key in STUSKEYS:
-        if key not in metadata:
-            metadata[key] = {'status': -1}
-
-    metadata['project'] = project
-    metadata['fsdate'] = fsdate
-    metadata['idate'] = date
-    metadata['fdate'] = date.strftime("%Y-%m-%d %H:%M")
-    metadata['system'] = system
-    metadata['branch'] = branch
-    metadata['systemimage'] = icon_for_system(system)
-    metadata['statusimage'] = status_image_link_for_build(project, branch, system, fsdate)
-
-    parse_status_for_metadata(metadata)
-    parse_links_for_build(project, branch, system, fsdate, metadata)
+        record = build_record(project, branch, system, fsdate)
+    if not record:
+        return None
 
     if get_history:
-        metadata['history'] = []
-        systempath =config.build_directory(project, branch, system)
-        current = os.readlink(os.path.join(systempath, 'current'))
-        for old_fsdate in sorted(os.listdir(systempath), reverse=True):
-            if old_fsdate == fsdate or old_fsdate == current or old_fsdate == 'current':
+        record = record.copy() # cached records are shared
+        record.history = []
+        current = archive.resolve(project, branch, system, 'current')
+        for old_fsdate in reversed(archive.fsdates(project, branch, system)):
+            if old_fsdate == fsdate or old_fsdate == current:
                 continue
-            old = get_build_data(project, branch, system, old_fsdate, get_history=False)
+            old = build_record(project, branch, system, old_fsdate)
             if not old:
                 continue
-            metadata['history'].append(old)
+            record.history.append(old)
 
-    return metadata
+    return record
 
-def get_projects():
-    '''get projects for index page'''
-    projects = []
-    #FIXME: use os.walk, silly pants
-    for project in os.listdir(config.build_directory()):
-        projects.append({'name': project, 'url': None, 'date': None, 'builds': []})
-        projectpath = config.build_directory(project)
+def project_names():
+    '''get names of projects, the most recently built first, from the current links alone'''
+    latest = {}
+    for root in config.build_roots():
+        for name in os.listdir(root):
+            if name.startswith('.'):
+                continue
+            latest.setdefault(name, '')
+            projectpath = config.build_directory(name)
+            for branch in os.listdir(projectpath):
+                for system in os.listdir(os.path.join(projectpath, branch)):
+                    currentpath = os.path.join(projectpath, branch, system, 'current')
+                    if os.path.islink(currentpath):
+                        latest[name] = max(latest[name], os.readlink(currentpath))
+    return sorted(sorted(latest), key=lambda name: latest[name], reverse=True)
+
+def iter_projects():
+    '''yield projects for index page one at a time, the most recently built first'''
+    for name in project_names():
+        project = {'name': name, 'url': None, 'date': None, 'builds': []}
+        projectpath = config.build_directory(name)
         for branch in os.listdir(projectpath):
             branchpath = os.path.join(projectpath, branch)
             for system in os.listdir(branchpath):
-                data = get_build_data(project, branch, system, 'current')
+                data = get_build_data(name, branch, system, 'current')
                 if not data:
                     continue
-                if not projects[-1]['date'] or data['idate'] > projects[-1]['date']:
-                    projects[-1]['date'] = data['idate']
+                if not project['date'] or data['idate'] > project['date']:
+                    project['date'] = data['idate']
                     if 'upstream' in data:
-                        projects[-1]['url'] = data['upstream']
-                projects[-1]['builds'].append(data)
-        if projects[-1]['date']:
-            projects[-1]['builds'] = sorted(projects[-1]['builds'], key=lambda k: k['date'], reverse=True)
-        else:
-            projects.remove(projects[-1])
+                        project['url'] = data['upstream']
+                project['builds'].append(data)
+        if project['date']:
+            project['builds'] = sorted(project['builds'], key=lambda k: k['date'], reverse=True)
+            yield project
 
-    projects = sorted(projects, key=lambda k: k['date'], reverse=True)
-    return projects
+def get_projects():
+    '''get projects for index page'''
+    return list(iter_projects())
 
 def clean_build_json(build):
     '''clean build data for json dump'''
-    build['date'] = build['fdate']
-    del build['idate']
-    del build['fdate']
-    if 'history' in build:
-        for old in build['history']:
-            clean_build_json(old)
-    return build
+    return build.as_json()
+
+def write_json_fragments(record):
+    '''serialize build once at ingest, as history entry and as current build'''
+    buildpath = config.build_directory(record.project, record.branch, record.system, record.fsdate)
+    current = record.copy()
+    current.fsdate = 'current'
+    for name, form in (('build.json', record), ('current.json', current)):
+        with open(os.path.join(buildpath, name), 'w', encoding='UTF-8') as fle:
+            fle.write(json.dumps(clean_build_json(form)))
+
+def bust_status_cache(text):
+    '''add cache-buster to status image urls of serialized builds when served, fragments are written without it'''
+    import time
+    return STATUSURLPROG.sub(r'\1?{}"'.format(time.time()), text)
+
+def json_fragment(project, branch, system, fsdate):
+    '''get serialized build, builds saved without fragments are serialized now'''
+    fle = archive.open_file(project, branch, system, fsdate, 'current.json' if fsdate == 'current' else 'build.json')
+    if fle:
+        with fle:
+            return fle.read().decode('UTF-8')
+    return json.dumps(clean_build_json(build_record(project, branch, system, fsdate)))
+
+def project_json(project):
+    '''get serialized project of iter_projects() from build fragments'''
+    builds = ','.join(json_fragment(project['name'], build['branch'], build['system'], 'current') for build in project['builds'])
+    return '{{"name": {}, "url": {}, "builds": [{}]}}'.format(json.dumps(project['name']), json.dumps(project['url']), builds)
+
+@cache.cached
+def index_json():
+    '''get serialized index page'''
+    return '[{}]'.format(', '.join(project_json(project) for project in get_projects()))
+
+@cache.cached
+def system_json(project, branch, system):
+    '''get serialized system page, or None'''
+    data = get_build_data(project, branch, system, 'current')
+    if not data:
+        return None
+    history = ', '.join(json_fragment(project, branch, system, old.fsdate) for old in data['history'])
+    return '{}, "history": [{}]}}'.format(json_fragment(project, branch, system, 'current')[:-1], history)
+
+@route('/trends/<project>/<branch>/<system>', ['GET'])
+def status_trend(project=None, branch=None, system=None):
+    '''stage status, analyze warnings and commit over history'''
+    validate_build(project, branch, system)
+    if not build_exists(project, branch, system):
+        abort(404, 'Builds for system not found')
+    return dump_json(trends.read_status(project, branch, system, STUSKEYS))
+
+@route('/trends/<project>/<branch>/<system>/resources', ['GET'])
+def resources_trend(project=None, branch=None, system=None):
+    '''wall time, cpu time and peak rss of stages over history'''
+    validate_build(project, branch, system)
+    if not build_exists(project, branch, system):
+        abort(404, 'Builds for system not found')
+    return dump_json(trends.read_resources(project, branch, system, STUSKEYS))
 
 @route('/delete/<project>/<branch>/<system>/<fsdate>', ['GET'])
 def delete_build_ui(project=None, branch=None, system=None, fsdate=None):
     '''delete build using get interface'''
+    reject_on_replica()
     admin = True if request.environ.get('REMOTE_ADDR') == '127.0.0.1' else False
     if not admin:
         abort(403, 'You are not allowed to do this')
@@ -588,32 +873,92 @@ def delete_build_ui(project=None, branch=None, system=None, fsdate=None):
 def system_page(project=None, branch=None, system=None):
     '''got branch delete request from client'''
     validate_build(project, branch, system)
+    if is_json_request():
+        data = system_json(project, branch, system)
+        if not data:
+            abort(404, 'Builds for system not found')
+        response.content_type = 'application/json'
+        return bust_status_cache(data)
     data = get_build_data(project, branch, system, 'current')
     if not data:
         abort(404, 'Builds for system not found')
-    if is_json_request():
-        return dump_json(clean_build_json(data))
     admin = True if request.environ.get('REMOTE_ADDR') == '127.0.0.1' else False
-    return template('build', admin=admin, build=data, standalone=True)
+    warnings = trends.read_status(project, branch, system, STUSKEYS)['warnings'][-SPARKLINE_BUILDS:]
+    return template('build', admin=admin, build=data, standalone=True, sparkline=trends.sparkline(warnings))
+
+def stream_index_json():
+    '''yield projects as json array, one project at a time'''
+    yield '['
+    for idx, project in enumerate(iter_projects()):
+        yield '{}{}'.format(', ' if idx else '', bust_status_cache(project_json(project)))
+    yield ']'
+
+def stream_index_html(admin):
+    '''yield index page, flushing the page header before any project is read'''
+    head, tail = template('html_base', title='buildhck', maxwidth=2048, base='\0').split('\0')
+    yield head
+    itr = 0
+    for itr, project in enumerate(iter_projects(), 1):
+        yield template('project', admin=admin, project=project)
+        if itr % 3 == 0:
+            yield "<div class='clearfix'></div>"
+    if not itr:
+        yield "<center class='no-projects'>No Projects</center>"
+    yield tail
+
+def is_stream_request():
+    '''check if index should be streamed'''
+    stream = request.query.get('stream')
+    if stream is None:
+        return bool(config.config.get('stream_index'))
+    return stream not in ('', '0', 'false')
 
 @route('/')
 def index():
     '''main page with information of all builds'''
     if is_json_request():
-        projects = get_projects()
-        for project in projects:
-            del project['date']
-            for build in project['builds']:
-                clean_build_json(build)
-        return dump_json(projects)
+        if is_stream_request():
+            response.content_type = 'application/json'
+            return stream_index_json()
+        response.content_type = 'application/json'
+        return bust_status_cache(index_json())
     admin = True if request.environ.get('REMOTE_ADDR') == '127.0.0.1' else False
+    if is_stream_request():
+        return stream_index_html(admin)
     return template('projects', admin=admin, projects=get_projects())
 
+@route('/search/logs', ['GET'])
+def search_logs():
+    '''search build logs'''
+    from buildhck import search
+    query = request.query.getunicode('q', '')
+    try:
+        results = search.search(query)
+    except ValueError as exc:
+        abort(400, str(exc))
+    for result in results:
+        result['url'] = quote('/build/{}/{}/{}/{}/{}-log.txt'.format(result['project'], result['branch'], result['system'], result['fsdate'], result['stage']))
+    if is_json_request():
+        return dump_json(results)
+    return template('search', query=query, results=results)
+
 @route('/favicon.ico')
 def get_favicon():
     '''fetch favicon'''
     return static_file('favicon.ico', root=rootpath('media'))
 
+_follower = None
+
+@hook('before_request')
+def load_config():
+    '''load config on first request, unless run.py already did, and drop caches of older writes'''
+    global _follower
+    config.load()
+    cache.refresh()
+    if config.config.get('replica') and (not _follower or _follower[0] != os.getpid()):
+        # replays of the journal run in the background of every process
+        _follower = (os.getpid(), journal.follower(apply_journal_entry, backfill_indexes, config.config.get('journal_interval', 1.0)))
+
 def setup():
     '''setup method'''
     BaseTemplate.defaults['STUSKEYS'] = STUSKEYS
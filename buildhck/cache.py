@@ -0,0 +1,42 @@
+# pylint: disable=line-too-long
+'''per-process caches invalidated by writes of any process'''
+
+from functools import wraps
+from buildhck import journal
+
+_caches = []
+_generation = None
+
+def generation():
+    '''get generation of the build tree, the journal grows on every write'''
+    return journal.generation()
+
+def clear():
+    '''drop every cached value of this process'''
+    for values in _caches:
+        values.clear()
+
+def refresh():
+    '''drop cached values if any process changed the build tree since last refresh'''
+    global _generation
+    current = generation()
+    if current == _generation:
+        return False
+    clear()
+    _generation = current
+    return True
+
+def cached(func):
+    '''memoize func by its arguments until the build tree changes'''
+    values = {}
+    _caches.append(values)
+
+    @wraps(func)
+    def wrapper(*args):
+        '''cached call'''
+        if args not in values:
+            values[args] = func(*args)
+        return values[args]
+    return wrapper
+
+#  vim: set ts=8 sw=4 tw=0 :
@@ -0,0 +1,152 @@
+# pylint: disable=line-too-long
+'''bounded command output capture, spooled compressed to a temporary file
+
+Output is read in chunks as it arrives, so partial or huge lines never
+block, and written to a gzip spool. Only the first 'log_head' bytes of a
+stage are spooled as they come, the last 'log_tail' bytes are kept until
+the stage ends and whatever is in between is replaced with a note of how
+much was omitted. 'log_timestamps' prefixes every line with the seconds
+since the stage started.
+'''
+
+import re
+import gzip
+from time import monotonic
+from base64 import b64encode
+from collections import deque
+from tempfile import TemporaryFile
+from buildhck import config
+
+CHUNK_SIZE = 64 * 1024
+
+LINES = re.compile(rb'[^\n]*\n|[^\n]+')
+
+STAMP = re.compile(rb'^\[ *\d+\.\d{3}\] ')
+
+# multiple of 3, so chunks encode to base64 without padding in between
+B64_CHUNK_SIZE = 3 * 16 * 1024
+
+class Capture:
+    '''spool of stage log'''
+
+    def __init__(self, head=None, tail=None, timestamps=None):
+        self.head = config.config.get('log_head', 32 * 1024 * 1024) if head is None else head
+        self.tail = config.config.get('log_tail', 8 * 1024 * 1024) if tail is None else tail
+        self.timestamps = config.config.get('log_timestamps', False) if timestamps is None else timestamps
+        self.file = TemporaryFile()
+        self.spool = gzip.GzipFile(fileobj=self.file, mode='wb', compresslevel=6)
+        self.spooled = 0
+        self.kept = deque()
+        self.keptsize = 0
+        self.omitted = 0
+        self.start = monotonic()
+        self.newline = True
+        self.empty = True
+        self.closed = False
+        self.length = 0
+
+    def stamp(self, data):
+        '''prefix lines of data with seconds since start'''
+        prefix = '[{:10.3f}] '.format(monotonic() - self.start).encode('UTF-8')
+        out = []
+        for line in LINES.findall(data):
+            out.append(prefix + line if self.newline else line)
+            self.newline = line.endswith(b'\n')
+        return b''.join(out)
+
+    def write(self, data):
+        '''capture chunk of output'''
+        if not data:
+            return
+        self.empty = False
+        if self.timestamps:
+            data = self.stamp(data)
+        if self.spooled < self.head:
+            size = min(len(data), self.head - self.spooled)
+            self.spool.write(data[:size])
+            self.spooled += size
+            data = data[size:]
+        if data:
+            self.kept.append(data)
+            self.keptsize += len(data)
+            while self.kept and self.keptsize - len(self.kept[0]) >= self.tail:
+                self.omitted += len(self.kept[0])
+                self.keptsize -= len(self.kept.popleft())
+
+    def close(self):
+        '''spool the tail and finish the spool'''
+        if self.closed:
+            return
+        if self.keptsize > self.tail:
+            first = self.kept.popleft()
+            cut = self.keptsize - self.tail
+            newline = first.find(b'\n', cut - 1) # tail starts from a whole line when it can
+            if newline >= 0:
+                cut = newline + 1
+            self.omitted += cut
+            self.kept.appendleft(first[cut:])
+        self.length = self.spooled
+        if self.omitted:
+            self.kept.appendleft('\n... {} bytes omitted ...\n'.format(self.omitted).encode('UTF-8'))
+        for data in self.kept:
+            self.spool.write(data)
+            self.length += len(data)
+        self.kept.clear()
+        self.spool.close()
+        self.closed = True
+
+    def size(self):
+        '''get size of log'''
+        self.close()
+        return self.length
+
+    def save(self, path):
+        '''copy spool to path'''
+        import shutil
+        self.close()
+        if self.file is None:
+            shutil.copyfile(self.path, path)
+            return
+        self.file.seek(0)
+        with open(path, 'wb') as fle:
+            shutil.copyfileobj(self.file, fle)
+
+    @classmethod
+    def load(cls, path, length):
+        '''get capture of log saved to path, opened only while it's read'''
+        capture = cls.__new__(cls)
+        capture.file = None
+        capture.path = path
+        capture.length = length
+        capture.timestamps = False
+        capture.empty = not length
+        capture.closed = True
+        return capture
+
+    def open(self):
+        '''get binary file reading the log'''
+        self.close()
+        if self.file is None:
+            return gzip.open(self.path, 'rb')
+        self.file.seek(0)
+        return gzip.GzipFile(fileobj=self.file, mode='rb')
+
+    def lines(self):
+        '''iterate lines of log, without timestamps'''
+        with self.open() as fle:
+            for line in fle:
+                yield STAMP.sub(b'', line, 1) if self.timestamps else line
+
+    def chunks(self):
+        '''iterate log in chunks'''
+        with self.open() as fle:
+            yield from iter(lambda: fle.read(CHUNK_SIZE), b'')
+
+    def b64chunks(self):
+        '''iterate log encoded as base64'''
+        with self.open() as fle:
+            for chunk in iter(lambda: fle.read(B64_CHUNK_SIZE), b''):
+                yield b64encode(chunk)
+
+    def __bool__(self):
+        return not self.empty
@@ -2,10 +2,10 @@
 '''buildhck python client'''
 
 import os
+import re
 import json
 import shlex
 import yaml
-from base64 import b64encode
 from importlib import import_module
 
 from buildhck.client.protocols import DownloadException, NothingToDoException
@@ -14,10 +14,33 @@ from buildhck import config
 import logging
 logging.root.name = 'buildhck'
 
+LOGFORMAT = '[%(name)s] [%(levelname)s]: %(message)s'
+
+STAGES = ['build', 'test', 'package', 'analyze']
+
+# remote heads checked at once in recipes directory mode
+CHECKS = 16
+
+# status of stage killed for running past its timeout
+TIMEOUT = 2
+
+# files with the most warnings sent with the analyze stage
+ANALYZE_FILES = 100
+
+# inline flags at the start of an analyze pattern
+INLINE_FLAGS = re.compile(r'\(\?([aiLmsux]+)\)')
+
+# seconds timed out commands get to exit after SIGTERM, and after SIGKILL before their output is abandoned
+KILL_GRACE = 10
+
 class CookException(Exception):
     '''exception related to cooking, if this fails the failed data is sent'''
 
 
+class CookTimeout(CookException):
+    '''exception raised when command ran past its timeout and got killed'''
+
+
 class RecipeException(Exception):
     '''exception raised when there was problem with recipe, if this fails nothing is sent'''
 
@@ -30,102 +53,319 @@ def s_mkdir(sdir):
         raise IOError("local path '{}' is not a directory".format(sdir))
 
 
-def touch(path):
-    '''touch file'''
-    with open(path, 'a'):
-        os.utime(path, None)
-
-
 def expand_cmd(cmd, replace):
     '''expand commands from recipies'''
     cmd_list = shlex.split(cmd)
     for i, item in enumerate(cmd_list):
-        for rep in replace:
+        for rep in sorted(replace, key=len, reverse=True): # $builddir before a $build axis
             if rep in item:
-                cmd_list[i] = item.replace(rep, replace[rep])
+                item = cmd_list[i] = item.replace(rep, replace[rep])
     logging.debug(cmd_list)
     return cmd_list
 
 
-def run_cmd_catch_output(cmd):
-    '''run command and catch output and return value'''
+def maxrss_kilobytes(usage):
+    '''get peak resident set size of rusage in kilobytes'''
+    import sys
+    return usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+
+
+def command_limits(recipe):
+    '''get timeouts and rlimits of commands of recipe, from the recipe or the client config'''
+    limits = {key: recipe.get(key, config.config.get(key)) for key in ('command_timeout', 'cpu_limit', 'memory_limit')}
+    limits['deadline'] = recipe.get('deadline')
+    return limits
+
+
+def rlimits(pid, limits):
+    '''apply cpu seconds and memory MiB limits to the started command, processes it starts inherit them
+
+    Set with prlimit from the parent, as stages run in threads where
+    preexec_fn is not safe.
+    '''
+    import resource
+    cpu = limits.get('cpu_limit')
+    memory = limits.get('memory_limit')
+    if cpu: # SIGXCPU at the limit, SIGKILL if it is ignored
+        resource.prlimit(pid, resource.RLIMIT_CPU, (int(cpu), int(cpu) + KILL_GRACE))
+    if memory:
+        resource.prlimit(pid, resource.RLIMIT_AS, (int(memory) * 1024 * 1024,) * 2)
+
+
+def kill_group(pid, sig):
+    '''signal process group of command, its whole subprocess tree'''
+    import signal
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+    logging.debug('sent %s to process group %d', signal.Signals(sig).name, pid)
+
+
+def run_cmd_catch_output(cmd, capture, cwd=None, limits=None, scan=None):
+    '''run command in cwd and catch output to capture, and scan(data) if given, return value, resource usage and whether it timed out'''
+    # pylint: disable=too-many-locals,too-many-branches
+    import signal
+    from time import monotonic
     from select import select
     from subprocess import Popen, PIPE
-    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-
-    log = []
-    while True:
-        reads = [proc.stdout.fileno(), proc.stderr.fileno()]
-        ret = select(reads, [], [])
-        for fdi in ret[0]:
-            if fdi == proc.stdout.fileno():
-                log.append(proc.stdout.readline())
-            elif fdi == proc.stderr.fileno():
-                log.append(proc.stderr.readline())
-        if proc.poll() is not None:
-            break
-
-    return {'code': proc.returncode, 'output': log}
-
-
-def run_cmd_list_catch_output(cmd_list, result, expand, throw_on_fail=True):
-    '''run commands in command list and catch output and return code'''
-    log = []
+    from buildhck.client.capture import CHUNK_SIZE
+    limits = limits or {}
+    start = monotonic()
+    deadlines = [limits.get('deadline')]
+    if limits.get('command_timeout'):
+        deadlines.append(start + limits['command_timeout'])
+    deadline = min((value for value in deadlines if value is not None), default=None)
+    # own session, so the whole tree can be killed as a process group
+    proc = Popen(cmd, stdout=PIPE, stderr=PIPE, cwd=cwd, start_new_session=True)
+    try:
+        rlimits(proc.pid, limits)
+    except ProcessLookupError:
+        pass # exited already
+    except (OSError, ValueError) as exc:
+        kill_group(proc.pid, signal.SIGKILL)
+        proc.communicate()
+        raise RecipeException('bad cpu_limit or memory_limit :: {}'.format(exc))
+
+    # read whatever is available until both pipes close, never waiting for a full line,
+    # but only whole lines go to capture so stdout and stderr interleave between lines
+    reads = [proc.stdout.fileno(), proc.stderr.fileno()]
+    pending = {fdi: bytearray() for fdi in reads}
+    ended = {fdi: True for fdi in reads} # whether output of pipe ended with a whole line
+
+    def emit(fdi, data):
+        capture.write(data)
+        if scan and data:
+            scan(data)
+            ended[fdi] = data.endswith(b'\n')
+
+    signals = [signal.SIGTERM, signal.SIGKILL]
+    timed_out = False
+    while reads:
+        ready = select(reads, [], [], None if deadline is None else max(0, deadline - monotonic()))[0]
+        if not ready:
+            if not signals:
+                break # output held open by a process that left the group
+            timed_out = True
+            kill_group(proc.pid, signals.pop(0))
+            deadline = monotonic() + KILL_GRACE
+        for fdi in ready:
+            chunk = os.read(fdi, CHUNK_SIZE)
+            if not chunk:
+                reads.remove(fdi)
+                continue
+            buf = pending[fdi]
+            buf += chunk
+            end = len(buf) if len(buf) >= CHUNK_SIZE else buf.rfind(b'\n') + 1 # huge lines go as they come
+            if end:
+                emit(fdi, bytes(buf[:end]))
+                del buf[:end]
+    for fdi, buf in pending.items():
+        emit(fdi, bytes(buf))
+        if scan and not ended[fdi]:
+            scan(b'\n') # end the last line, so it is counted
+    proc.stdout.close()
+    proc.stderr.close()
+
+    # usage of this command alone, even while commands of other stages run
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    usage = {'wall': round(monotonic() - start, 3),
+             'cpu': round(rusage.ru_utime + rusage.ru_stime, 3),
+             'maxrss': maxrss_kilobytes(rusage)}
+    return {'code': proc.returncode, 'resources': usage, 'timeout': timed_out}
+
+
+def add_resources(resources, usage):
+    '''accumulate resource usage of command to stage'''
+    resources['wall'] = round(resources['wall'] + usage['wall'], 3)
+    resources['cpu'] = round(resources['cpu'] + usage['cpu'], 3)
+    resources['maxrss'] = max(resources['maxrss'], usage['maxrss'])
+
+
+def run_cmd_list_catch_output(cmd_list, result, expand, throw_on_fail=True, cwd=None, limits=None, scan=None):
+    '''run commands in command list in cwd and catch output and return code, returns capture of the log'''
+    # pylint: disable=too-many-arguments
+    from buildhck.client.capture import Capture
+    log = Capture()
+    resources = result['resources'] = {'wall': 0.0, 'cpu': 0.0, 'maxrss': 0, 'commands': []}
     for cmd in cmd_list:
         expanded = expand_cmd(cmd, expand)
-        ret = run_cmd_catch_output(expanded)
         if log:
-            log.append(b'\n')
-        log.append('>> {}:\n'.format(expanded).encode('UTF-8'))
-        log.extend(ret['output'])
+            log.write(b'\n')
+        log.write('>> {}:\n'.format(expanded).encode('UTF-8'))
+        ret = run_cmd_catch_output(expanded, log, cwd, limits, scan)
+        resources['commands'].append(dict(ret['resources'], command=' '.join(expanded)))
+        add_resources(resources, ret['resources'])
+        if ret['timeout']:
+            log.write('\n>> timed out after {:.0f}s, killed\n'.format(ret['resources']['wall']).encode('UTF-8'))
+            result['status'] = TIMEOUT if throw_on_fail else -1 # warnings of analyze can't be counted
+            result['log'] = log
+            raise CookTimeout('command timed out: {}'.format(expanded))
         if throw_on_fail and ret['code'] != os.EX_OK:
             result['status'] = 0
-            result['log'] = b64encode(b''.join(log)).decode('UTF-8') if log else ''
+            result['log'] = log # base64 encoded from the spool when uploaded
             raise CookException('command failed: {}'.format(expanded))
     result['status'] = 1 if cmd_list else -1
-    result['log'] = b64encode(b''.join(log)).decode('UTF-8') if log else ''
+    result['log'] = log if log else ''
     return log
 
 
+def recipe_slots(recipe):
+    '''get number of cpus recipe builds with'''
+    return max(1, int(recipe.get('slots', 1)))
+
+
+def recipe_variables(recipe):
+    '''get variables expanded in commands besides directories, $jobs and the axes of the configuration'''
+    variables = {'$jobs': str(recipe_slots(recipe))}
+    for axis, value in recipe.get('configuration', {}).items():
+        variables['${}'.format(axis)] = str(value)
+    return variables
+
+
+def matrix_configurations(recipe):
+    '''get configurations the axes of 'matrix' expand into, a single empty one without matrix'''
+    from itertools import product
+    matrix = recipe.get('matrix') or {}
+    if not isinstance(matrix, dict) or not all(isinstance(values, list) and values for values in matrix.values()):
+        raise RecipeException('matrix should map axes to lists of values')
+    if matrix and recipe.get('build_in_srcdir'):
+        raise RecipeException('matrix configurations can not build in the shared srcdir')
+    return [dict(zip(matrix, values)) for values in product(*matrix.values())]
+
+
+def variant_name(configuration):
+    '''get name of configuration, appended to the system it uploads as'''
+    return '-'.join(re.sub(r'[:;*?"<>|()\\\s/]', '_', str(value)) for value in configuration.values())
+
+
+def matrix_jobs(recipe):
+    '''get number of configurations of recipe built at once, 'matrix_jobs' or as many as there are cpus for'''
+    configurations = len(matrix_configurations(recipe))
+    default = max(1, (config.config.get('jobs') or os.cpu_count() or 1) // recipe_slots(recipe))
+    return max(1, min(configurations, int(recipe.get('matrix_jobs', default))))
+
+
+def recipe_cpus(recipe):
+    '''get number of cpus recipe builds with, all its configurations built at once'''
+    try:
+        return recipe_slots(recipe) * matrix_jobs(recipe)
+    except RecipeException:
+        return recipe_slots(recipe) # reported when cooking
+
+
 def prepare(recipe, srcdir, result):
     '''prepare project'''
-    return run_cmd_list_catch_output(recipe['prepare'], result, {'$srcdir': srcdir})
+    return run_cmd_list_catch_output(recipe['prepare'], result, {'$srcdir': srcdir, **recipe_variables(recipe)}, cwd=srcdir, limits=command_limits(recipe))
 
 
 def build(recipe, srcdir, builddir, pkgdir, result):
     '''build project'''
-    return run_cmd_list_catch_output(recipe['build'], result, {'$srcdir': srcdir, '$builddir': builddir, '$pkgdir': pkgdir})
+    return run_cmd_list_catch_output(recipe['build'], result, {'$srcdir': srcdir, '$builddir': builddir, '$pkgdir': pkgdir, **recipe_variables(recipe)}, cwd=builddir, limits=command_limits(recipe))
 
 
 def test(recipe, srcdir, builddir, result):
     '''test project'''
-    return run_cmd_list_catch_output(recipe['test'], result, {'$srcdir': srcdir, '$builddir': builddir})
+    return run_cmd_list_catch_output(recipe['test'], result, {'$srcdir': srcdir, '$builddir': builddir, **recipe_variables(recipe)}, cwd=builddir, limits=command_limits(recipe))
 
 
 def package(recipe, srcdir, builddir, pkgdir, result):
     '''package project'''
-    return run_cmd_list_catch_output(recipe['package'], result, {'$srcdir': srcdir, '$builddir': builddir, '$pkgdir': pkgdir})
+    return run_cmd_list_catch_output(recipe['package'], result, {'$srcdir': srcdir, '$builddir': builddir, '$pkgdir': pkgdir, **recipe_variables(recipe)}, cwd=builddir, limits=command_limits(recipe))
+
+
+def analyze_patterns(recipe):
+    '''get named warning patterns of recipe, analyze_re is a single pattern named warnings'''
+    patterns = recipe.get('analyze_patterns') or {}
+    if not isinstance(patterns, dict):
+        raise RecipeException('analyze_patterns should map names to regexes')
+    if not patterns and 'analyze_re' in recipe:
+        patterns = {'warnings': recipe['analyze_re']}
+    return patterns
+
+
+def compile_patterns(patterns):
+    '''get regexes of named patterns, each with the name and file group of its alternatives
+
+    Patterns without groups of their own besides file are alternated in one
+    regex, their leading inline flags scoped to them. Patterns with other
+    groups, which backreferences may refer to by number, get a regex of
+    their own and (name, file group) instead of a dict.
+    '''
+    alternatives = []
+    groups = {}
+    regexes = []
+    for idx, (name, pattern) in enumerate(patterns.items()):
+        name, pattern = str(name), str(pattern)
+        try:
+            exp = re.compile(pattern.encode('UTF-8'), re.MULTILINE)
+        except re.error as exc:
+            raise RecipeException('bad analyze pattern {}: {}'.format(name, exc))
+        if exp.groups > ('file' in exp.groupindex):
+            regexes.append((exp, (name, 'file' if 'file' in exp.groupindex else None)))
+            continue
+        filegroup = 'file{}'.format(idx) if 'file' in exp.groupindex else None
+        if filegroup:
+            pattern = pattern.replace('(?P<file>', '(?P<{}>'.format(filegroup))
+        flags = INLINE_FLAGS.match(pattern)
+        if flags: # global flags can only start the whole regex
+            pattern = '(?{}:{})'.format(flags.group(1), pattern[flags.end():])
+        alternatives.append('(?P<pattern{}>{})'.format(idx, pattern))
+        groups['pattern{}'.format(idx)] = (name, filegroup)
+    if alternatives:
+        try:
+            regexes.insert(0, (re.compile('|'.join(alternatives).encode('UTF-8'), re.MULTILINE), groups))
+        except re.error as exc:
+            raise RecipeException('analyze patterns do not combine: {}'.format(exc))
+    return regexes
+
+
+class WarningScan:
+    '''count lines of output, or matches of named patterns, as the output is captured in whole lines'''
+
+    def __init__(self, patterns):
+        from collections import Counter
+        self.regexes = compile_patterns(patterns)
+        self.lines = 0
+        self.categories = Counter({str(name): 0 for name in patterns})
+        self.files = Counter()
+
+    def __call__(self, data):
+        self.lines += data.count(b'\n')
+        for exp, groups in self.regexes:
+            for match in exp.finditer(data):
+                name, filegroup = groups[match.lastgroup] if isinstance(groups, dict) else groups
+                self.categories[name] += 1
+                if filegroup and match.group(filegroup):
+                    self.files[match.group(filegroup)] += 1
+
+    def warnings(self, srcdir):
+        '''get counts of categories and of the files with most warnings, relative to srcdir'''
+        from collections import Counter
+        paths = Counter() # decoded once per file
+        for path, count in self.files.items():
+            path = path.decode('UTF-8', 'replace')
+            paths[os.path.relpath(path, srcdir) if path.startswith(srcdir + os.sep) else path] += count
+        return {'categories': dict(self.categories), 'files': dict(paths.most_common(ANALYZE_FILES))}
 
 
 def analyze(recipe, srcdir, builddir, result):
-    '''analyze project'''
-    output = run_cmd_list_catch_output(recipe['analyze'], result, {'$srcdir': srcdir, '$builddir': builddir}, False)
-
-    if 'analyze_re' in recipe:
-        import re
-        exp = re.compile(recipe['analyze_re'])
-        matches = 0
-        for line in output:
-            matches += len(exp.findall(line.decode('UTF-8')))
-        result['status'] = matches
-    else:
-        result['status'] = len(output)
-
+    '''analyze project, warnings are counted while the output streams, not only in the head and tail kept of it'''
+    patterns = analyze_patterns(recipe)
+    scan = WarningScan(patterns)
+    output = run_cmd_list_catch_output(recipe['analyze'], result, {'$srcdir': srcdir, '$builddir': builddir, **recipe_variables(recipe)}, False, cwd=builddir, limits=command_limits(recipe), scan=scan)
+    if not patterns:
+        result['status'] = scan.lines
+        return output
+
+    result['status'] = sum(scan.categories.values())
+    result['warnings'] = scan.warnings(srcdir)
     return output
 
 
-def download(recipe, srcdir, result):
-    '''download recipe'''
+def parse_source(recipe):
+    '''get protocol, url and branch of recipe source'''
     proto = ''
     fragment = ''
     branch = ''
@@ -145,48 +385,114 @@ def download(recipe, srcdir, result):
 
     if fragment:
         branch = fragment.partition("=")[2]
-        if branch:
-            result['branch'] = branch
 
     try:
         protocol = import_module('buildhck.client.protocols.{}'.format(proto))
     except ImportError:
         raise RecipeException('Unknown protocol: {}'.format(proto))
-    else:
-        if not branch:
-            result['branch'] = protocol.DEFAULT_BRANCH
-        protocol.clone(srcdir, url, branch, result)
+    return protocol, url, branch or protocol.DEFAULT_BRANCH
 
 
-def perform_recipe(recipe, srcdir, builddir, pkgdir, result):
-    '''perform recipe'''
-    s_mkdir(srcdir)
-    download(recipe, srcdir, result)
+def download(recipe, srcdir, result):
+    '''download recipe'''
+    from buildhck.client.mirrors import mirror_path
+    protocol, url, branch = parse_source(recipe)
+    result['branch'] = branch
+    protocol.clone(srcdir, url, branch, result, mirror=mirror_path(protocol.__name__.rpartition('.')[2], recipe, url))
 
-    if 'prepare' in recipe:
-        os.chdir(srcdir)
-        prepare(recipe, srcdir, result['build'])
 
-    s_mkdir(builddir)
-    os.chdir(builddir)
-    build(recipe, srcdir, builddir, pkgdir, result['build'])
+def built_commit(srcdir):
+    '''get commit of the last build sent to server, or None'''
+    try:
+        with open(os.path.join(srcdir, '.buildhck_built')) as fle:
+            return fle.read().strip() or None
+    except OSError:
+        return None
 
-    if 'test' in recipe:
-        test(recipe, srcdir, builddir, result['test'])
-    else:
-        result['test']['status'] = -1
 
+def remote_unchanged(recipe):
+    '''check if remote head is the last built commit, without fetching'''
+    if config.config.get('force'):
+        return False
+    commit = built_commit(os.path.join(config.build_directory(recipe['name']), 'src'))
+    if not commit:
+        return False
+    try:
+        protocol, url, branch = parse_source(recipe)
+    except RecipeException:
+        return False # reported when cooking
+    return protocol.remote_unchanged(url, branch, commit)
+
+
+def stage_dependencies(recipe):
+    '''get stages of recipe and the stages each one waits for, the previous stage unless 'depends' of the recipe says otherwise'''
+    stages = [stage for stage in STAGES if stage == 'build' or stage in recipe]
+    depends = recipe.get('depends') or {}
+    for stage in depends:
+        if stage not in STAGES:
+            raise RecipeException('depends has unknown stage {}'.format(stage))
+
+    graph = {}
+    for idx, stage in enumerate(stages):
+        deps = depends.get(stage, stages[idx - 1:idx])
+        deps = [deps] if isinstance(deps, str) else deps or []
+        for dep in deps:
+            if dep not in STAGES:
+                raise RecipeException('{} depends on unknown stage {}'.format(stage, dep))
+        graph[stage] = [dep for dep in deps if dep in stages] # stages the recipe lacks are done already
+
+    ready = set()
+    while len(ready) < len(graph):
+        more = {stage for stage, deps in graph.items() if stage not in ready and ready.issuperset(deps)}
+        if not more:
+            raise RecipeException('depends has a cycle between {}'.format(', '.join(sorted(set(graph) - ready))))
+        ready |= more
+    return graph
+
+
+def run_stages(graph, runners):
+    '''run stages once the stages they depend on succeeded, independent stages at once'''
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    pending = dict(graph)
+    running = {}
+    done = set()
+    failed = set() # and stages skipped because of them
+    failures = []
+    with ThreadPoolExecutor(len(graph)) as pool:
+        while pending or running:
+            for stage, deps in list(pending.items()):
+                if failed.intersection(deps):
+                    failed.add(stage)
+                    del pending[stage]
+                elif done.issuperset(deps):
+                    running[pool.submit(runners[stage])] = stage
+                    del pending[stage]
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    future.result()
+                    done.add(stage)
+                except CookException as exc:
+                    failed.add(stage)
+                    failures.append(exc)
+    if failures:
+        raise failures[0]
+
+
+def perform_recipe(recipe, srcdir, builddir, pkgdir, result):
+    '''perform stages of recipe in source downloaded already'''
+    graph = stage_dependencies(recipe)
+    s_mkdir(builddir)
     if 'package' in recipe:
         s_mkdir(pkgdir)
-        os.chdir(builddir)
-        package(recipe, srcdir, builddir, pkgdir, result['package'])
-    else:
-        result['package']['status'] = -1
 
-    if 'analyze' in recipe:
-        analyze(recipe, srcdir, builddir, result['analyze'])
-    else:
-        result['analyze']['status'] = -1
+    run_stages(graph, {'build': lambda: build(recipe, srcdir, builddir, pkgdir, result['build']),
+                       'test': lambda: test(recipe, srcdir, builddir, result['test']),
+                       'package': lambda: package(recipe, srcdir, builddir, pkgdir, result['package']),
+                       'analyze': lambda: analyze(recipe, srcdir, builddir, result['analyze'])})
 
 
 def cleanup_build(builddir, srcdir, pkgdir):
@@ -198,31 +504,69 @@ def cleanup_build(builddir, srcdir, pkgdir):
         shutil.rmtree(pkgdir)
 
 
-def upload_build(recipe, result, srcdir):
-    '''upload build'''
+def auth_key(recipe):
+    '''get key recipe is uploaded with'''
+    for name in [recipe['name'], '']:
+        if name in config.config['auth']:
+            return config.config['auth'][name]
+    return None
+
+
+def mark_built(srcdir, result):
+    '''record commit as sent to server, so it is not built again'''
+    if os.path.exists(srcdir):
+        with open(os.path.join(srcdir, '.buildhck_built'), 'w') as fle:
+            fle.write(result.get('commit', ''))
+
+
+def unmark_built(srcdir, commit):
+    '''forget commit was sent to server, if it is still the one recorded'''
+    if srcdir and commit and built_commit(srcdir) == commit:
+        os.remove(os.path.join(srcdir, '.buildhck_built'))
+
+
+def upload_build(recipe, result, srcdir, variant=''):
+    '''upload build, as variant of the system if given, spools it to be sent on a later run if that fails
+
+    The commit is marked built by the caller once every configuration was sent or spooled.
+    '''
     try:
         service = import_module('buildhck.client.services.{}'.format('buildhck'))
     except ImportError:
         raise Exception('TODO')
 
-    for name in [recipe['name'], '']:
-        if name in config.config['auth']:
-            key = config.config['auth'][name]
-            break
-    else:
-        key = None
+    system = '{} {}'.format(service.default_system(), variant) if variant else None
+    if service.upload(recipe, result, config.config['serverurl'], auth_key(recipe), encoding=config.config.get('upload_encoding'), system=system):
+        logging.info('%s build successfully sent to server.', recipe['name'])
+        return True
 
-    if service.upload(recipe, result, config.config['serverurl'], key):
-        if os.path.exists(srcdir):
-            touch(os.path.join(srcdir, '.buildhck_built'))
-        logging.info('Build successfully sent to server.')
     # the error already got displayed
+    from buildhck.client import spool
+    spool.save(recipe, result, config.config['serverurl'], system, srcdir)
+    logging.warning('%s build spooled, it is sent again on a later run or with --flush.', recipe['name'])
+    return False
 
 
-def cook_recipe(recipe):
-    '''prepare && cook recipe'''
+def upload_spooled(entry):
+    '''upload spooled build'''
+    from buildhck.client.services.buildhck import upload
+    return upload(entry['recipe'], entry['result'], entry['server'], auth_key(entry['recipe']), encoding=config.config.get('upload_encoding'), system=entry.get('system'))
+
+
+def drop_spooled(entry):
+    '''build commit of dropped spooled build again on the next run'''
+    unmark_built(entry.get('srcdir'), entry['result'].get('commit'))
+
+
+def cook_recipe(recipe, checked=False):
+    '''prepare && cook recipe, returns summaries of the outcome of its configurations'''
     # pylint: disable=too-many-branches
+    from time import monotonic
+    start = monotonic()
 
+    if not checked and remote_unchanged(recipe):
+        logging.info('%s is up to date', recipe['name'])
+        return [{'name': recipe['name'], 'outcome': 'up to date', 'wall': round(monotonic() - start, 1), 'stages': {}}]
     logging.info('Building %s from %s', recipe['name'], recipe['source'])
     logging.debug(recipe['build'])
     if 'test' in recipe:
@@ -230,17 +574,9 @@ def cook_recipe(recipe):
     if 'package' in recipe:
         logging.debug(recipe['package'])
 
-    os.chdir(STARTDIR)
     projectdir = config.build_directory(recipe['name'])
-
-    pkgdir = os.path.join(projectdir, 'pkg')
     srcdir = os.path.join(projectdir, 'src')
 
-    if 'build_in_srcdir' in recipe and recipe['build_in_srcdir']:
-        builddir = srcdir
-    else:
-        builddir = os.path.join(projectdir, 'build')
-
     import socket
     result = {'client': socket.gethostname(),
               'build': {'status': -1},
@@ -260,28 +596,184 @@ def cook_recipe(recipe):
         result['github'] = recipe['github']
 
     s_mkdir(projectdir)
-    send_build = True
+    outcome = None
     try:
-        perform_recipe(recipe, srcdir, builddir, pkgdir, result)
-    except CookException as exc:
-        logging.error('%s build failed :: %s', recipe['name'], str(exc))
+        configurations = matrix_configurations(recipe)
+        stage_dependencies(recipe)
+        compile_patterns(analyze_patterns(recipe))
+        s_mkdir(srcdir)
+        download(recipe, srcdir, result)
     except RecipeException as exc:
         logging.error('%s recipe error :: %s', recipe['name'], str(exc))
-        send_build = False
+        outcome = 'recipe error'
     except DownloadException as exc:
         logging.error('%s download failed :: %s', recipe['name'], str(exc))
-        send_build = False
+        outcome = 'download failed'
     except NothingToDoException:
+        outcome = 'up to date'
+    if outcome:
+        return [{'name': recipe['name'], 'outcome': outcome, 'wall': round(monotonic() - start, 1),
+                 'stages': {stage: result[stage]['status'] for stage in STAGES}}]
+
+    summaries = prepare_source(recipe, configurations, srcdir, result, start)
+    if summaries is None:
+        # configurations share the prepared source and build in directories of their own
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(matrix_jobs(recipe)) as pool:
+            summaries = list(pool.map(lambda configuration: cook_configuration(recipe, configuration, srcdir, result), configurations))
+
+    # sent or spooled, building the commit again would not help unless the recipe is fixed
+    if all(summary['outcome'] != 'recipe error' for summary in summaries):
+        mark_built(srcdir, result)
+    return summaries
+
+
+def recipe_deadline(recipe, start):
+    '''get recipe with the deadline its 'timeout' sets from start'''
+    timeout = recipe.get('timeout', config.config.get('recipe_timeout'))
+    return dict(recipe, deadline=start + timeout) if timeout else recipe
+
+
+def prepare_source(recipe, configurations, srcdir, result, start):
+    '''run prepare of recipe once in the source, returns summaries of the configurations if it failed'''
+    from time import monotonic
+    if 'prepare' not in recipe:
+        return None
+    prepared = {'status': -1}
+    try:
+        prepare(recipe_deadline(recipe, start), srcdir, prepared)
+        return None
+    except CookTimeout as exc:
+        logging.error('%s prepare timed out :: %s', recipe['name'], str(exc))
+        outcome = 'timed out'
+    except CookException as exc:
+        logging.error('%s prepare failed :: %s', recipe['name'], str(exc))
+        outcome = 'build failed'
+    except RecipeException as exc:
+        logging.error('%s recipe error :: %s', recipe['name'], str(exc))
+        return [{'name': recipe['name'], 'outcome': 'recipe error', 'wall': round(monotonic() - start, 1),
+                 'stages': {stage: result[stage]['status'] for stage in STAGES}}]
+
+    # every configuration is sent with the log of the failed prepare as its build
+    summaries = []
+    for configuration in configurations:
+        variant = variant_name(configuration)
+        failed = {key: dict(value) if isinstance(value, dict) else value for key, value in result.items()}
+        failed['build'] = dict(prepared)
+        spooled = not upload_build(dict(recipe, configuration=configuration), failed, srcdir, variant)
+        summaries.append({'name': '{} {}'.format(recipe['name'], variant) if variant else recipe['name'],
+                          'outcome': outcome + (', upload spooled' if spooled else ''), 'wall': round(monotonic() - start, 1),
+                          'stages': {stage: failed[stage]['status'] for stage in STAGES}})
+    return summaries
+
+
+def cook_configuration(recipe, configuration, srcdir, result):
+    '''cook configuration of recipe in downloaded source, returns summary of the outcome'''
+    import copy
+    from time import monotonic
+    start = monotonic()
+    projectdir = os.path.dirname(srcdir)
+    variant = variant_name(configuration)
+    name = '{} {}'.format(recipe['name'], variant) if variant else recipe['name']
+    recipe = recipe_deadline(dict(recipe, configuration=configuration), start) # every stage is killed past it
+    result = copy.deepcopy(result)
+    suffix = '-{}'.format(variant) if variant else ''
+
+    pkgdir = os.path.join(projectdir, 'pkg' + suffix)
+    if 'build_in_srcdir' in recipe and recipe['build_in_srcdir']:
+        builddir = srcdir
+    else:
+        builddir = os.path.join(projectdir, 'build' + suffix)
+
+    send_build = True
+    outcome = 'built'
+    try:
+        perform_recipe(recipe, srcdir, builddir, pkgdir, result)
+    except CookTimeout as exc:
+        logging.error('%s timed out :: %s', name, str(exc))
+        outcome = 'timed out'
+    except CookException as exc:
+        logging.error('%s build failed :: %s', name, str(exc))
+        outcome = 'build failed'
+    except RecipeException as exc:
+        logging.error('%s recipe error :: %s', name, str(exc))
         send_build = False
+        outcome = 'recipe error'
 
-    if send_build:
-        upload_build(recipe, result, srcdir)
+    if send_build and not upload_build(recipe, result, srcdir, variant):
+        outcome += ', upload spooled'
 
     # cleanup build and pkg directory
     if config.config.get('cleanup'):
-        cleanup_build(srcdir, builddir, pkgdir)
-
-    os.chdir(STARTDIR)
+        cleanup_build(builddir, srcdir, pkgdir)
+
+    return {'name': name, 'outcome': outcome, 'wall': round(monotonic() - start, 1),
+            'stages': {stage: result[stage]['status'] for stage in STAGES}}
+
+
+def init_worker(overrides, level):
+    '''set up logging and config of recipe cooking process'''
+    logging.basicConfig(level=level, format=LOGFORMAT)
+    config.load(overrides)
+
+
+def cook_recipes(recipes, slots, overrides):
+    '''cook recipes concurrently, never running more than slots cpus worth of them at once'''
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+    with ThreadPoolExecutor(CHECKS) as checks:
+        unchanged = list(checks.map(remote_unchanged, recipes))
+    summaries = [{'name': recipe['name'], 'outcome': 'up to date', 'wall': 0.0, 'stages': {}}
+                 for recipe, skip in zip(recipes, unchanged) if skip]
+    pending = [recipe for recipe, skip in zip(recipes, unchanged) if not skip]
+    running = {}
+    free = slots
+    with ProcessPoolExecutor(max_workers=slots, initializer=init_worker, initargs=(overrides, logging.root.level)) as pool:
+        while pending or running:
+            for recipe in list(pending):
+                need = min(recipe_cpus(recipe), slots)
+                if need <= free:
+                    pending.remove(recipe)
+                    free -= need
+                    running[pool.submit(cook_recipe, recipe, True)] = (recipe, need)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                recipe, need = running.pop(future)
+                free += need
+                try:
+                    summaries.extend(future.result())
+                except Exception as exc: # pylint: disable=broad-except
+                    logging.error('%s crashed :: %s', recipe['name'], str(exc))
+                    summaries.append({'name': recipe['name'], 'outcome': 'crashed', 'wall': 0.0, 'stages': {}})
+    return summaries
+
+
+def load_recipes(directory):
+    '''load every recipe in directory, skipping broken ones and duplicate names'''
+    recipes = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(('.yaml', '.yml')):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as fle:
+                recipe = yaml.safe_load(fle)
+            if not isinstance(recipe, dict) or 'name' not in recipe:
+                raise RecipeException('recipe has no name')
+        except (yaml.YAMLError, RecipeException) as exc:
+            logging.error('%s recipe error :: %s', filename, str(exc))
+            continue
+        if recipe['name'] in [other['name'] for other in recipes]:
+            logging.error('%s recipe error :: %s is already cooked by another recipe', filename, recipe['name'])
+            continue
+        recipes.append(recipe)
+    return recipes
+
+
+def print_summary(summaries):
+    '''print table of cooked recipes'''
+    print('{:<24} {:<24} {:>8} {:>8} {:>8} {:>8} {:>8}'.format('recipe', 'outcome', *STAGES, 'wall s'))
+    for summary in sorted(summaries, key=lambda k: k['name']):
+        stages = [str(summary['stages'].get(stage, '')) for stage in STAGES]
+        print('{:<24} {:<24} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(summary['name'], summary['outcome'], *stages, summary['wall']))
 
 
 def main():
@@ -294,6 +786,14 @@ def main():
                         help='directory for builds')
     parser.add_argument('-r', '--recipe', dest='recipe',
                         help='build single recipe in recipes directory')
+    parser.add_argument('-d', '--recipes', dest='recipes',
+                        help='build every recipe in directory concurrently')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+                        help='cpus shared by concurrently built recipes (default: all)')
+    parser.add_argument('-m', '--refresh-mirrors', action='store_true', dest='refresh_mirrors',
+                        help='fetch every mirror and exit, for running in the background')
+    parser.add_argument('--flush', action='store_true', dest='flush',
+                        help='send every spooled build now and exit')
     parser.add_argument('-c', '--cleanup', action='store_true', dest='cleanup',
                         help='cleanup build and package directories after build')
     parser.add_argument('-f', '--force', action='store_true', dest='force',
@@ -304,19 +804,28 @@ def main():
                         help='print debug information')
     args = parser.parse_args()
 
-    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
-                        format='[%(name)s] [%(levelname)s]: %(message)s')
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format=LOGFORMAT)
+
+    overrides = {k:v for k,v in vars(args).items() if v}
+    config.load(overrides)
+    if args.refresh_mirrors:
+        from buildhck.client.mirrors import refresh
+        raise SystemExit(1 if refresh() else 0)
+
+    from buildhck.client import spool
+    if args.flush:
+        raise SystemExit(1 if spool.flush(upload_spooled, force=True, dropped=drop_spooled) else 0)
+    spool.flush(upload_spooled, dropped=drop_spooled)
 
-    # FIXME: hack
-    global STARTDIR
-    STARTDIR = os.path.dirname(os.path.abspath(__file__))
+    if config.config.get('recipes'):
+        slots = config.config.get('jobs') or os.cpu_count() or 1
+        print_summary(cook_recipes(load_recipes(config.config['recipes']), slots, overrides))
+        return
 
-    config.config.update({k:v for k,v in vars(args).items() if v})
     recipe_file = config.config.get('recipe', 'recipe.yaml')
     with open(recipe_file) as recipe_file:
-        recipe = yaml.load(recipe_file)
+        recipe = yaml.safe_load(recipe_file)
 
-    os.chdir(STARTDIR)
     cook_recipe(recipe)
 
 #  vim: set ts=8 sw=4 tw=0 :
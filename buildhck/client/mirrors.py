@@ -0,0 +1,73 @@
+# pylint: disable=line-too-long
+'''shared mirror store, recipes building the same upstream share its history
+
+Sources are fetched into a mirror under 'mirrors_directory' and checked out
+from there, as git worktrees or hg shares, so every commit is downloaded
+and stored once however many recipes build it. A mirror is keyed by the
+'mirror' of the recipe, or its source url, so recipes building forks of
+the same upstream share one mirror by naming it. Every url is a remote
+of its mirror.
+'''
+
+import os
+import logging
+from hashlib import sha1
+from contextlib import contextmanager
+from importlib import import_module
+from subprocess import CalledProcessError
+from buildhck.client.protocols import DownloadException
+from buildhck import config
+
+# mirrors refreshed at once
+REFRESH_JOBS = 4
+
+def mirrors_directory(*args):
+    '''get directory of mirrors'''
+    return config.data_directory(config.config.get('mirrors_directory', 'mirrors'), *args)
+
+
+def key(name):
+    '''get file name safe key of name'''
+    return sha1(name.encode('UTF-8')).hexdigest()[:16]
+
+
+def mirror_path(proto, recipe, url):
+    '''get mirror of recipe source, or None if mirrors are disabled'''
+    if config.config.get('mirrors') is False:
+        return None
+    return mirrors_directory(proto, key(recipe.get('mirror') or url))
+
+
+@contextmanager
+def locked(mirror):
+    '''hold lock of mirror, shared by every client process'''
+    import fcntl
+    os.makedirs(os.path.dirname(mirror), exist_ok=True)
+    with open(mirror + '.lock', 'w') as fle:
+        fcntl.flock(fle, fcntl.LOCK_EX)
+        yield
+
+
+def refresh_mirror(proto, mirror):
+    '''fetch every remote of mirror, returns whether it succeeded'''
+    protocol = import_module('buildhck.client.protocols.{}'.format(proto))
+    try:
+        with locked(mirror):
+            protocol.refresh_mirror(mirror)
+    except (CalledProcessError, DownloadException) as exc:
+        logging.error('%s mirror refresh failed :: %s', mirror, str(exc))
+        return False
+    logging.info('%s mirror refreshed', mirror)
+    return True
+
+
+def refresh():
+    '''refresh every mirror, returns number of failures'''
+    from concurrent.futures import ThreadPoolExecutor
+    mirrors = []
+    for proto in sorted(os.listdir(mirrors_directory())) if os.path.isdir(mirrors_directory()) else []:
+        for name in sorted(os.listdir(mirrors_directory(proto))):
+            if not name.endswith('.lock'):
+                mirrors.append((proto, mirrors_directory(proto, name)))
+    with ThreadPoolExecutor(REFRESH_JOBS) as pool:
+        return list(pool.map(lambda args: refresh_mirror(*args), mirrors)).count(False)
@@ -2,41 +2,102 @@
 '''git module'''
 
 import os
-from subprocess import check_call, check_output
+from subprocess import check_call, check_output, CalledProcessError, TimeoutExpired, DEVNULL
 from . import DownloadException, NothingToDoException
 
-def _git(*args):
+def _git(*args, cwd=None):
     '''git wrapper'''
-    return check_call(['git'] + list(args)) == os.EX_OK
+    return check_call(['git'] + list(args), cwd=cwd) == os.EX_OK
 
 
-def _git2(*args):
+def _git2(*args, cwd=None):
     '''git wrapper2'''
-    return check_output(['git'] + list(args))
+    return check_output(['git'] + list(args), cwd=cwd)
 
 
-def clone(srcdir, url, branch, result):
-    '''clone source using git'''
+def remote_unchanged(url, branch, commit):
+    '''check if head of remote branch is commit, in one round-trip'''
+    try:
+        out = check_output(['git', 'ls-remote', '--heads', url, branch], timeout=REMOTE_TIMEOUT, stderr=DEVNULL)
+    except (CalledProcessError, TimeoutExpired, OSError):
+        return False
+    heads = dict(reversed(line.split('\t', 1)) for line in out.decode('UTF-8').splitlines())
+    return heads.get('refs/heads/{}'.format(branch)) == commit
+
+
+def fetch_options():
+    '''get fetch options of mirrors, 'mirror_depth' makes them shallow'''
+    from buildhck import config
+    depth = config.config.get('mirror_depth')
+    return ['--depth', str(depth)] if depth else []
+
+
+def update_mirror(mirror, url):
+    '''fetch heads of url into mirror, returns name of its remote'''
+    from buildhck import config
+    from buildhck.client.mirrors import key
+    remote = key(url)
+    if not os.path.isdir(mirror) and not _git('init', '--bare', '-q', mirror):
+        raise DownloadException('git init failed')
+    if remote not in _git2('remote', cwd=mirror).decode('UTF-8').split():
+        if not _git('remote', 'add', remote, url, cwd=mirror):
+            raise DownloadException('git remote add failed')
+        if config.config.get('mirror_filter'): # partial clone, blobs are fetched when checked out
+            _git('config', 'remote.{}.promisor'.format(remote), 'true', cwd=mirror)
+            _git('config', 'remote.{}.partialclonefilter'.format(remote), config.config['mirror_filter'], cwd=mirror)
+    if not _git('fetch', '-q', '--prune', *fetch_options(), remote, cwd=mirror):
+        raise DownloadException('git fetch failed')
+    return remote
+
+
+def refresh_mirror(mirror):
+    '''fetch every remote of mirror'''
+    if not _git('fetch', '-q', '--prune', '--all', *fetch_options(), cwd=mirror):
+        raise DownloadException('git fetch failed')
+    _git('worktree', 'prune', cwd=mirror)
+
+
+def checkout(srcdir, mirror, url, branch):
+    '''check out branch of url into worktree of mirror, returns the previous commit'''
+    from buildhck.client.mirrors import locked
+    oldcommit = ''
+    with locked(mirror):
+        ref = 'refs/remotes/{}/{}'.format(update_mirror(mirror, url), branch)
+        if os.path.isfile(os.path.join(srcdir, '.git')):
+            oldcommit = _git2('rev-parse', 'HEAD', cwd=srcdir).strip().decode('UTF-8')
+            if not _git('checkout', '-q', '-f', '--detach', ref, cwd=srcdir):
+                raise DownloadException('git checkout failed')
+        else:
+            _git('worktree', 'prune', cwd=mirror)
+            if not _git('worktree', 'add', '-q', '-f', '--detach', srcdir, ref, cwd=mirror):
+                raise DownloadException('git worktree add failed')
+    return oldcommit
+
+
+def clone(srcdir, url, branch, result, mirror=None):
+    '''clone source using git, through worktree of mirror unless srcdir is a standalone clone'''
     if not branch:
         branch = DEFAULT_BRANCH
 
     oldcommit = ''
-    if os.path.isdir(os.path.join(srcdir, '.git')):
-        os.chdir(srcdir)
-        oldcommit = _git2('rev-parse', 'HEAD').strip().decode('UTF-8')
-        if not _git('--work-tree', srcdir, 'fetch', '-f', '-u', 'origin', '{}:{}'.format(branch, branch)):
+    if mirror and not os.path.isdir(os.path.join(srcdir, '.git')):
+        oldcommit = checkout(srcdir, mirror, url, branch)
+    elif os.path.isdir(os.path.join(srcdir, '.git')):
+        oldcommit = _git2('rev-parse', 'HEAD', cwd=srcdir).strip().decode('UTF-8')
+        if not _git('--work-tree', srcdir, 'fetch', '-f', '-u', 'origin', '{}:{}'.format(branch, branch), cwd=srcdir):
             raise DownloadException('git fetch failed')
-        if not _git('--work-tree', srcdir, 'checkout', '-f', branch):
+        if not _git('--work-tree', srcdir, 'checkout', '-f', branch, cwd=srcdir):
             raise DownloadException('git checkout failed')
     elif not _git('clone', '--depth', '1', '-b', branch, url, srcdir):
         raise DownloadException('git clone failed')
 
-    os.chdir(srcdir)
-    result['commit'] = _git2('--work-tree', srcdir, 'rev-parse', 'HEAD').strip().decode('UTF-8')
-    result['description'] = _git2('--work-tree', srcdir, 'log', '-1', '--pretty=%B').strip().decode('UTF-8')
+    result['commit'] = _git2('--work-tree', srcdir, 'rev-parse', 'HEAD', cwd=srcdir).strip().decode('UTF-8')
+    result['description'] = _git2('--work-tree', srcdir, 'log', '-1', '--pretty=%B', cwd=srcdir).strip().decode('UTF-8')
 
     if os.path.exists(os.path.join(srcdir, '.buildhck_built')) and result['commit'] == oldcommit:
         raise NothingToDoException('There is nothing to build')
 
 
+REMOTE_TIMEOUT = 60
+
 DEFAULT_BRANCH = 'master'
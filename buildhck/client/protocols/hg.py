@@ -2,41 +2,104 @@
 '''hg module'''
 
 import os
-from subprocess import check_call, check_output
+from subprocess import check_call, check_output, CalledProcessError, TimeoutExpired, DEVNULL
 from . import DownloadException, NothingToDoException
 
-def _hg(*args):
+def _hg(*args, cwd=None):
     '''hg wrapper'''
-    return check_call(['hg'] + list(args)) == os.EX_OK
+    return check_call(['hg'] + list(args), cwd=cwd) == os.EX_OK
 
 
-def _hg2(*args):
+def _hg2(*args, cwd=None):
     '''hg wrapper2'''
-    return check_output(['hg'] + list(args))
+    return check_output(['hg'] + list(args), cwd=cwd)
 
 
-def clone(srcdir, url, branch, result):
-    '''clone source using hg'''
+def remote_head(url, branch):
+    '''get full node of head of branch at url'''
+    return check_output(['hg', 'identify', '--id', '--debug', '-r', branch, url], timeout=REMOTE_TIMEOUT, stderr=DEVNULL).decode('UTF-8').strip()
+
+
+def remote_unchanged(url, branch, commit):
+    '''check if head of remote branch is commit, in one round-trip'''
+    try:
+        head = remote_head(url, branch)
+    except (CalledProcessError, TimeoutExpired, OSError):
+        return False
+    # commit is rev:node of COMMIT_TEMPLATE
+    node = commit.rpartition(':')[2]
+    return bool(node) and head.startswith(node)
+
+
+def head_of(url, branch):
+    '''get node to update to, branch names may have heads of other forks in a shared store'''
+    try:
+        return remote_head(url, branch)
+    except (CalledProcessError, TimeoutExpired, OSError):
+        raise DownloadException('hg identify failed')
+
+
+def update_mirror(mirror, url):
+    '''pull url into mirror, every url pulled is kept in its paths'''
+    from buildhck.client.mirrors import key
+    if not os.path.isdir(os.path.join(mirror, '.hg')):
+        if not _hg('clone', '-q', '-U', url, mirror):
+            raise DownloadException('hg clone failed')
+        return
+    paths = _hg2('paths', cwd=mirror).decode('UTF-8').splitlines()
+    if url not in [path.partition(' = ')[2] for path in paths]:
+        with open(os.path.join(mirror, '.hg', 'hgrc'), 'a') as fle:
+            fle.write('\n[paths]\n{} = {}\n'.format(key(url), url))
+    if not _hg('pull', '-q', url, cwd=mirror):
+        raise DownloadException('hg pull failed')
+
+
+def refresh_mirror(mirror):
+    '''pull every path of mirror'''
+    for path in _hg2('paths', cwd=mirror).decode('UTF-8').splitlines():
+        if not _hg('pull', '-q', path.partition(' = ')[2], cwd=mirror):
+            raise DownloadException('hg pull failed')
+
+
+def clone(srcdir, url, branch, result, mirror=None):
+    '''clone source using hg, as share of mirror unless srcdir is a standalone clone'''
+    from buildhck.client.mirrors import locked
     if not branch:
         branch = DEFAULT_BRANCH
 
+    hgdir = os.path.join(srcdir, '.hg')
     oldcommit = ''
-    if os.path.isdir(os.path.join(srcdir, '.hg')):
-        os.chdir(srcdir)
-        oldcommit = _hg2('tip', '--quiet').strip().decode('UTF-8')
-        if not _hg('pull'):
+    if mirror and (not os.path.isdir(hgdir) or os.path.exists(os.path.join(hgdir, 'sharedpath'))):
+        with locked(mirror):
+            node = head_of(url, branch) # before pulling, so the pull has it
+            update_mirror(mirror, url)
+            if os.path.isdir(hgdir):
+                oldcommit = _hg2('log', '-r', '.', '--template', COMMIT_TEMPLATE, cwd=srcdir).strip().decode('UTF-8')
+            elif not _hg('--config', 'extensions.share=', 'share', '-q', '-U', mirror, srcdir):
+                raise DownloadException('hg share failed')
+            if not _hg('update', '-q', '-C', '-r', node, cwd=srcdir):
+                raise DownloadException('hg update failed')
+    elif os.path.isdir(hgdir):
+        oldcommit = _hg2('log', '-r', '.', '--template', COMMIT_TEMPLATE, cwd=srcdir).strip().decode('UTF-8')
+        node = head_of(url, branch)
+        if not _hg('pull', url, cwd=srcdir):
             raise DownloadException('hg pull failed')
-        if not _hg('update', '-C', branch):
+        if not _hg('update', '-C', '-r', node, cwd=srcdir):
             raise DownloadException('hg update failed')
     elif not _hg('clone', '-b', branch, url, srcdir):
         raise DownloadException('hg clone failed')
 
-    os.chdir(srcdir)
-    result['commit'] = _hg2('tip', '--quiet').strip().decode('UTF-8')
-    result['description'] = _hg2('log', '-l1', '--template', '{desc}').decode('UTF-8')
+    # working directory parent, tip of a shared store may be on any branch or fork
+    result['commit'] = _hg2('log', '-r', '.', '--template', COMMIT_TEMPLATE, cwd=srcdir).strip().decode('UTF-8')
+    result['description'] = _hg2('log', '-r', '.', '--template', '{desc}', cwd=srcdir).decode('UTF-8')
 
     if os.path.exists(os.path.join(srcdir, '.buildhck_built')) and result['commit'] == oldcommit:
         raise NothingToDoException('There is nothing to build')
 
 
+REMOTE_TIMEOUT = 60
+
+# same as hg tip --quiet
+COMMIT_TEMPLATE = '{rev}:{node|short}'
+
 DEFAULT_BRANCH = 'default'
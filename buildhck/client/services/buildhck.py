@@ -1,30 +1,244 @@
 '''buildhck module'''
 
+import os
 import json
 import logging
 import sys
+import time
 import platform
 from urllib.parse import quote
 from urllib.request import Request, urlopen
 from urllib.error import URLError, HTTPError
 
 
-def upload(recipe, result, server, key=None):
-    '''upload build'''
-    branch = result.pop('branch', 'unknown')
+RETRIES = 5
 
+# logs larger than this are uploaded in resumable chunks of this size
+CHUNK_SIZE = 8 * 1024 * 1024
+
+def retry_delay(exc, attempt):
+    '''get seconds to wait before retrying rejected upload, jittered so clients spread out'''
+    import random
+    try:
+        delay = max(int(exc.headers.get('Retry-After', 0)), 2 ** attempt)
+    except ValueError:
+        delay = 2 ** attempt
+    return delay + random.uniform(0, delay)
+
+def write_json(fle, obj):
+    '''write obj as json, logs captured to spools are encoded as base64 from their spool'''
+    if isinstance(obj, dict):
+        fle.write(b'{')
+        for idx, (key, value) in enumerate(obj.items()):
+            if idx:
+                fle.write(b', ')
+            fle.write(json.dumps(key).encode('UTF-8') + b': ')
+            write_json(fle, value)
+        fle.write(b'}')
+    elif hasattr(obj, 'b64chunks'):
+        fle.write(b'"')
+        for chunk in obj.b64chunks():
+            fle.write(chunk)
+        fle.write(b'"')
+    else:
+        fle.write(json.dumps(obj).encode('UTF-8'))
+
+def default_system():
+    '''get system builds are uploaded as'''
+    return '{} {}'.format(sys.platform, platform.machine())
+
+def new_request(recipe, result, server, key=None, system=None):
+    '''get request uploading build'''
+    # pylint: disable=too-many-arguments
     # FIXME: use urljoin
     request = Request('{}/build/{}/{}/{}'.format(
-        server, quote(recipe['name']), quote(branch),
-        quote('{} {}'.format(sys.platform, platform.machine()))))
+        server, quote(recipe['name']), quote(result.get('branch', 'unknown')),
+        quote(system or default_system())))
+    if key is not None:
+        request.add_header('Authorization', key)
+    return request
+
+def without_uploads(value):
+    '''get stage without tokens of resumable uploads, its logs are sent inline instead'''
+    if isinstance(value, dict) and 'uploads' in value:
+        return {k: v for k, v in value.items() if k != 'uploads'}
+    return value
 
+def upload_request(recipe, result, server, key=None, system=None):
+    '''get upload request and its body'''
+    # pylint: disable=too-many-arguments
+    request = new_request(recipe, result, server, key, system)
     request.add_header('Content-Type', 'application/json')
+
+    # body is written to a temporary file, so logs never have to be in memory at once
+    from tempfile import TemporaryFile
+    body = TemporaryFile()
+    write_json(body, {k: without_uploads(v) for k, v in result.items() if k != 'branch'})
+    body.seek(0)
+    request.data = body # set before Content-Length, setting another body drops it and the body goes chunked
+    request.add_header('Content-Length', str(os.fstat(body.fileno()).st_size))
+    return request, body
+
+def content_encoders():
+    '''get compressors by Content-Encoding, preferred first, zstd needs the zstandard module'''
+    import zlib
+    encoders = {}
+    try:
+        import zstandard
+        encoders['zstd'] = lambda: zstandard.ZstdCompressor(level=3).compressobj()
+    except ImportError:
+        pass
+    encoders['gzip'] = lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return encoders
+
+def multipart_body(result, boundary):
+    '''iterate multipart body of build, the build json in part 'json' and captured logs raw in their own parts'''
+    meta = {}
+    files = []
+    for key, value in result.items():
+        if key == 'branch':
+            continue
+        if isinstance(value, dict):
+            value = dict(value)
+            for kind, item in list(value.items()):
+                if hasattr(item, 'chunks'):
+                    if kind not in value.get('uploads', {}): # otherwise uploaded in resumable chunks already
+                        files.append(('{}.{}'.format(key, kind), item))
+                    del value[kind]
+        meta[key] = value
+
+    yield '--{}\r\nContent-Disposition: form-data; name="json"\r\nContent-Type: application/json\r\n\r\n'.format(boundary).encode('UTF-8')
+    yield json.dumps(meta).encode('UTF-8')
+    for name, item in files:
+        yield '\r\n--{0}\r\nContent-Disposition: form-data; name="{1}"; filename="{1}"\r\nContent-Type: application/octet-stream\r\n\r\n'.format(boundary, name).encode('UTF-8')
+        yield from item.chunks()
+    yield '\r\n--{}--\r\n'.format(boundary).encode('UTF-8')
+
+def compressed(chunks, compressor):
+    '''compress iterated chunks'''
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+def stream_request(recipe, result, server, key=None, encoding='gzip', system=None):
+    '''get multipart upload request and its body, streamed with chunked transfer encoding and compressed with encoding'''
+    # pylint: disable=too-many-arguments
+    from uuid import uuid4
+    request = new_request(recipe, result, server, key, system)
+    boundary = uuid4().hex
+    request.add_header('Content-Type', 'multipart/form-data; boundary={}'.format(boundary))
+    body = multipart_body(result, boundary)
+    if encoding != 'identity':
+        request.add_header('Content-Encoding', encoding)
+        body = compressed(body, content_encoders()[encoding]())
+    return request, body
+
+def upload_resumable(recipe, result, server, key=None, chunk_size=CHUNK_SIZE):
+    '''upload logs larger than chunk_size in chunks, resuming from what the server has
+
+    Each log gets a token kept in the 'uploads' of its stage, so uploads of
+    spooled builds resume where they were left on later runs.
+    '''
+    from uuid import uuid4
+    for value in result.values():
+        if not isinstance(value, dict):
+            continue
+        for kind, item in list(value.items()):
+            if not hasattr(item, 'chunks') or (item.size() <= chunk_size and kind not in value.get('uploads', {})):
+                continue # started uploads are finished whatever their size, the server uses the token
+            token = value.setdefault('uploads', {}).setdefault(kind, uuid4().hex)
+            url = '{}/upload/{}/{}'.format(server, quote(recipe['name']), token)
+            request = Request(url)
+            if key is not None:
+                request.add_header('Authorization', key)
+            offset = json.loads(urlopen(request).read().decode('UTF-8'))['offset']
+            with item.open() as fle:
+                fle.seek(offset)
+                while offset < item.size():
+                    request = Request('{}?offset={}'.format(url, offset), fle.read(chunk_size), method='PUT')
+                    if key is not None:
+                        request.add_header('Authorization', key)
+                    offset = json.loads(urlopen(request).read().decode('UTF-8'))['offset']
+                    logging.debug('Uploaded %d of %d bytes of %s.', offset, item.size(), kind)
+
+def accepted_encoding(exc):
+    '''get encoding to retry with after server rejected ours with 415'''
+    accepted = [enc.strip().lower() for enc in exc.headers.get('Accept-Encoding', '').split(',')]
+    return next((enc for enc in content_encoders() if enc in accepted), 'identity')
+
+def predates_streaming(recipe, server, key=None):
+    '''check if server predates streamed uploads, it lacks resumable uploads as well'''
+    from uuid import uuid4
+    request = Request('{}/upload/{}/{}'.format(server, quote(recipe['name']), uuid4().hex))
     if key is not None:
         request.add_header('Authorization', key)
-
     try:
-        urlopen(request, json.dumps(result).encode('UTF-8'))
+        urlopen(request).read()
     except HTTPError as exc:
+        return exc.code in (404, 405)
+    except URLError:
+        return False
+    return False
+
+def upload(recipe, result, server, key=None, retries=RETRIES, encoding=None, system=None):
+    '''upload build, retries while the server is busy
+
+    The build is streamed compressed as multipart, logs in their own parts,
+    or uploaded in resumable chunks first if they are large. Servers
+    rejecting the encoding with 415 get one they accept, servers not
+    supporting multipart uploads at all get the build as plain json, once
+    they answer 411 or 415, or 400 and turn out to lack resumable uploads.
+    '''
+    # pylint: disable=too-many-arguments,too-many-branches,too-many-statements
+    encoding = encoding or next(iter(content_encoders()))
+    streamed = encoding != 'json'
+    resumable = streamed
+    legacy = False # server known to predate streamed uploads
+    for attempt in range(retries + 1):
+        try:
+            if resumable:
+                try:
+                    upload_resumable(recipe, result, server, key)
+                except HTTPError as exc:
+                    if exc.code not in (404, 405):
+                        raise
+                    resumable = False # server predates resumable uploads
+                    legacy = True
+                    for value in result.values():
+                        if isinstance(value, dict):
+                            value.pop('uploads', None)
+            if streamed:
+                request, body = stream_request(recipe, result, server, key, encoding, system)
+            else:
+                request, body = upload_request(recipe, result, server, key, system)
+            urlopen(request, body)
+            break
+        except HTTPError as exc:
+            if streamed and exc.code == 415 and encoding != 'identity':
+                encoding = accepted_encoding(exc)
+                logging.debug('Server does not accept encoding, retrying with %s.', encoding)
+                continue
+            if streamed and (exc.code in (411, 415) or (exc.code == 400 and (legacy or predates_streaming(recipe, server, key)))):
+                streamed = False
+                logging.debug('Server does not accept streamed uploads, retrying with json.')
+                continue
+            if exc.code == 409 and attempt < retries: # chunk offset raced, resume from what the server has
+                continue
+            if exc.code != 503 or attempt == retries:
+                return upload_error(exc)
+            delay = retry_delay(exc, attempt)
+            logging.warning('Server is busy, retrying in %.0f seconds.', delay)
+            time.sleep(delay)
+        except URLError as exc:
+            return upload_error(exc)
+
+    return True
+
+def upload_error(exc):
+    '''log upload error'''
+    if isinstance(exc, HTTPError):
         logging.error("The server couldn't fulfill the request.")
         logging.error('Error code: %s', exc.code)
         if exc.code == 400:
@@ -32,10 +246,7 @@ def upload(recipe, result, server, key=None):
         elif exc.code == 401:
             logging.error("Wrong key provided for project.")
         logging.error("%s", exc.read())
-        return False
-    except URLError as exc:
+    else:
         logging.error('Failed to reach a server.')
         logging.error('Reason: %s', exc.reason)
-        return False
-
-    return True
+    return False
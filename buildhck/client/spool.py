@@ -0,0 +1,119 @@
+# pylint: disable=line-too-long
+'''spool of builds that could not be uploaded, sent again on later runs
+
+Every spooled build is a directory under 'spool_directory' holding the
+build json and its captured logs. Spooled builds are sent again at the
+start of later runs once their backoff has passed, or right away with
+client.py --flush, and dropped after 'spool_attempts' failed attempts,
+when the commit is unmarked as built so it is built again.
+'''
+
+import os
+import json
+import time
+import shutil
+import random
+import logging
+from buildhck.client.capture import Capture
+from buildhck import config
+
+# seconds waited after the first failed attempt, doubled after every attempt
+BACKOFF = 60
+BACKOFF_MAX = 24 * 60 * 60
+
+def spool_directory(*args):
+    '''get directory of spooled builds'''
+    return config.data_directory(config.config.get('spool_directory', 'spool'), *args)
+
+
+def save(recipe, result, server, system=None, srcdir=None):
+    '''spool build, returns its directory'''
+    # pylint: disable=too-many-arguments
+    from tempfile import mkdtemp
+    os.makedirs(spool_directory(), exist_ok=True)
+    path = mkdtemp(prefix='{}-'.format(recipe['name'].replace(os.sep, '_')), dir=spool_directory())
+    files = {}
+    stages = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            value = dict(value)
+            for kind, item in list(value.items()):
+                if isinstance(item, Capture):
+                    name = '{}.{}.gz'.format(key, kind)
+                    item.save(os.path.join(path, name))
+                    files[name] = item.size()
+                    del value[kind]
+        stages[key] = value
+    entry = {'recipe': recipe, 'result': stages, 'files': files, 'server': server, 'system': system, 'srcdir': srcdir,
+             'attempts': 1, 'next': time.time() + backoff(1)}
+    write_entry(path, entry)
+    return path
+
+
+def write_entry(path, entry):
+    '''write spool entry atomically'''
+    with open(os.path.join(path, 'entry.json.tmp'), 'w') as fle:
+        json.dump(entry, fle)
+    os.replace(os.path.join(path, 'entry.json.tmp'), os.path.join(path, 'entry.json'))
+
+
+def backoff(attempts):
+    '''get seconds to wait before next attempt, jittered so spooled builds spread out'''
+    delay = min(BACKOFF * 2 ** (attempts - 1), BACKOFF_MAX)
+    return delay + random.uniform(0, delay / 2)
+
+
+def load(path):
+    '''get spool entry with its captured logs'''
+    with open(os.path.join(path, 'entry.json')) as fle:
+        entry = json.load(fle)
+    for name, length in entry['files'].items():
+        key, kind, _ = name.split('.')
+        entry['result'][key][kind] = Capture.load(os.path.join(path, name), length)
+    return entry
+
+
+def entries():
+    '''get directories of spooled builds, least recently attempted first'''
+    if not os.path.isdir(spool_directory()):
+        return []
+    paths = [spool_directory(name) for name in os.listdir(spool_directory())]
+    return sorted((path for path in paths if os.path.isfile(os.path.join(path, 'entry.json'))), key=os.path.getmtime)
+
+
+def flush(upload, force=False, dropped=None):
+    '''send spooled builds due, or every one if force, using upload(entry), returns number still spooled
+
+    dropped(entry) is called for every build dropped after its last attempt.
+    '''
+    import fcntl
+    os.makedirs(spool_directory(), exist_ok=True)
+    with open(spool_directory('.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            logging.info('Spool is being flushed by another run.')
+            return len(entries())
+        for path in entries():
+            entry = load(path)
+            if not force and entry['next'] > time.time():
+                continue
+            name = entry['recipe']['name']
+            if upload(entry):
+                logging.info('%s spooled build sent to server.', name)
+                shutil.rmtree(path)
+                continue
+            entry['attempts'] += 1
+            if entry['attempts'] > config.config.get('spool_attempts', 12):
+                logging.error('%s spooled build dropped after %d attempts.', name, entry['attempts'] - 1)
+                if dropped:
+                    dropped(entry)
+                shutil.rmtree(path)
+                continue
+            entry['next'] = time.time() + backoff(entry['attempts'])
+            for key, value in entry['result'].items(): # keep tokens of resumable uploads
+                if isinstance(value, dict):
+                    entry['result'][key] = {k: v for k, v in value.items() if not isinstance(v, Capture)}
+            write_entry(path, entry)
+            logging.warning('%s spooled build retried in %.0f minutes.', name, (entry['next'] - time.time()) / 60)
+        return len(entries())
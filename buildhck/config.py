@@ -1,5 +1,8 @@
-import yaml
 from os import path, makedirs
+from zlib import crc32
+from hashlib import sha1
+from functools import wraps
+from contextlib import contextmanager
 from xdg import BaseDirectory
 
 config = \
@@ -10,18 +13,80 @@ config = \
     'port': 9001
 }
 
-def load():
-    for config_path in BaseDirectory.load_config_paths('buildhck', 'config.yaml'):
-        with open(config_path) as f:
-            obj = yaml.load(f)
-            if obj:
-                config.update(obj)
-    if not path.isdir(build_directory()):
-        makedirs(build_directory())
+_loaded = False
+_data_path = None
+
+def load(overrides=None):
+    '''load config files once and apply overrides, such as command line options, on top'''
+    global _loaded
+    if _loaded and not overrides:
+        return config
+    if not _loaded:
+        for config_path in BaseDirectory.load_config_paths('buildhck', 'config.yaml'):
+            import yaml
+            with open(config_path) as f:
+                obj = yaml.safe_load(f)
+                if obj:
+                    config.update(obj)
+        _loaded = True
+    if overrides:
+        config.update(overrides)
+    for root in build_roots():
+        if not path.isdir(root):
+            makedirs(root)
+    return config
+
+def data_directory(*args):
+    global _data_path
+    if not _data_path:
+        _data_path = BaseDirectory.save_data_path('buildhck')
+    return path.join(_data_path, *args)
+
+def upload_max_bytes():
+    '''get bytes an upload may have, 'upload_max_bytes' in config'''
+    return config.get('upload_max_bytes', 1024 * 1024 * 1024)
+
+def build_roots():
+    '''get every directory holding projects, 'build_roots' in config shards projects over several'''
+    roots = config.get('build_roots')
+    if not roots:
+        return [data_directory(config.get('builds_directory', 'builds'))]
+    return [data_directory(root) for root in roots]
+
+def placement(project):
+    '''get root project belongs to'''
+    roots = build_roots()
+    return roots[crc32(project.encode('UTF-8')) % len(roots)]
+
+def build_root(project):
+    '''get root holding project, which is its placement unless it is still waiting to be moved there'''
+    root = placement(project)
+    if not path.isdir(path.join(root, project)):
+        for other in build_roots():
+            if path.isdir(path.join(other, project)):
+                return other
+    return root
 
 def build_directory(*args):
-    data_path = BaseDirectory.save_data_path('buildhck')
-    p = path.join(data_path, config.get('builds_directory', 'builds'), *args)
-    return p
+    if not args:
+        return build_roots()[0]
+    return path.join(build_root(args[0]), *args)
+
+@contextmanager
+def project_lock(project, exclusive=False):
+    '''hold lock of project, shared by writers and exclusive while the project moves between roots'''
+    import fcntl
+    lockpath = data_directory('locks', '{}.lock'.format(sha1(project.encode('UTF-8')).hexdigest()[:16]))
+    makedirs(path.dirname(lockpath), exist_ok=True)
+    with open(lockpath, 'a') as fle:
+        fcntl.flock(fle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
 
-load()
+def project_writer(func):
+    '''hold shared lock of project, the first argument, while func writes to it'''
+    @wraps(func)
+    def wrapper(project, *args, **kwargs):
+        '''locked call'''
+        with project_lock(project):
+            return func(project, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,87 @@
+# pylint: disable=line-too-long
+'''github issue post-hook, imported only when a build asks for it'''
+
+import json
+from urllib.parse import quote
+from buildhck import config, buildhck
+
+def github_issue(user, repo, subject, body, issueid=None, close=False):
+    '''create/comment/delete github issue'''
+    # pylint: disable=too-many-arguments
+
+    if not config.config['github']:
+        print("no github_token specified, won't handle issue request")
+        return
+
+    if close and not issueid:
+        print("can't close github issue without id")
+        return
+
+    from urllib.request import Request, urlopen
+    from urllib.error import URLError, HTTPError
+
+    data = None
+    handle = None
+    apiroot = 'https://api.github.com'
+
+    if not issueid and not close: # create issue
+        data = {'title': subject, 'body': body}
+        handle = Request('{}/repos/{}/{}/issues'.format(apiroot, quote(user), quote(repo)))
+    elif issueid and not close: # comment
+        data = {'body': body}
+        handle = Request('{}/repos/{}/{}/issues/{}/comments'.format(apiroot, quote(user), quote(repo), issueid))
+    elif issueid and close: # close
+        data = {'state': 'close'}
+        handle = Request('{}/repos/{}/{}/issues/{}'.format(apiroot, quote(user), quote(repo), issueid))
+        handle.get_method = lambda: 'PATCH'
+
+    handle.add_header('Content-Type', 'application/json')
+    handle.add_header('Accept', 'application/vnd.github.v3+json')
+    handle.add_header('Authorization', 'token {}'.format(config.config['github']))
+
+    srvdata = None
+    try:
+        srvdata = urlopen(handle, json.dumps(data).encode('UTF-8'))
+    except HTTPError as exc:
+        print("The server couldn't fulfill the request.")
+        print('Error code: ', exc.code)
+        print(exc.read())
+        return
+    except URLError as exc:
+        print('Failed to reach a server.')
+        print('Reason: ', exc.reason)
+        return
+
+    if not srvdata:
+        return
+
+    if not issueid:
+        issueid = json.loads(srvdata.readall().decode('UTF-8'))['number']
+        print("[GITHUB] issue created ({})".format(issueid))
+    else:
+        print("[GITHUB] issue updated ({})".format(issueid))
+
+    return issueid if not close else None
+
+def handle_github(project, branch, system, fsdate, metadata):
+    '''handle github posthook for build'''
+    github = metadata['github']
+
+    if 'issueid' not in github:
+        github['issueid'] = None
+
+    failed = buildhck.failure_for_metadata(metadata)
+
+    if not github or (not failed and not github['issueid']):
+        return # nothing to do
+
+    build = buildhck.get_build_data(project, branch, system, fsdate, get_history=False, in_metadata=metadata)
+    for idx in range(len(build['url'])):
+        build['url'][idx] = buildhck.absolute_link(build['url'][idx][1:])
+    build['systemimage'] = buildhck.absolute_link(build['systemimage'][1:])
+
+    subject = buildhck.template('github_issue', build=build, subject=True)
+    body = buildhck.template('github_issue', build=build, subject=False)
+    github['issueid'] = github_issue(github['user'], github['repo'], subject, body, github['issueid'], not failed)
+
+#  vim: set ts=8 sw=4 tw=0 :
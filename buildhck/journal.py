@@ -0,0 +1,186 @@
+# pylint: disable=line-too-long
+'''append-only journal of build writes, tailed by read-only replicas'''
+
+import os
+import json
+import time
+import uuid
+from zlib import crc32
+from buildhck import config
+
+_node = None
+
+def journal_path():
+    '''get path to the journal, set 'journal' in config to share it between nodes'''
+    return config.config.get('journal') or config.data_directory('journal')
+
+def offset_path():
+    '''get path to the journal offset the local indexes of this node are at'''
+    return config.data_directory('journal.offset')
+
+def node():
+    '''get id of this node, processes sharing a data directory are one node'''
+    global _node
+    if not _node:
+        path = config.data_directory('node')
+        try:
+            with open(path, 'x') as fle:
+                fle.write(uuid.uuid4().hex)
+        except FileExistsError:
+            pass
+        with open(path) as fle:
+            _node = fle.read().strip()
+    return _node
+
+def size():
+    '''get size of the journal, which grows on every write'''
+    return generation()[1]
+
+def generation():
+    '''get (inode, size) of the journal, changes on every write and when the journal is rotated'''
+    try:
+        stat = os.stat(journal_path())
+    except OSError:
+        return (0, 0)
+    return (stat.st_ino, stat.st_size)
+
+def identity():
+    '''get identity of the journal file, its inode and first entry, which change when it is rotated or truncated'''
+    try:
+        with open(journal_path(), 'rb') as fle:
+            return '{}-{:08x}'.format(os.fstat(fle.fileno()).st_ino, crc32(fle.readline()))
+    except OSError:
+        return None
+
+def read_offset(fle):
+    '''get (journal identity, offset) the local indexes are at from the offset file'''
+    fle.seek(0)
+    fields = fle.read().split()
+    if len(fields) == 2:
+        return fields[0], int(fields[1])
+    return None, int(fields[0]) if fields else 0 # written before rotations were noticed
+
+def write_offset(fle, ident, offset):
+    '''write (journal identity, offset) to the offset file'''
+    fle.seek(0)
+    fle.truncate()
+    fle.write('{} {}'.format(ident, offset))
+    fle.flush()
+
+def append(operation, project, branch='', system='', fsdate=''):
+    '''append write to the journal'''
+    # pylint: disable=too-many-arguments
+    entry = {'op': operation, 'project': project, 'branch': branch,
+             'system': system, 'fsdate': fsdate, 'node': node(), 'time': time.time()}
+    # single write of one line to a file opened for appending, so concurrent
+    # writers never interleave
+    with open(journal_path(), 'ab') as fle:
+        fle.write('{}\n'.format(json.dumps(entry)).encode('UTF-8'))
+        end = fle.tell()
+    if end > max_bytes():
+        rotate()
+
+def max_bytes():
+    '''get size the journal is rotated at, 'journal_max_bytes' in config'''
+    return config.config.get('journal_max_bytes', 16 * 1024 * 1024)
+
+def rotate():
+    '''move journal over journal_max_bytes to journal.1, replicas backfill when they notice'''
+    import fcntl
+    with open(journal_path() + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX) # rotated once by concurrent writers
+        if size() > max_bytes():
+            os.replace(journal_path(), journal_path() + '.1')
+
+def entries(offset):
+    '''yield (next offset, entry) for every complete entry after offset'''
+    try:
+        fle = open(journal_path(), 'rb')
+    except OSError:
+        return
+    with fle:
+        fle.seek(offset)
+        for line in fle:
+            if not line.endswith(b'\n'): # being written
+                return
+            offset += len(line)
+            yield offset, json.loads(line.decode('UTF-8'))
+
+def follow(apply, backfill=None):
+    '''apply entries written by other nodes since the last follow of this node
+
+    When the journal was truncated or rotated, the entries missed in the old
+    one are unknown, so the local indexes are rebuilt with backfill if given,
+    or else the new journal is followed from its start.'''
+    import fcntl
+    with open(offset_path(), 'a+') as fle:
+        fcntl.flock(fle, fcntl.LOCK_EX)
+        ident, offset = read_offset(fle)
+        current, length = identity(), size()
+        if (ident, offset) == (current, length):
+            return offset
+        if offset > length or ident not in (None, current):
+            if backfill:
+                backfill()
+                write_offset(fle, current, length)
+                return length
+            offset = 0
+        own = node()
+        for offset, entry in entries(offset):
+            if entry['node'] != own:
+                apply(entry)
+        write_offset(fle, current, offset)
+    return offset
+
+def catch_up(backfill):
+    '''index an existing tree from scratch and follow the journal from here on
+
+    Writes after the offset is taken are both backfilled and replayed by the
+    next follow, which is harmless as applying entries is idempotent.'''
+    import fcntl
+    with open(offset_path(), 'a+') as fle:
+        fcntl.flock(fle, fcntl.LOCK_EX) # no follow in between
+        ident, offset = identity(), size()
+        backfill()
+        write_offset(fle, ident, offset)
+    return offset
+
+def follower(apply, backfill=None, interval=1.0):
+    '''start daemon thread following the journal, so requests never wait for replays'''
+    import time
+    import logging
+    from threading import Thread
+
+    def run():
+        while True:
+            try:
+                follow(apply, backfill)
+            except Exception: # pylint: disable=broad-except
+                logging.exception('following the journal failed')
+            time.sleep(interval)
+    thread = Thread(target=run, name='journal', daemon=True)
+    thread.start()
+    return thread
+
+def main():
+    '''main method'''
+    from argparse import ArgumentParser
+    from buildhck import buildhck
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-b', '--buildsdir', dest='builds_directory',
+                        help='directory for builds')
+    parser.add_argument('--catch-up', action='store_true', dest='catch_up',
+                        help='rebuild local indexes from the tree before following the journal')
+    args = parser.parse_args()
+
+    config.load({k:v for k, v in vars(args).items() if v and k == 'builds_directory'})
+
+    if args.catch_up:
+        print('[CAUGHT UP] at offset {}'.format(catch_up(buildhck.backfill_indexes)))
+    else:
+        print('[FOLLOWED] to offset {}'.format(follow(buildhck.apply_journal_entry, buildhck.backfill_indexes)))
+
+if __name__ == '__main__':
+    main()
+
+#  vim: set ts=8 sw=4 tw=0 :
@@ -0,0 +1,119 @@
+# pylint: disable=line-too-long
+'''unified diffs between logs of a build and the last good build'''
+
+import os
+import re
+import bz2
+import json
+from array import array
+from hashlib import sha1, blake2b
+from tempfile import TemporaryFile
+from buildhck import config
+
+# (pattern, replacement) pairs applied to every line before diffing,
+# override with 'diff_normalize' in config.yaml
+DEFAULT_NORMALIZE = [
+    [r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?', '<date>'],
+    [r'\b\d{2}:\d{2}:\d{2}(?:[.,]\d+)?\b', '<time>'],
+    [r'\b\d+(?:\.\d+)?\s?(?:ms|s|sec|seconds)\b', '<duration>'],
+    [r'(?:/[^/\s:\'"]+)+/(src|build|pkg)(?=[/\s:\'"]|$)', r'$\1dir'],
+    [r'/tmp/[^\s:\'"]+', '<tmp>'],
+]
+
+def normalize_patterns():
+    '''get compiled normalization patterns from config'''
+    return [(re.compile(pattern), replacement) for pattern, replacement in config.config.get('diff_normalize', DEFAULT_NORMALIZE)]
+
+def normalized_lines(fileobj, patterns):
+    '''read lines of compressed log file object one by one and normalize them'''
+    with bz2.open(fileobj, 'rt', encoding='UTF-8', errors='replace') as fle:
+        for line in fle:
+            for exp, replacement in patterns:
+                line = exp.sub(replacement, line)
+            yield line if line.endswith('\n') else line + '\n'
+
+class SpooledLines:
+    '''normalized lines of a log spooled to a temporary file, only a digest of each line is kept in memory'''
+
+    def __init__(self, fileobj, patterns):
+        self.spool = TemporaryFile()
+        self.offsets = array('q', [0])
+        self.digests = []
+        with fileobj:
+            for line in normalized_lines(fileobj, patterns):
+                data = line.encode('UTF-8')
+                self.spool.write(data)
+                self.offsets.append(self.offsets[-1] + len(data))
+                self.digests.append(blake2b(data, digest_size=8).digest())
+
+    def lines(self, start, stop):
+        '''read lines from start to stop'''
+        self.spool.seek(self.offsets[start])
+        for idx in range(start, stop):
+            yield self.spool.read(self.offsets[idx + 1] - self.offsets[idx]).decode('UTF-8')
+
+    def close(self):
+        '''remove spool'''
+        self.spool.close()
+
+def format_range(start, stop):
+    '''format line range of hunk like difflib.unified_diff'''
+    length = stop - start
+    if length == 1:
+        return str(start + 1)
+    return '{},{}'.format(start + 1 if length else start, length)
+
+def unified_diff(old, new, baselabel, label):
+    '''yield unified diff of spooled lines, matched by their digests'''
+    from difflib import SequenceMatcher
+    for idx, group in enumerate(SequenceMatcher(None, old.digests, new.digests).get_grouped_opcodes(3)):
+        if not idx:
+            yield '--- {}\n'.format(baselabel)
+            yield '+++ {}\n'.format(label)
+        yield '@@ -{} +{} @@\n'.format(format_range(group[0][1], group[-1][2]), format_range(group[0][3], group[-1][4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                yield from (' ' + line for line in old.lines(i1, i2))
+                continue
+            if tag in ('replace', 'delete'):
+                yield from ('-' + line for line in old.lines(i1, i2))
+            if tag in ('replace', 'insert'):
+                yield from ('+' + line for line in new.lines(j1, j2))
+
+def cache_path(project, branch, system, fsdate, basefsdate, stage):
+    '''get cache path for diff, keyed by both builds and normalization patterns'''
+    # pylint: disable=too-many-arguments
+    key = sha1(json.dumps(config.config.get('diff_normalize', DEFAULT_NORMALIZE)).encode('UTF-8')).hexdigest()[:12]
+    return config.data_directory('cache', 'diff', project, branch, system, '{}-{}-{}-{}.diff'.format(fsdate, basefsdate, stage, key))
+
+def stream_diff(basefile, newfile, baselabel, label, cachepath):
+    '''yield unified diff of two logs, while writing it to cache'''
+    # pylint: disable=too-many-arguments
+    patterns = normalize_patterns()
+    # SequenceMatcher needs random access to both sides, the normalized
+    # lines are spooled to disk and matched by digest instead of kept
+    old = SpooledLines(basefile, patterns)
+    new = SpooledLines(newfile, patterns)
+
+    os.makedirs(os.path.dirname(cachepath), exist_ok=True)
+    tmppath = '{}.{}.tmp'.format(cachepath, os.getpid())
+    try:
+        with open(tmppath, 'w', encoding='UTF-8') as cache:
+            for line in unified_diff(old, new, baselabel, label):
+                cache.write(line)
+                yield line
+        os.replace(tmppath, cachepath)
+    finally: # client gone before the end
+        old.close()
+        new.close()
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+def remove_cache(project, branch='', system=''):
+    '''remove cached diffs of builds'''
+    import shutil
+    path = config.data_directory('cache', 'diff', *[arg for arg in (project, branch, system) if arg])
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+
+#  vim: set ts=8 sw=4 tw=0 :
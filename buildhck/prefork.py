@@ -0,0 +1,85 @@
+# pylint: disable=line-too-long
+'''prefork server, workers share one listening socket and nothing else'''
+
+import os
+import signal
+import socket
+from bottle import ServerAdapter, server_names
+
+class PreforkServer(ServerAdapter):
+    '''bottle server adapter forking 'workers' wsgiref servers'''
+
+    def listen(self):
+        '''create the listening socket shared by workers'''
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, int(self.port)))
+        sock.listen(self.options.get('backlog', 128))
+        return sock
+
+    def serve(self, handler, sock):
+        '''serve requests from shared socket until killed'''
+        from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+        class Handler(WSGIRequestHandler):
+            '''request handler honouring quiet'''
+            quiet = self.quiet
+
+            def log_request(self, *args, **kwargs):
+                if not self.quiet:
+                    super().log_request(*args, **kwargs)
+
+        server = WSGIServer(sock.getsockname()[:2], Handler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = sock
+        server.server_name = socket.getfqdn(self.host)
+        server.server_port = sock.getsockname()[1]
+        server.setup_environ()
+        server.set_app(handler)
+        server.serve_forever()
+
+    def spawn(self, handler, sock):
+        '''fork worker'''
+        pid = os.fork()
+        if pid:
+            return pid
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            self.serve(handler, sock)
+        finally:
+            os._exit(0) # pylint: disable=protected-access
+
+    def run(self, handler):
+        '''fork workers and replace the ones that die'''
+        sock = self.listen()
+        workers = set()
+        stopping = []
+
+        def stop(*_):
+            '''stop workers'''
+            stopping.append(True)
+            for pid in workers:
+                os.kill(pid, signal.SIGTERM)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        for _ in range(int(self.options.get('workers') or os.cpu_count() or 1)):
+            workers.add(self.spawn(handler, sock))
+
+        while workers:
+            try:
+                pid, _ = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            workers.discard(pid)
+            if not stopping:
+                workers.add(self.spawn(handler, sock))
+        sock.close()
+
+server_names['prefork'] = PreforkServer
+
+#  vim: set ts=8 sw=4 tw=0 :
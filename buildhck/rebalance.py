@@ -0,0 +1,81 @@
+# pylint: disable=line-too-long
+'''move projects to the build root their placement asks for, while serving'''
+
+import os
+import shutil
+from buildhck import config
+
+def misplaced():
+    '''yield (project, current root, target root) of projects outside their placement'''
+    for root in config.build_roots():
+        for project in sorted(os.listdir(root)):
+            if project.startswith('.'):
+                continue
+            target = config.placement(project)
+            if target != root:
+                yield project, root, target
+
+def same_file(src, dst):
+    '''check if copy of file is complete, by size and modification time'''
+    srcstat, dststat = os.stat(src), os.stat(dst)
+    return srcstat.st_size == dststat.st_size and int(srcstat.st_mtime) == int(dststat.st_mtime)
+
+def reconcile(source, destination):
+    '''copy builds written to source while it was being copied'''
+    for name in os.listdir(source):
+        src, dst = os.path.join(source, name), os.path.join(destination, name)
+        if os.path.islink(src):
+            if not os.path.lexists(dst) or os.readlink(dst) != os.readlink(src):
+                tmp = '{}.rebalance'.format(dst)
+                os.symlink(os.readlink(src), tmp)
+                os.replace(tmp, dst)
+        elif os.path.isdir(src):
+            if os.path.isdir(dst):
+                reconcile(src, dst)
+            else:
+                shutil.copytree(src, dst, symlinks=True)
+        elif not os.path.exists(dst) or not same_file(src, dst):
+            shutil.copy2(src, dst)
+
+def move(project, source, target):
+    '''move project between roots, reads are served from one copy or the other throughout
+
+    Saves and deletes of the project wait for the move, so nothing is
+    written to the source once it is copied.'''
+    with config.project_lock(project, exclusive=True):
+        if not os.path.isdir(os.path.join(target, project)): # else an earlier move was interrupted
+            staging = os.path.join(target, '.rebalance-{}'.format(project))
+            if os.path.isdir(staging):
+                shutil.rmtree(staging)
+            shutil.copytree(os.path.join(source, project), staging, symlinks=True)
+            # once renamed into place the target copy is the one found by
+            # config.build_root(), so new writes land there
+            os.rename(staging, os.path.join(target, project))
+        reconcile(os.path.join(source, project), os.path.join(target, project))
+        shutil.rmtree(os.path.join(source, project))
+
+def rebalance(dry_run=False):
+    '''move every misplaced project'''
+    moved = 0
+    for project, source, target in list(misplaced()):
+        print('[MOVE] {}: {} -> {}'.format(project, source, target))
+        if not dry_run:
+            move(project, source, target)
+        moved += 1
+    return moved
+
+def main():
+    '''main method'''
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--dry-run', action='store_true', dest='dry_run',
+                        help='only print projects that would move')
+    args = parser.parse_args()
+
+    config.load()
+    print('[REBALANCED] {} projects'.format(rebalance(args.dry_run)))
+
+if __name__ == '__main__':
+    main()
+
+#  vim: set ts=8 sw=4 tw=0 :
@@ -0,0 +1,155 @@
+# pylint: disable=line-too-long
+'''compact build records, derived fields are computed when read'''
+
+import sys
+import copy
+from datetime import datetime
+from urllib.parse import quote
+
+STUSKEYS = ['build', 'test', 'package', 'analyze']
+
+SCODEMAP = {-1: 'SKIP', 0: 'FAIL', 1: 'OK', 2: 'TIMEOUT'}
+
+# statuses of failed stages
+SCODEFAIL = (0, 2)
+
+# stored as slots, every other metadata key goes to extra
+FIELDS = ('date', 'client', 'commit', 'description', 'upstream')
+
+def icon_for_system(system):
+    '''get link to icon for system'''
+    icon = 'platform/unknown.svg'
+    if 'linux' in system.lower():
+        icon = '/platform/linux.svg'
+    if 'darwin' in system.lower():
+        icon = '/platform/darwin.svg'
+    if 'win32' in system.lower() or 'win64' in system.lower():
+        icon = '/platform/windows.svg'
+    if 'bsd' in system.lower():
+        icon = '/platform/bsd.svg'
+    return icon
+
+class BuildRecord:
+    '''build metadata readable like the dict get_build_data() used to return'''
+    # pylint: disable=too-many-instance-attributes
+
+    __slots__ = ('project', 'branch', 'system', 'fsdate', 'statuses', 'logs', 'extra', 'history') + FIELDS
+
+    def __init__(self, project, branch, system, fsdate, metadata, logs=0):
+        # pylint: disable=too-many-arguments
+        self.project = sys.intern(project)
+        self.branch = sys.intern(branch)
+        self.system = sys.intern(system)
+        self.fsdate = fsdate
+        self.logs = logs # bit per stage with a log
+        self.history = None
+        extra = {}
+        for key, value in metadata.items():
+            if key not in FIELDS and key not in STUSKEYS:
+                extra[key] = value
+        for field in FIELDS:
+            setattr(self, field, metadata.get(field))
+        self.client = sys.intern(self.client) if self.client else self.client
+        statuses = []
+        for stage in STUSKEYS:
+            value = metadata.get(stage) or {'status': -1}
+            statuses.append(value['status'])
+            if len(value) > 1:
+                extra[stage] = {k: v for k, v in value.items() if k != 'status'}
+        self.statuses = tuple(statuses)
+        self.extra = extra or None
+
+    def copy(self):
+        '''get shallow copy, so history can be attached to a cached record'''
+        record = BuildRecord.__new__(BuildRecord)
+        for slot in BuildRecord.__slots__:
+            setattr(record, slot, getattr(self, slot))
+        record.extra = dict(self.extra) if self.extra else None
+        return record
+
+    def stage(self, stage):
+        '''get stage dict with human readable result and log url'''
+        idx = STUSKEYS.index(stage)
+        status = self.statuses[idx]
+        value = dict(self.extra.get(stage, {})) if self.extra else {}
+        value['status'] = status
+        value['result'] = str(status) if stage == 'analyze' and status >= 0 else SCODEMAP[status]
+        if self.logs & (1 << idx):
+            value['url'] = quote('/build/{}/{}/{}/{}/{}-log.txt'.format(self.project, self.branch, self.system, self.fsdate, stage))
+        else:
+            value['url'] = '#'
+        return value
+
+    def derived(self, key):
+        '''compute derived field'''
+        if key == 'idate':
+            return datetime.strptime(self.date, "%Y-%m-%dT%H:%M:%S.%f")
+        if key == 'fdate':
+            return self.derived('idate').strftime("%Y-%m-%d %H:%M")
+        if key == 'systemimage':
+            return icon_for_system(self.system)
+        if key == 'statusurl':
+            return quote('/build/{}/{}/{}/{}/status.svg'.format(self.project, self.branch, self.system, self.fsdate))
+        if key == 'statusimage':
+            import time
+            return '{}?{}'.format(self.derived('statusurl'), time.time())
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if self.extra and key in self.extra and key not in STUSKEYS:
+            return self.extra[key]
+        if key in STUSKEYS:
+            return self.stage(key)
+        if key in ('project', 'branch', 'system', 'fsdate') or key in FIELDS:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        if key == 'history' and self.history is not None:
+            return self.history
+        return self.derived(key)
+
+    def __setitem__(self, key, value):
+        # overrides of derived fields, e.g. absolute links in github issues
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key] # pylint: disable=pointless-statement
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        '''get value of key or default'''
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def metadata(self):
+        '''get metadata dict as stored on disk'''
+        metadata = {field: getattr(self, field) for field in FIELDS if getattr(self, field) is not None}
+        for key, value in (self.extra or {}).items():
+            if key not in STUSKEYS:
+                metadata[key] = value
+        for idx, stage in enumerate(STUSKEYS):
+            metadata[stage] = dict((self.extra or {}).get(stage, {}), status=self.statuses[idx])
+        return copy.deepcopy(metadata) # callers modify the returned dict
+
+    def as_json(self):
+        '''get dict for json dump, statusimage without the cache-buster added when served'''
+        data = self.metadata()
+        data['date'] = self['fdate']
+        for stage in STUSKEYS:
+            data[stage] = self.stage(stage)
+        for key in ('project', 'fsdate', 'system', 'branch', 'systemimage'):
+            data[key] = self[key]
+        data['statusimage'] = self.get('statusimage') if 'statusimage' in (self.extra or {}) else self.derived('statusurl')
+        if self.history is not None:
+            data['history'] = [old.as_json() for old in self.history]
+        return data
+
+#  vim: set ts=8 sw=4 tw=0 :
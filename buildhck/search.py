@@ -0,0 +1,170 @@
+# pylint: disable=line-too-long
+'''trigram index for full-text search of build logs'''
+
+import os
+import bz2
+import sqlite3
+from buildhck import config, archive
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS logs (
+    id INTEGER PRIMARY KEY,
+    project TEXT NOT NULL, branch TEXT NOT NULL, system TEXT NOT NULL,
+    fsdate TEXT NOT NULL, stage TEXT NOT NULL,
+    UNIQUE (project, branch, system, fsdate, stage));
+CREATE TABLE IF NOT EXISTS postings (
+    trigram INTEGER NOT NULL, log INTEGER NOT NULL,
+    PRIMARY KEY (trigram, log)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_log ON postings (log);
+'''
+
+MAX_LOGS = 50
+MAX_SNIPPETS = 5
+
+def index_path():
+    '''get path to the search index database'''
+    return config.data_directory('search.db')
+
+def connect():
+    '''open search index, creating it when needed'''
+    conn = sqlite3.connect(index_path(), timeout=30)
+    conn.executescript(SCHEMA)
+    return conn
+
+def trigrams(text):
+    '''get set of case-insensitive trigrams for text'''
+    data = text.lower().encode('UTF-8')
+    return {data[i] << 16 | data[i + 1] << 8 | data[i + 2] for i in range(len(data) - 2)}
+
+def index_log(project, branch, system, fsdate, stage, text, conn=None, replace=True):
+    '''add log of build stage to the index'''
+    # pylint: disable=too-many-arguments
+    own = conn is None
+    if own:
+        conn = connect()
+    with conn:
+        key = (project, branch, system, fsdate, stage)
+        row = conn.execute('SELECT id FROM logs WHERE project = ? AND branch = ? AND system = ? AND fsdate = ? AND stage = ?', key).fetchone()
+        if row and replace:
+            conn.execute('DELETE FROM postings WHERE log = ?', row)
+            logid = row[0]
+        elif not row:
+            logid = conn.execute('INSERT INTO logs (project, branch, system, fsdate, stage) VALUES (?, ?, ?, ?, ?)', key).lastrowid
+        if not row or replace:
+            conn.executemany('INSERT INTO postings (trigram, log) VALUES (?, ?)',
+                             ((trigram, logid) for trigram in trigrams(text)))
+    if own:
+        conn.close()
+    return not row or replace
+
+def remove(project, branch='', system='', fsdate=''):
+    '''remove logs of build(s) from the index'''
+    where = ['project = ?']
+    args = [project]
+    for column, value in (('branch', branch), ('system', system), ('fsdate', fsdate)):
+        if not value:
+            break
+        where.append('{} = ?'.format(column))
+        args.append(value)
+
+    conn = connect()
+    with conn:
+        logids = [(row[0],) for row in conn.execute('SELECT id FROM logs WHERE {}'.format(' AND '.join(where)), args)]
+        conn.executemany('DELETE FROM postings WHERE log = ?', logids)
+        conn.executemany('DELETE FROM logs WHERE id = ?', logids)
+    conn.close()
+
+def candidates(conn, query):
+    '''get logs that contain every trigram of query, newest first'''
+    grams = list(trigrams(query))
+    sql = 'SELECT l.id, l.project, l.branch, l.system, l.fsdate, l.stage FROM logs l ' \
+          'JOIN postings p ON p.log = l.id WHERE p.trigram IN ({}) ' \
+          'GROUP BY l.id HAVING COUNT(*) = ? ORDER BY l.fsdate DESC'.format(','.join('?' * len(grams)))
+    return conn.execute(sql, grams + [len(grams)])
+
+def search(query, limit=MAX_LOGS):
+    '''search logs for query, returns list of matches with line numbers and snippets'''
+    if len(query.encode('UTF-8')) < 3:
+        raise ValueError('query must be at least 3 bytes long')
+
+    needle = query.lower()
+    results = []
+    conn = connect()
+    for _, project, branch, system, fsdate, stage in candidates(conn, query):
+        log = archive.open_file(project, branch, system, fsdate, '{}-log.bz2'.format(stage))
+        if not log:
+            continue
+        lines = []
+        with bz2.open(log, 'rt', encoding='UTF-8', errors='replace') as fle:
+            for lineno, line in enumerate(fle, 1):
+                if needle in line.lower():
+                    lines.append({'line': lineno, 'snippet': line.rstrip('\n')})
+                    if len(lines) >= MAX_SNIPPETS:
+                        break
+        if not lines: # trigram false positive
+            continue
+        results.append({'project': project, 'branch': branch, 'system': system,
+                        'fsdate': fsdate, 'stage': stage, 'matches': lines})
+        if len(results) >= limit:
+            break
+    conn.close()
+    return results
+
+def backfill():
+    '''index every log already on disk'''
+    conn = connect()
+    indexed = 0
+    for root in config.build_roots():
+        for dirpath, _, filenames in os.walk(root):
+            relative = os.path.relpath(dirpath, root).split(os.sep)
+            if len(relative) != 4 or relative[3] == 'current' or relative[0].startswith('.'):
+                continue
+            for filename in filenames:
+                if not filename.endswith('-log.bz2'):
+                    continue
+                stage = filename[:-len('-log.bz2')]
+                with bz2.open(os.path.join(dirpath, filename), 'rt', encoding='UTF-8', errors='replace') as fle:
+                    if index_log(*relative, stage=stage, text=fle.read(), conn=conn, replace=False):
+                        indexed += 1
+            if len(relative) == 3 and not relative[0].startswith('.'):
+                indexed += backfill_archive(conn, *relative)
+    conn.close()
+    return indexed
+
+def backfill_archive(conn, project, branch, system):
+    '''index every log packed into the archive of system'''
+    indexed = 0
+    for fsdate, files in archive.read_index(project, branch, system).items():
+        for filename in files:
+            if not filename.endswith('-log.bz2'):
+                continue
+            text = bz2.decompress(archive.read_file(project, branch, system, fsdate, filename)).decode('UTF-8', errors='replace')
+            if index_log(project, branch, system, fsdate, filename[:-len('-log.bz2')], text, conn=conn, replace=False):
+                indexed += 1
+    return indexed
+
+def main():
+    '''main method'''
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-b', '--buildsdir', dest='builds_directory',
+                        help='directory for builds')
+    parser.add_argument('--backfill', action='store_true',
+                        help='index logs of existing builds')
+    parser.add_argument('query', nargs='?',
+                        help='search logs for query')
+    args = parser.parse_args()
+
+    config.load({k:v for k, v in vars(args).items() if v and k == 'builds_directory'})
+
+    if args.backfill:
+        print('[INDEXED] {} logs'.format(backfill()))
+    if args.query:
+        for result in search(args.query):
+            for match in result['matches']:
+                print('{project}/{branch}/{system}/{fsdate}/{stage}:'.format(**result) + '{line}: {snippet}'.format(**match))
+
+if __name__ == '__main__':
+    main()
+
+#  vim: set ts=8 sw=4 tw=0 :
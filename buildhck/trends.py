@@ -0,0 +1,212 @@
+# pylint: disable=line-too-long
+'''append-only columnar store of per-system build series'''
+
+import os
+from array import array
+from buildhck import config
+
+# array typecode for column by the last part of its name, None for text
+TYPECODES = {'fsdate': 'q', 'wall': 'd', 'cpu': 'd', 'maxrss': 'q',
+             'status': 'b', 'warnings': 'l', 'commit': None}
+
+RESOURCEKEYS = ['wall', 'cpu', 'maxrss']
+
+def trend_directory(project, branch='', system=''):
+    '''get directory of series for system'''
+    return config.data_directory('trends', *[arg for arg in (project, branch, system) if arg])
+
+def typecode(name):
+    '''get array typecode for column'''
+    return TYPECODES[name.rsplit('_', 1)[-1]]
+
+def column_path(path, name):
+    '''get path to column file'''
+    return os.path.join(path, '{}.col'.format(name))
+
+def append(project, branch, system, row):
+    '''append row of {column: value} to series of system, replacing the row of the same commit and fsdate'''
+    import fcntl
+    path = trend_directory(project, branch, system)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        rows = column_length(path, 'fsdate')
+        matches = matching_rows(path, rows, row['fsdate'], row.get('commit'))
+        if matches:
+            remove_rows(path, matches)
+            rows -= len(matches)
+        # fsdate is written last, so it commits the row; cut leftovers of a
+        # row that was interrupted before that
+        for name, value in sorted(row.items(), key=lambda item: item[0] == 'fsdate'):
+            if column_length(path, name) > rows:
+                values = read_column(path, name, rows)
+                with open(column_path(path, name), 'wb') as fle:
+                    write_values(fle, name, values)
+            with open(column_path(path, name), 'ab') as fle:
+                write_values(fle, name, [value])
+
+def matching_rows(path, rows, fsdate, commit=None):
+    '''get indexes of rows of build, by fsdate and commit if given'''
+    fsdates = read_column(path, 'fsdate', rows)
+    commits = read_column(path, 'commit', rows) if commit is not None else [None] * rows
+    commit = ' '.join(str(commit).split()) # as stored
+    return {idx for idx, value in enumerate(fsdates) if value == int(fsdate) and commits[idx] in (None, commit)}
+
+def remove_rows(path, indexes):
+    '''remove rows at indexes from every column, with the lock of the series held'''
+    rows = column_length(path, 'fsdate')
+    names = sorted((fle[:-len('.col')] for fle in os.listdir(path) if fle.endswith('.col')), key=lambda name: name == 'fsdate')
+    for name in names:
+        offset = rows - min(column_length(path, name), rows) # columns added later start later
+        values = read_column(path, name, rows)[offset:]
+        values = [value for idx, value in enumerate(values, offset) if idx not in indexes]
+        with open(column_path(path, name) + '.tmp', 'wb') as fle:
+            write_values(fle, name, values)
+        os.replace(column_path(path, name) + '.tmp', column_path(path, name))
+
+def remove_build(project, branch, system, fsdate):
+    '''remove row of build from series of system'''
+    import fcntl
+    path = trend_directory(project, branch, system)
+    if not os.path.isdir(path):
+        return
+    with open(os.path.join(path, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        matches = matching_rows(path, column_length(path, 'fsdate'), fsdate)
+        if matches:
+            remove_rows(path, matches)
+
+def write_values(fle, name, values):
+    '''write values to column file'''
+    if typecode(name):
+        array(typecode(name), values).tofile(fle)
+    else:
+        fle.write(''.join('{}\n'.format(' '.join(str(value).split())) for value in values).encode('UTF-8'))
+
+def column_length(path, name):
+    '''get number of values stored in column'''
+    try:
+        if not typecode(name):
+            with open(column_path(path, name), 'rb') as fle:
+                return fle.read().count(b'\n')
+        return os.path.getsize(column_path(path, name)) // array(typecode(name)).itemsize
+    except OSError:
+        return 0
+
+def read_column(path, name, rows):
+    '''read rows values of column, padding the front of columns added later with None'''
+    values = array(typecode(name)) if typecode(name) else []
+    available = min(column_length(path, name), rows)
+    if available:
+        with open(column_path(path, name), 'rb') as fle:
+            if typecode(name):
+                values.fromfile(fle, available)
+            else:
+                values = fle.read().decode('UTF-8').splitlines()[:available]
+    return [None] * (rows - available) + (values.tolist() if typecode(name) else values)
+
+def read(project, branch, system, columns):
+    '''read columns of series for system'''
+    path = trend_directory(project, branch, system)
+    rows = column_length(path, 'fsdate')
+    return {name: read_column(path, name, rows) for name in ['fsdate'] + list(columns)}
+
+def resource_row(metadata, stages):
+    '''get resource usage columns of build metadata'''
+    row = {}
+    for stage in stages:
+        resources = metadata.get(stage, {}).get('resources', {})
+        for key in RESOURCEKEYS:
+            row['{}_{}'.format(stage, key)] = resources.get(key, 0)
+    return row
+
+def status_row(metadata, stages):
+    '''get status, warning and commit columns of build metadata'''
+    row = {'commit': metadata.get('commit', '')}
+    for stage in stages:
+        status = metadata.get(stage, {}).get('status', -1)
+        if stage == 'analyze':
+            row['warnings'] = status
+        else:
+            row['{}_status'.format(stage)] = status
+    return row
+
+def read_status(project, branch, system, stages):
+    '''read status, warning and commit series for system'''
+    columns = ['commit', 'warnings'] + ['{}_status'.format(stage) for stage in stages if stage != 'analyze']
+    series = read(project, branch, system, columns)
+    result = {'fsdate': [str(fsdate) for fsdate in series['fsdate']],
+              'commit': series['commit'], 'warnings': series['warnings']}
+    for stage in stages:
+        if stage != 'analyze':
+            result[stage] = series['{}_status'.format(stage)]
+    return result
+
+def sparkline(values, width=120, height=16):
+    '''get svg polyline points for values, skipped values are left out'''
+    points = [(idx, value) for idx, value in enumerate(values) if value is not None and value >= 0]
+    if len(points) < 2:
+        return ''
+    top = max(value for _, value in points) or 1
+    step = width / (len(values) - 1)
+    return ' '.join('{:.1f},{:.1f}'.format(idx * step, height - 1 - value * (height - 2) / top) for idx, value in points)
+
+def read_resources(project, branch, system, stages):
+    '''read resource usage series for system'''
+    series = read(project, branch, system, ['{}_{}'.format(stage, key) for stage in stages for key in RESOURCEKEYS])
+    result = {'fsdate': [str(fsdate) for fsdate in series['fsdate']]}
+    for stage in stages:
+        result[stage] = {key: series['{}_{}'.format(stage, key)] for key in RESOURCEKEYS}
+    return result
+
+def backfill(stages):
+    '''rebuild series of every system from build metadata on disk and archived'''
+    import bz2
+    import json
+    from buildhck import archive
+    systems = 0
+    for root in config.build_roots():
+        for dirpath, dirnames, _ in os.walk(root):
+            relative = os.path.relpath(dirpath, root).split(os.sep)
+            if len(relative) != 3 or relative[0].startswith('.'):
+                continue
+            dirnames[:] = [] # don't descend into builds
+            remove(*relative)
+            for fsdate in archive.fsdates(*relative):
+                metadata = archive.open_file(*relative, fsdate, 'metadata.bz2')
+                if not metadata:
+                    continue
+                with bz2.open(metadata) as fle:
+                    metadata = json.loads(fle.read().decode('UTF-8'))
+                row = dict(resource_row(metadata, stages), **status_row(metadata, stages))
+                append(*relative, row=dict(row, fsdate=int(fsdate)))
+            systems += 1
+    return systems
+
+def remove(project, branch='', system=''):
+    '''remove series of project, branch or system'''
+    import shutil
+    path = trend_directory(project, branch, system)
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+
+def main():
+    '''main method'''
+    from argparse import ArgumentParser
+    from buildhck.buildhck import STUSKEYS
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-b', '--buildsdir', dest='builds_directory',
+                        help='directory for builds')
+    parser.add_argument('--backfill', action='store_true',
+                        help='rebuild series from existing builds')
+    args = parser.parse_args()
+
+    config.load({k:v for k, v in vars(args).items() if v and k == 'builds_directory'})
+
+    if args.backfill:
+        print('[BACKFILLED] {} systems'.format(backfill(STUSKEYS)))
+
+if __name__ == '__main__':
+    main()
+
+#  vim: set ts=8 sw=4 tw=0 :
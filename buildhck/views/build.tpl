@@ -21,11 +21,28 @@
    % itr = 0
    % for status in STUSKEYS:
       % css_class = 'SKIP' if status == 'analyze' else build[status]['result']
-      <a href="{{build[status]['url']}}">{{status}}
+      % warnings = build[status].get('warnings', {}).get('categories', {})
+      <a href="{{build[status]['url']}}" title="{{', '.join('{} {}'.format(name, count) for name, count in warnings.items())}}">{{status}}
       <label class="{{css_class}}">{{build[status]['result']}}</label></a>
       % itr += 1
    % end
 
+   % if standalone and get('sparkline'):
+   <svg class='sparkline' width='120' height='16'><title>analyze warnings</title><polyline points="{{sparkline}}"/></svg>
+   % end
+
+   % warnings = build['analyze'].get('warnings')
+   % if standalone and warnings:
+   <table class='warnings'>
+      % for name, count in sorted(warnings['categories'].items(), key=lambda item: -item[1]):
+      <tr><td>{{name}}</td><td>{{count}}</td></tr>
+      % end
+      % for path, count in sorted(warnings['files'].items(), key=lambda item: -item[1])[:10]:
+      <tr class='file'><td>{{path}}</td><td>{{count}}</td></tr>
+      % end
+   </table>
+   % end
+
    % if not standalone and 'history' in build:
    <a style='float:right;' href="{{'/build/{}/{}/{}'.format(build['project'], build['branch'], build['system'])}}">+</a>
    % elif admin:
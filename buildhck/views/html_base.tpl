@@ -23,6 +23,12 @@
       .OK { color:green; font-weight:bold; }
       .FAIL { color:#FF1300; font-weight:bold; }
       .SKIP { color:#8E8E93; font-weight:bold; }
+      .TIMEOUT { color:#FF8C00; font-weight:bold; }
+      .sparkline { vertical-align:middle; margin:0 1em; }
+      .warnings { font-size:small; margin-top:4px; }
+      .warnings td { padding:0 1em 0 0; }
+      .warnings .file { color:#6E6E6E; }
+      .sparkline polyline { fill:none; stroke:#D81860; stroke-width:1; }
       .col_33 { width:31%; margin:0 2% 0 0; float:left; min-width:320px; }
       .container { max-width:{{maxwidth}}px; margin-left:auto; margin-right:auto; }
       .clearfix:before, .clearfix:after { content:""; display:table; }
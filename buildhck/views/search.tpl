@@ -0,0 +1,21 @@
+% rebase('html_base.tpl', title='buildhck :: search {}'.format(query), maxwidth=1024)
+<h2>{{query}}</h2>
+
+<a href='/'>index</a>
+
+% if not results:
+<center class='no-projects'>No Matches</center>
+% end
+
+% for result in results:
+<div class='build'>
+   <strong>{{result['project']}} - {{result['system']}}</strong>
+   <label class='branch'>{{result['branch']}}</label> @ <label class='date'>{{result['fsdate']}}</label>
+   <a style='float:right;' href="{{result['url']}}">{{result['stage']}}</a><br/>
+   % for match in result['matches']:
+      <label class='commit'>{{match['line']}}:</label> <code>{{match['snippet']}}</code><br/>
+   % end
+</div>
+% end
+
+% # vim: set ts=8 sw=3 tw=0 :
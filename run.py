@@ -4,20 +4,29 @@ from os import chdir, path
 from optparse import OptionParser
 
 from bottle import run
-from buildhck import buildhck, config
+from buildhck import buildhck, config, prefork, asyncserver
 
 def main():
     '''main method'''
     parser = OptionParser()
     parser.add_option('-s', '--server', dest='server',
-                      help='bottle.py WSGI server backend')
+                      help='bottle.py WSGI server backend, or prefork or asyncio')
     parser.add_option('-p', '--port', dest='port',
                       help='server port')
     parser.add_option('-b', '--buildsdir', dest='builds_directory',
                       help='directory for builds')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+                      help='fork this many worker processes')
+    parser.add_option('-t', '--threads', dest='threads', type='int',
+                      help='size of the app thread pool of the asyncio server')
+    parser.add_option('-r', '--replica', action='store_true', dest='replica',
+                      help='serve reads only, following the journal of the writing node')
     args = parser.parse_args()[0]
 
-    config.config.update({k:v for k,v in vars(args).items() if v})
+    config.load({k:v for k,v in vars(args).items() if v})
+    if config.config.get('workers') and not config.config.get('server'):
+        config.config['server'] = 'prefork'
+    buildhck.compile_templates()
 
     run(**config.config)
 
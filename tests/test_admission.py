@@ -0,0 +1,40 @@
+# pylint: disable=C0301, R0904, R0201, W0212
+
+import threading
+from time import sleep
+from buildhck.admission import Admission
+
+def test_admission_fairness():
+    """test waiting uploads are admitted round-robin by project and client"""
+    state = Admission(1, 1000)
+    assert state.acquire('busy', 'a', 10, 1, 10)
+    admitted = []
+
+    def upload(project, client):
+        assert state.acquire(project, client, 10, 5, 10)
+        admitted.append((project, client))
+        state.release(10)
+
+    threads = []
+    for project, client in [('busy', 'a'), ('busy', 'a'), ('busy', 'b'), ('quiet', 'c')]:
+        threads.append(threading.Thread(target=upload, args=(project, client)))
+        threads[-1].start()
+        sleep(0.05) # queue in this order
+    state.release(10)
+    for thread in threads:
+        thread.join()
+    assert admitted == [('busy', 'a'), ('quiet', 'c'), ('busy', 'b'), ('busy', 'a')]
+
+def test_admission_rejects():
+    """test uploads over the limits are rejected"""
+    state = Admission(2, 100)
+    assert state.acquire('project', 'a', 60, 1, 1)
+    assert not state.acquire('project', 'b', 60, 0.1, 1) # over byte budget
+    assert state.acquire('project', 'b', 40, 0.1, 1)
+    assert not state.acquire('project', 'c', 1, 0.1, 1) # over concurrency
+    assert not state.acquire('project', 'c', 1, 0.1, 0) # queue full
+    state.release(60)
+    state.release(40)
+    assert state.acquire('project', 'c', 1000, 0.1, 1) # alone always fits
+
+#  vim: set ts=8 sw=4 tw=0 :
@@ -0,0 +1,77 @@
+# pylint: disable=C0301, R0904, R0201, W0212
+
+import os
+import bz2
+import json
+from threading import Thread
+from base64 import b64encode
+from time import sleep
+from util import send_build, delete_build, get_file, get_json
+from buildhck import archive, cache, config
+
+def test_archive():
+    """test builds packed into the system archive are still served"""
+    delete_build('unittest') # don't care about return
+    for commit in ('first', 'second', 'third'):
+        assert send_build({'client': 'unittest', 'commit': commit, 'build': {'status': 1, 'log': b64encode('log of {}'.format(commit).encode('UTF-8')).decode('UTF-8')}}, 'unittest', 'unittest', 'unittest')
+        sleep(1)
+
+    cache.refresh()
+    fsdates = archive.fsdates('unittest', 'unittest', 'unittest')
+    assert len(fsdates) == 3
+    assert archive.compact('unittest', 'unittest', 'unittest', '99999999999999') == 2
+    systempath = config.build_directory('unittest', 'unittest', 'unittest')
+    assert sorted(os.listdir(systempath)) == sorted([fsdates[-1], 'current', archive.ARCHIVE])
+    assert archive.fsdates('unittest', 'unittest', 'unittest') == fsdates
+
+    data = get_json('build/unittest/unittest/unittest')
+    assert [old['commit'] for old in data['history']] == ['second', 'first']
+    assert get_file('build/unittest/unittest/unittest/{}/build-log.txt'.format(fsdates[0])).read() == b'log of first'
+    metadata = get_file('build/unittest/unittest/unittest/{}/metadata.bz2'.format(fsdates[1]))
+    assert bz2.decompress(metadata.read()) and int(metadata.headers['Content-Length']) > 0
+    assert not get_file('build/unittest/unittest/unittest/{}/test-log.txt'.format(fsdates[1]))
+
+    assert delete_build('unittest', 'unittest', 'unittest', fsdates[0])
+    cache.refresh()
+    assert archive.fsdates('unittest', 'unittest', 'unittest') == fsdates[1:]
+    assert delete_build('unittest', 'unittest', 'unittest', 'current')
+    cache.refresh()
+    assert os.readlink(os.path.join(systempath, 'current')) == fsdates[1]
+    assert get_json('build/unittest/unittest/unittest')['commit'] == 'second'
+
+    assert delete_build('unittest')
+
+def test_archive_lock():
+    """test removals from the archive wait for the rewrite holding its lock, and compaction for deletes"""
+    delete_build('unittest') # don't care about return
+    for commit in ('first', 'second', 'third'):
+        assert send_build({'client': 'unittest', 'commit': commit, 'build': {'status': 1}}, 'unittest', 'unittest', 'unittest')
+        sleep(1)
+    cache.refresh()
+    fsdates = archive.fsdates('unittest', 'unittest', 'unittest')
+    with archive.locked('unittest', 'unittest', 'unittest'):
+        compacter = Thread(target=archive.compact, args=('unittest', 'unittest', 'unittest', '99999999999999'))
+        compacter.start()
+        sleep(0.5)
+        assert compacter.is_alive() # waits for the lock
+        assert not os.path.exists(archive.archive_path('unittest', 'unittest', 'unittest'))
+    compacter.join()
+    assert archive.remove('unittest', 'unittest', 'unittest', fsdates[0])
+    assert sorted(archive.load_index('unittest', 'unittest', 'unittest')) == fsdates[1:2]
+    with archive.open_file('unittest', 'unittest', 'unittest', fsdates[1], 'metadata.bz2') as fle:
+        assert json.loads(bz2.decompress(fle.read()).decode('UTF-8'))['commit'] == 'second'
+
+    assert send_build({'client': 'unittest', 'commit': 'fourth', 'build': {'status': 1}}, 'unittest', 'unittest', 'unittest')
+    with config.project_lock('unittest'): # held by a delete of a build on disk
+        compacter = Thread(target=archive.compact, args=('unittest', 'unittest', 'unittest', '99999999999999'))
+        compacter.start()
+        sleep(0.5)
+        assert compacter.is_alive()
+        assert delete_build('unittest', 'unittest', 'unittest', fsdates[2])
+    compacter.join()
+    assert sorted(archive.load_index('unittest', 'unittest', 'unittest')) == fsdates[1:2] # not packed back
+    cache.refresh()
+    assert fsdates[2] not in archive.fsdates('unittest', 'unittest', 'unittest')
+    assert delete_build('unittest')
+
+#  vim: set ts=8 sw=4 tw=0 :
@@ -0,0 +1,108 @@
+# pylint: disable=C0301, R0904, R0201, W0212
+
+import json
+from time import sleep
+from random import randint
+from base64 import b64encode
+from http.client import HTTPConnection
+from multiprocessing import Process
+
+from pytest import fixture, mark
+from bottle import run
+from buildhck import config
+from buildhck import asyncserver # pylint: disable=unused-import
+
+@fixture
+def limit(monkeypatch):
+    """small upload_max_bytes for the server forked after this"""
+    monkeypatch.setitem(config.config, 'upload_max_bytes', 1024)
+    return 1024
+
+@fixture
+def port(request):
+    """asyncio server sharing the build tree of the test server, with options of the parameter"""
+    port = randint(49152, 65535)
+    proc = Process(target=run, kwargs={'server': 'asyncio', 'port': port, 'quiet': True, **getattr(request, 'param', {})})
+    proc.start()
+    for _ in range(30):
+        try:
+            HTTPConnection('localhost', port).request('HEAD', '/')
+            break
+        except ConnectionError:
+            sleep(0.25)
+    yield port
+    proc.terminate()
+    proc.join()
+
+def test_asyncserver(port):
+    """test uploads and downloads over one keep-alive connection"""
+    conn = HTTPConnection('localhost', port)
+    conn.request('DELETE', '/build/unittest')
+    conn.getresponse().read()
+
+    log = b'line\n' * 100000
+    body = json.dumps({'client': 'unittest', 'build': {'status': 1, 'log': b64encode(log).decode('UTF-8')}})
+    conn.request('POST', '/build/unittest/unittest/unittest', body, {'Content-Type': 'application/json'})
+    assert conn.getresponse().read() == b'OK!'
+
+    conn.request('GET', '/build/unittest/unittest/unittest/current/build-log.txt')
+    response = conn.getresponse()
+    assert response.getheader('Transfer-Encoding') == 'chunked'
+    assert response.read() == log.rstrip(b'\n')
+
+    conn.request('GET', '/build/unittest/unittest/unittest', headers={'Accept': 'application/json'})
+    assert json.loads(conn.getresponse().read().decode('UTF-8'))['client'] == 'unittest'
+
+    conn.request('HEAD', '/')
+    response = conn.getresponse()
+    assert response.status == 200 and not response.read()
+
+    conn.request('GET', '/build/unittest/unittest/unittest/nope.txt')
+    response = conn.getresponse()
+    assert response.status == 404
+    response.read()
+
+    conn.request('DELETE', '/build/unittest')
+    assert conn.getresponse().status == 200
+    conn.close()
+
+def test_upload_limit(limit, port):
+    """test bodies over upload_max_bytes are refused while reading"""
+    conn = HTTPConnection('localhost', port)
+    conn.request('POST', '/build/unittest/unittest/unittest', b'x' * (limit + 1), {'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    assert response.status == 413
+    response.read()
+    conn.close()
+
+    conn = HTTPConnection('localhost', port)
+    conn.putrequest('POST', '/build/unittest/unittest/unittest')
+    conn.putheader('Content-Type', 'application/json')
+    conn.putheader('Transfer-Encoding', 'chunked')
+    conn.endheaders()
+    try:
+        for _ in range(4):
+            conn.send(b'200\r\n' + b'x' * 512 + b'\r\n')
+        conn.send(b'0\r\n\r\n')
+    except ConnectionError:
+        pass # refused before the rest was sent
+    response = conn.getresponse()
+    assert response.status == 413
+    response.read()
+    conn.close()
+
+@mark.parametrize('port', [{'body_timeout': 0.5}], indirect=True)
+def test_body_timeout(port):
+    """test stalled request bodies are answered with 408"""
+    conn = HTTPConnection('localhost', port)
+    conn.putrequest('POST', '/build/unittest/unittest/unittest')
+    conn.putheader('Content-Type', 'application/json')
+    conn.putheader('Content-Length', '100')
+    conn.endheaders()
+    conn.send(b'{')
+    response = conn.getresponse()
+    assert response.status == 408
+    response.read()
+    conn.close()
+
+#  vim: set ts=8 sw=4 tw=0 :
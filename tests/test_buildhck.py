@@ -1,14 +1,18 @@
 # pylint: disable=C0301, R0904, R0201, W0212
 
-from util import send_build, delete_build, get_build_file
+import os
+import json
+from util import send_build, delete_build, get_build_file, get_file, get_json
 from base64 import b64encode
+from time import sleep
+from buildhck import config, trends
 
 def test_send():
     """test build data send"""
     assert send_build({'client': 'unittest', 'build': {'status': 1}, 'test': {'status': 1}}, 'unittest', 'unittest', 'unittest')
     assert send_build({'force': True, 'client': 'unittest', 'build': {'status': 1}, 'test': {'status': 1}}, 'unittest', 'unittest', 'unittest')
     assert not send_build({'client': 'unittest', 'build': {'status': 'notint'}, 'test': 0}, 'unittest', 'unittest', 'unittest')
-    assert not send_build({'client': 'unittest', 'build': {'status': 2}, 'test': {'status': 2}}, 'unittest', 'unittest', 'unittest')
+    assert not send_build({'client': 'unittest', 'build': {'status': 3}, 'test': {'status': -2}}, 'unittest', 'unittest', 'unittest')
     assert not send_build({'client': 'unittest', 'build': {'status': 1}, 'test': {'status': 1}}, '/;:#%-\\', 'unittest', 'unittest')
     assert not send_build({'client': 'unittest', 'build': {'status': 1}, 'test': {'status': 1}}, 'unittest', '/;:#%-\\', 'unittest')
     assert not send_build({'client': 'unittest', 'build': {'status': 1}, 'test': {'status': 1}}, 'unittest', 'unittest', '/;:#%-\\')
@@ -51,6 +55,114 @@ def test_build_files():
     assert get_build_file('unittest', 'unittest', 'unittest', 'test-log.bz2')
     assert get_build_file('unittest', 'unittest', 'unittest', 'status.svg')
 
+def test_build_log_diff():
+    """test log diff against last good build"""
+    delete_build('unittest') # don't care about return
+    good = b64encode(b'[12:00:01] compiling /home/ci/buildhck/src/main.c\nok\n').decode('UTF-8')
+    bad = b64encode(b'[13:37:00] compiling /srv/builds/buildhck/src/main.c\nmain.c:1: error\n').decode('UTF-8')
+    assert send_build({'client': 'unittest', 'commit': 'good', 'build': {'status': 1, 'log': good}}, 'unittest', 'unittest', 'unittest')
+    assert not get_build_file('unittest', 'unittest', 'unittest', 'build-log.diff')
+    sleep(1)
+    assert send_build({'client': 'unittest', 'commit': 'bad', 'build': {'status': 0, 'log': bad}}, 'unittest', 'unittest', 'unittest')
+
+    for _ in range(2): # second one is served from cache
+        diff = get_build_file('unittest', 'unittest', 'unittest', 'build-log.diff').read().decode('UTF-8')
+        assert '-ok\n' in diff
+        assert '+main.c:1: error\n' in diff
+        assert ' [<time>] compiling $srcdir/main.c\n' in diff
+
+    assert delete_build('unittest')
+
+def test_resources_trend():
+    """test resource usage series"""
+    delete_build('unittest') # don't care about return
+    resources = {'wall': 2.5, 'cpu': 2, 'maxrss': 2048, 'commands': [{'command': 'make', 'wall': 2.5, 'cpu': 2, 'maxrss': 2048}]}
+    assert not send_build({'client': 'unittest', 'build': {'status': 1, 'resources': {'wall': 'slow'}}}, 'unittest', 'unittest', 'unittest')
+    assert send_build({'client': 'unittest', 'commit': 'first', 'build': {'status': 1, 'resources': resources}}, 'unittest', 'unittest', 'unittest')
+    sleep(1)
+    assert send_build({'client': 'unittest', 'commit': 'second', 'build': {'status': 1}}, 'unittest', 'unittest', 'unittest')
+
+    trend = get_json('trends/unittest/unittest/unittest/resources')
+    assert len(trend['fsdate']) == 2
+    assert trend['build'] == {'wall': [2.5, 0.0], 'cpu': [2.0, 0.0], 'maxrss': [2048, 0]}
+    assert trend['test']['wall'] == [0.0, 0.0]
+
+    assert delete_build('unittest')
+    assert not get_json('trends/unittest/unittest/unittest/resources')
+
+def test_status_trend():
+    """test status and warning series"""
+    delete_build('unittest') # don't care about return
+    assert send_build({'client': 'unittest', 'commit': 'first', 'build': {'status': 1}, 'analyze': {'status': 3}}, 'unittest', 'unittest', 'unittest')
+    sleep(1)
+    assert send_build({'client': 'unittest', 'commit': 'second', 'build': {'status': 0}, 'analyze': {'status': 7}}, 'unittest', 'unittest', 'unittest')
+
+    trend = get_json('trends/unittest/unittest/unittest')
+    assert trend['commit'] == ['first', 'second']
+    assert trend['build'] == [1, 0]
+    assert trend['test'] == [-1, -1]
+    assert trend['warnings'] == [3, 7]
+    assert b'sparkline' in get_file('build/unittest/unittest/unittest').read()
+
+    sleep(1) # forced rebuild replaces the row of the build it replaces
+    assert send_build({'force': True, 'client': 'unittest', 'commit': 'second', 'build': {'status': 1}, 'analyze': {'status': 5}}, 'unittest', 'unittest', 'unittest')
+    trend = get_json('trends/unittest/unittest/unittest')
+    assert trend['commit'] == ['first', 'second']
+    assert trend['warnings'] == [3, 5]
+
+    assert delete_build('unittest', 'unittest', 'unittest', trend['fsdate'][0])
+    assert get_json('trends/unittest/unittest/unittest')['commit'] == ['second']
+
+    row = {'commit': 'second', 'build_status': 0, 'fsdate': int(trend['fsdate'][1])}
+    trends.append('unittest', 'unittest', 'unittest', row) # replayed write of the same build
+    assert trends.read_status('unittest', 'unittest', 'unittest', ['build'])['build'] == [0]
+
+    assert delete_build('unittest')
+
+def test_system_json():
+    """test system page json assembled from fragments written at ingest"""
+    delete_build('unittest') # don't care about return
+    assert send_build({'client': 'unittest', 'commit': 'first', 'build': {'status': 1}}, 'unittest', 'unittest', 'unittest')
+    sleep(1)
+    assert send_build({'client': 'unittest', 'commit': 'second', 'build': {'status': 0}}, 'unittest', 'unittest', 'unittest')
+
+    data = get_json('build/unittest/unittest/unittest')
+    assert data['commit'] == 'second' and data['fsdate'] == 'current'
+    assert data['build']['result'] == 'FAIL' and '/current/' in data['statusimage']
+    assert [old['commit'] for old in data['history']] == ['first']
+    assert data['history'][0]['fsdate'] in data['history'][0]['statusimage']
+    assert [build['commit'] for project in get_json('') for build in project['builds'] if project['name'] == 'unittest'] == ['second']
+
+    # cache-buster of the status image is added when served, not frozen at ingest
+    assert data['statusimage'].endswith('/status.svg?{}'.format(data['statusimage'].rpartition('?')[2]))
+    sleep(0.1)
+    assert get_json('build/unittest/unittest/unittest')['statusimage'] != data['statusimage']
+    assert [build['statusimage'] for project in get_json('', {'stream': '1'}) for build in project['builds'] if project['name'] == 'unittest'][0].count('?') == 1
+    with open(os.path.join(config.build_directory('unittest', 'unittest', 'unittest', 'current'), 'current.json')) as fle:
+        assert json.load(fle)['statusimage'].endswith('/status.svg')
+
+    assert delete_build('unittest')
+
+def test_timeout_status():
+    """test timed out stages are kept apart from failures and count as failed"""
+    delete_build('unittest') # don't care about return
+    assert send_build({'client': 'unittest', 'build': {'status': 1}, 'test': {'status': 2, 'log': b64encode(b'>> timed out after 60s, killed').decode('UTF-8')}}, 'unittest', 'unittest', 'unittest')
+    data = get_json('build/unittest/unittest/unittest')
+    assert data['test']['result'] == 'TIMEOUT'
+    with open(os.path.join(os.path.dirname(__file__), '..', 'buildhck', 'media', 'status', 'fail.svg'), 'rb') as fle:
+        assert get_build_file('unittest', 'unittest', 'unittest', 'status.svg').read() == fle.read()
+    assert delete_build('unittest')
+
+def test_analyze_warnings():
+    """test warning breakdown of analyze is stored and shown"""
+    delete_build('unittest') # don't care about return
+    warnings = {'categories': {'unused': 3, 'deprecated': 1}, 'files': {'src/main.c': 4}}
+    assert not send_build({'client': 'unittest', 'analyze': {'status': 4, 'warnings': {'categories': {'unused': 'many'}}}}, 'unittest', 'unittest', 'unittest')
+    assert send_build({'client': 'unittest', 'build': {'status': 1}, 'analyze': {'status': 4, 'warnings': warnings}}, 'unittest', 'unittest', 'unittest')
+    assert get_json('build/unittest/unittest/unittest')['analyze']['warnings'] == warnings
+    assert 'src/main.c' in get_file('build/unittest/unittest/unittest').read().decode('UTF-8')
+    assert delete_build('unittest')
+
 def teardown_method(self, method):
     """cleanup test"""
     delete_build('unittest') # don't care about return
@@ -0,0 +1,24 @@
+# pylint: disable=C0301, R0904, R0201, W0212
+
+from time import sleep
+from util import send_build, delete_build
+from buildhck import buildhck, cache
+
+def test_cache_invalidation():
+    """test caches of this process follow writes of the server process"""
+    delete_build('unittest') # don't care about return
+    assert send_build({'client': 'unittest', 'commit': 'first', 'build': {'status': 1}}, 'unittest', 'unittest', 'unittest')
+    cache.refresh()
+    assert buildhck.metadata_for_build('unittest', 'unittest', 'unittest', 'current')['commit'] == 'first'
+
+    sleep(1)
+    assert send_build({'client': 'unittest', 'commit': 'second', 'build': {'status': 1}}, 'unittest', 'unittest', 'unittest')
+    assert buildhck.metadata_for_build('unittest', 'unittest', 'unittest', 'current')['commit'] == 'first'
+    cache.refresh()
+    assert buildhck.metadata_for_build('unittest', 'unittest', 'unittest', 'current')['commit'] == 'second'
+
+    assert delete_build('unittest')
+    cache.refresh()
+    assert not buildhck.metadata_for_build('unittest', 'unittest', 'unittest', 'current')
+
+#  vim: set ts=8 sw=4 tw=0 :
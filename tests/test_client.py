@@ -0,0 +1,150 @@
+# pylint: disable=C0301, R0904, R0201, W0212
+
+import sys
+import time
+import signal
+import threading
+
+from pytest import raises
+
+from buildhck import config
+from buildhck.client import client
+from buildhck.client.capture import Capture
+
+def test_output_lines():
+    """test stdout and stderr interleave between whole lines, stamped at line starts"""
+    capture = Capture(timestamps=True)
+    ret = client.run_cmd_catch_output(['sh', '-c', 'printf out; printf err >&2; sleep 0.1; echo put; echo or >&2; printf tail'], capture)
+    assert ret['code'] == 0 and not ret['timeout']
+    assert sorted(capture.lines()) == [b'error\n', b'output\n', b'tail']
+    stamped = b''.join(capture.chunks())
+    assert stamped.count(b'] ') == 3 and stamped.startswith(b'[')
+
+def test_stage_dependencies():
+    """test stages wait for the previous one unless depends says otherwise"""
+    assert client.stage_dependencies({}) == {'build': []}
+    assert client.stage_dependencies({'test': [], 'package': [], 'analyze': []}) == {'build': [], 'test': ['build'], 'package': ['test'], 'analyze': ['package']}
+    recipe = {'test': [], 'analyze': [], 'depends': {'test': 'build', 'analyze': [], 'package': 'test'}}
+    assert client.stage_dependencies(recipe) == {'build': [], 'test': ['build'], 'analyze': []}
+    assert client.stage_dependencies({'analyze': [], 'depends': {'analyze': ['package']}}) == {'build': [], 'analyze': []} # package is done already
+
+    with raises(client.RecipeException, match='unknown stage deploy'):
+        client.stage_dependencies({'depends': {'deploy': 'build'}})
+    with raises(client.RecipeException, match='build depends on unknown stage fetch'):
+        client.stage_dependencies({'depends': {'build': 'fetch'}})
+    with raises(client.RecipeException, match='cycle between build, test'):
+        client.stage_dependencies({'test': [], 'analyze': [], 'depends': {'build': 'test', 'analyze': []}})
+
+def test_run_stages():
+    """test independent stages run at once and dependents of a failed stage are skipped"""
+    graph = {'build': [], 'test': ['build'], 'package': ['test'], 'analyze': []}
+    ran = []
+    both = threading.Barrier(2, timeout=5) # build and analyze must run at the same time
+
+    def runner(stage, fail=False):
+        def run():
+            if stage in ('build', 'analyze'):
+                both.wait()
+            ran.append(stage)
+            if fail:
+                raise client.CookException('{} failed'.format(stage))
+        return run
+
+    client.run_stages(graph, {stage: runner(stage) for stage in graph})
+    assert sorted(ran[:2]) == ['analyze', 'build'] and ran[2:] == ['test', 'package']
+
+    ran.clear()
+    both.reset()
+    runners = {stage: runner(stage, stage == 'test') for stage in graph}
+    with raises(client.CookException, match='test failed'):
+        client.run_stages(graph, runners)
+    assert sorted(ran) == ['analyze', 'build', 'test'] # package skipped
+
+def test_run_stages_first_failure():
+    """test failure of the first failed stage is raised after the others finish"""
+    finished = []
+
+    def slow():
+        time.sleep(0.2)
+        finished.append('analyze')
+        raise client.CookException('analyze failed')
+
+    def fast():
+        raise client.CookException('build failed')
+
+    with raises(client.CookException, match='build failed'):
+        client.run_stages({'build': [], 'analyze': []}, {'build': fast, 'analyze': slow})
+    assert finished == ['analyze']
+
+def test_command_timeout(monkeypatch):
+    """test commands past their timeout are killed with their process group, SIGKILL if SIGTERM is ignored"""
+    monkeypatch.setattr(client, 'KILL_GRACE', 0.5)
+    start = time.monotonic()
+    ret = client.run_cmd_catch_output(['sh', '-c', 'sleep 30 & echo started; wait'], Capture(), limits={'command_timeout': 0.3})
+    assert ret['timeout'] and ret['code'] == -signal.SIGTERM
+
+    ret = client.run_cmd_catch_output(['sh', '-c', 'trap "" TERM; while :; do sleep 0.1; done'], Capture(), limits={'command_timeout': 0.3})
+    assert ret['timeout'] and ret['code'] == -signal.SIGKILL
+    assert time.monotonic() - start < 5
+
+    ret = client.run_cmd_catch_output(['sh', '-c', 'sleep 30'], Capture(), limits={'command_timeout': 60, 'deadline': time.monotonic() + 0.3})
+    assert ret['timeout'] # deadline of the recipe comes first
+
+def test_timeout_status():
+    """test timed out stages get status TIMEOUT and a note in their log"""
+    result = {'status': -1}
+    with raises(client.CookTimeout):
+        client.run_cmd_list_catch_output(['sh -c "echo before; sleep 30"', 'echo never'], result, {}, limits={'command_timeout': 0.3})
+    assert result['status'] == client.TIMEOUT
+    log = b''.join(result['log'].lines())
+    assert b'before\n' in log and b'timed out after 0s, killed' in log and b'never' not in log
+
+    result = {'status': -1}
+    with raises(client.CookTimeout):
+        client.run_cmd_list_catch_output(['sleep 30'], result, {}, throw_on_fail=False, limits={'command_timeout': 0.3})
+    assert result['status'] == -1 # warnings of analyze can't be counted
+
+def test_rlimits():
+    """test cpu and memory limits apply to commands"""
+    ret = client.run_cmd_catch_output([sys.executable, '-c', 'bytearray(512 * 1024 * 1024)'], Capture(), limits={'memory_limit': 256})
+    assert ret['code'] != 0
+    ret = client.run_cmd_catch_output(['sh', '-c', 'while :; do :; done'], Capture(), limits={'cpu_limit': 1, 'command_timeout': 10})
+    assert not ret['timeout'] and ret['code'] == -signal.SIGXCPU
+    assert client.run_cmd_catch_output([sys.executable, '-c', 'bytearray(16 * 1024 * 1024)'], Capture(), limits={'memory_limit': 256})['code'] == 0
+
+    with raises(client.RecipeException, match='memory_limit'):
+        client.run_cmd_catch_output(['sleep', '30'], Capture(), limits={'memory_limit': 'lots'})
+
+def test_compile_patterns():
+    """test simple patterns share one regex, inline flags and backreferences keep working"""
+    regexes = client.compile_patterns({'unused': 'warning: unused', 'case': '(?i)deprecated', 'quoted': r"(['\"])x\1", 'file': r'^(?P<file>[^:]+):\d+: warning'})
+    assert len(regexes) == 2
+    exp, groups = regexes[0]
+    assert groups == {'pattern0': ('unused', None), 'pattern1': ('case', None), 'pattern3': ('file', 'file3')}
+    assert exp.search(b'DEPRECATED').lastgroup == 'pattern1'
+    assert regexes[1][1] == ('quoted', None)
+    assert regexes[1][0].search(b'"x"') and not regexes[1][0].search(b'"x\'')
+
+    with raises(client.RecipeException, match='bad analyze pattern broken'):
+        client.compile_patterns({'broken': '(unclosed'})
+
+def test_analyze(monkeypatch, tmp_path):
+    """test warnings are counted over the whole output, not only the head and tail kept of it"""
+    monkeypatch.setitem(config.config, 'log_head', 100)
+    monkeypatch.setitem(config.config, 'log_tail', 100)
+    srcdir = str(tmp_path)
+    script = 'for i in $(seq 1000); do echo "{}/a.c:$i: warning: unused"; echo "WARNING: \'x\'" >&2; done; printf "b.c:1: Warning: unused"'.format(srcdir)
+    recipe = {'analyze': ["sh -c '{}'".format(script.replace("'", "'\\''"))],
+              'analyze_patterns': {'unused': r'(?i)^(?P<file>[^:]+):\d+: warning: unused', 'quoted': r"(['\"])x\1"}}
+    result = {'status': -1}
+    client.analyze(recipe, srcdir, srcdir, result)
+    assert result['status'] == 2001
+    assert result['warnings'] == {'categories': {'unused': 1001, 'quoted': 1000}, 'files': {'a.c': 1000, 'b.c': 1}}
+    assert b'bytes omitted' in b''.join(result['log'].lines())
+
+    result = {'status': -1}
+    client.analyze({'analyze': ["sh -c '{}'".format(script.replace("'", "'\\''"))]}, srcdir, srcdir, result)
+    assert result['status'] == 2001 # lines of output
+    assert 'warnings' not in result
+
+#  vim: set ts=8 sw=4 tw=0 :
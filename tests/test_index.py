@@ -1,9 +1,42 @@
-from util import get_file
+from time import sleep
+from util import get_file, get_json, send_build, delete_build
 
 def test_index():
     """index page"""
     assert get_file('')
 
+def test_index_stream():
+    """streamed index page"""
+    assert send_build({'client': 'unittest', 'build': {'status': 1}}, 'unittest', 'unittest', 'unittest')
+    streamed, buffered = get_json('', {'stream': 1}), get_json('')
+    for project in streamed + buffered:
+        for build in project['builds']:
+            del build['statusimage'] # contains timestamp
+    assert streamed == buffered
+    page = get_file('', {'stream': 1}).read().decode('UTF-8')
+    assert page.startswith('<!DOCTYPE html>') and page.rstrip().endswith('</html>')
+    assert '<h2>unittest</h2>' in page
+    assert delete_build('unittest')
+    assert 'No Projects' in get_file('', {'stream': 1}).read().decode('UTF-8')
+
+def test_index_stream_order():
+    """streamed and buffered index list projects the most recently built first"""
+    names = ['unittest-b', 'unittest-c', 'unittest-a']
+    for name in names:
+        delete_build(name) # don't care about return
+        assert send_build({'client': 'unittest', 'build': {'status': 1}}, name, 'unittest', 'unittest')
+        sleep(1)
+    streamed, buffered = get_json('', {'stream': 1}), get_json('')
+    for project in streamed + buffered:
+        for build in project['builds']:
+            del build['statusimage'] # contains timestamp
+    assert streamed == buffered
+    assert [project['name'] for project in streamed if project['name'] in names] == names[::-1]
+    page = get_file('', {'stream': 1}).read().decode('UTF-8')
+    assert page.index('<h2>unittest-a</h2>') < page.index('<h2>unittest-c</h2>') < page.index('<h2>unittest-b</h2>')
+    for name in names:
+        assert delete_build(name)
+
 def test_favicon():
     """favicon"""
     assert get_file('favicon.ico')
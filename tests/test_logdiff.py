@@ -0,0 +1,30 @@
+# pylint: disable=C0301, R0904, R0201, W0212
+
+import os
+import bz2
+import difflib
+from io import BytesIO
+from tempfile import mkdtemp
+from buildhck import logdiff
+
+def compressed(lines):
+    """get compressed log file object of lines"""
+    return BytesIO(bz2.compress(''.join(lines).encode('UTF-8')))
+
+def test_stream_diff():
+    """test spooled diff matches difflib and leaves no temporary file behind"""
+    old = ['line {}\n'.format(idx) for idx in range(100)]
+    new = old[:40] + ['changed\n'] + old[45:] + ['added\n']
+    cachepath = os.path.join(mkdtemp(), 'build.diff')
+    diff = list(logdiff.stream_diff(compressed(old), compressed(new), 'old', 'new', cachepath))
+    assert diff == list(difflib.unified_diff(old, new, 'old', 'new'))
+    with open(cachepath) as fle:
+        assert fle.read() == ''.join(diff)
+
+    os.remove(cachepath)
+    stream = logdiff.stream_diff(compressed(old), compressed(new), 'old', 'new', cachepath)
+    next(stream)
+    stream.close() # client disconnected
+    assert not os.listdir(os.path.dirname(cachepath))
+
+#  vim: set ts=8 sw=4 tw=0 :
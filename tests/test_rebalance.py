@@ -0,0 +1,60 @@
+# pylint: disable=C0301, R0904, R0201, W0212
+
+import os
+from time import sleep
+from threading import Thread
+from buildhck import config, rebalance
+
+def test_rebalance(tmpdir, monkeypatch):
+    """test projects move to their placement when build roots change"""
+    roots = [str(tmpdir.join('a')), str(tmpdir.join('b'))]
+    monkeypatch.setitem(config.config, 'build_roots', roots[:1])
+    for root in roots:
+        os.makedirs(root)
+
+    projects = ['project{}'.format(idx) for idx in range(8)]
+    for project in projects:
+        os.makedirs(config.build_directory(project, 'master', 'linux', '20150101000000'))
+        os.symlink('20150101000000', config.build_directory(project, 'master', 'linux', 'current'))
+        assert config.build_directory(project).startswith(roots[0])
+
+    monkeypatch.setitem(config.config, 'build_roots', roots)
+    assert {config.placement(project) for project in projects} == set(roots)
+    for project in projects: # still found before moving
+        assert os.path.isdir(config.build_directory(project, 'master', 'linux', 'current'))
+
+    assert rebalance.rebalance() == len([p for p in projects if config.placement(p) == roots[1]])
+    assert not list(rebalance.misplaced())
+    for project in projects:
+        assert config.build_directory(project).startswith(config.placement(project))
+        assert os.readlink(config.build_directory(project, 'master', 'linux', 'current')) == '20150101000000'
+    assert not [name for name in os.listdir(roots[1]) if name.startswith('.')]
+
+def test_move_waits_for_writers(tmpdir, monkeypatch):
+    """test a move waits for writes holding the project lock and copies what they wrote"""
+    roots = [str(tmpdir.join('a')), str(tmpdir.join('b'))]
+    monkeypatch.setitem(config.config, 'build_roots', roots)
+    project = next('project{}'.format(idx) for idx in range(100) if config.placement('project{}'.format(idx)) == roots[1])
+    os.makedirs(os.path.join(roots[0], project, 'master', 'linux', '20150101000000'))
+
+    mover = Thread(target=rebalance.move, args=(project, roots[0], roots[1]))
+    with config.project_lock(project):
+        mover.start()
+        sleep(0.5)
+        assert mover.is_alive() and os.path.isdir(os.path.join(roots[0], project))
+        with open(os.path.join(roots[0], project, 'master', 'linux', '20150101000000', 'build-log.bz2'), 'w') as fle:
+            fle.write('written while the move waited')
+    mover.join()
+    assert not os.path.exists(os.path.join(roots[0], project))
+    with open(os.path.join(roots[1], project, 'master', 'linux', '20150101000000', 'build-log.bz2')) as fle:
+        assert fle.read() == 'written while the move waited'
+
+def test_reconcile_partial_copy(tmpdir):
+    """test reconcile copies files again when the copy is not complete"""
+    source, destination = tmpdir.mkdir('source'), tmpdir.mkdir('destination')
+    source.join('log').write('complete log')
+    destination.join('log').write('compl')
+    rebalance.reconcile(str(source), str(destination))
+    assert destination.join('log').read() == 'complete log'
+
+#  vim: set ts=8 sw=4 tw=0 :
@@ -0,0 +1,27 @@
+# pylint: disable=C0301, R0904, R0201, W0212
+
+from buildhck.record import BuildRecord
+
+METADATA = {'date': '2015-01-01T12:00:00.000000', 'client': 'unittest', 'commit': 'abc',
+            'description': '', 'upstream': 'https://example.com', 'github': {'user': 'u', 'repo': 'r'},
+            'build': {'status': 1, 'resources': {'wall': 1.0}}, 'test': {'status': 0}, 'analyze': {'status': 3}}
+
+def test_record():
+    """test record reads like the build dict it replaces"""
+    record = BuildRecord('unittest', 'master', 'linux', '20150101120000', METADATA, logs=1)
+    assert record.metadata() == dict(METADATA, package={'status': -1})
+    assert record['fdate'] == '2015-01-01 12:00'
+    assert record['build']['url'].endswith('/20150101120000/build-log.txt')
+    assert record['test']['url'] == '#'
+    assert [record[stage]['result'] for stage in ('build', 'test', 'package', 'analyze')] == ['OK', 'FAIL', 'SKIP', '3']
+    assert record['systemimage'] == '/platform/linux.svg'
+    assert 'history' not in record and 'nope' not in record
+
+    record.metadata()['github']['user'] = 'changed'
+    assert record['github']['user'] == 'u'
+
+    data = record.as_json()
+    assert data['date'] == '2015-01-01 12:00' and 'idate' not in data
+    assert data['build']['resources'] == {'wall': 1.0}
+
+#  vim: set ts=8 sw=4 tw=0 :
@@ -0,0 +1,119 @@
+# pylint: disable=C0301, R0904, R0201, W0212
+
+import os
+import json
+from random import randint
+from multiprocessing import Process
+from time import sleep, time
+
+from pytest import fixture
+from bottle import run
+
+from tempfile import mkdtemp
+from buildhck import config, journal
+import util
+from util import send_build, delete_build, get_json
+
+def run_replica(port, builds, journal_path, data):
+    """run server in replica mode, with data directory of its own sharing builds and journal of the primary"""
+    config._data_path = data
+    journal._node = None
+    config.config.update({'replica': True, 'builds_directory': builds, 'journal': journal_path, 'journal_interval': 0.1})
+    run(port=port, quiet=True)
+
+@fixture
+def replica():
+    """replica server following the test server"""
+    port = randint(49152, 65535)
+    args = (port, config.build_directory(), journal.journal_path(), mkdtemp())
+    proc = Process(target=run_replica, args=args)
+    proc.start()
+    primary, util.SERVER = util.SERVER, 'http://localhost:{}'.format(port)
+    for _ in range(30):
+        if proc.is_alive() and util.get_file(''):
+            break
+        sleep(0.25)
+    util.SERVER = primary
+    yield 'http://localhost:{}'.format(port)
+    proc.terminate()
+    proc.join()
+
+def test_replica(replica):
+    """test replica serves writes of the primary and rejects its own"""
+    delete_build('unittest') # don't care about return
+    primary = util.SERVER
+    try:
+        util.SERVER = replica
+        assert not send_build({'client': 'unittest', 'build': {'status': 1}}, 'unittest', 'unittest', 'unittest')
+        assert not get_json('build/unittest/unittest/unittest')
+
+        util.SERVER = primary
+        assert send_build({'client': 'unittest', 'commit': 'replicated', 'build': {'status': 1}}, 'unittest', 'unittest', 'unittest')
+
+        util.SERVER = replica
+        assert get_json('build/unittest/unittest/unittest')['commit'] == 'replicated'
+        for _ in range(30): # replayed into the trends of the replica in the background
+            if get_json('trends/unittest/unittest/unittest')['commit'] == ['replicated']:
+                break
+            sleep(0.25)
+        assert get_json('trends/unittest/unittest/unittest')['commit'] == ['replicated']
+        assert not delete_build('unittest')
+
+        util.SERVER = primary
+        assert delete_build('unittest')
+
+        util.SERVER = replica
+        assert not get_json('build/unittest/unittest/unittest')
+    finally:
+        util.SERVER = primary
+
+def test_journal_rotation(monkeypatch):
+    """test follow notices a truncated or rotated journal"""
+    data = mkdtemp()
+    monkeypatch.setattr(config, '_data_path', data)
+    monkeypatch.setattr(journal, '_node', 'follower')
+    monkeypatch.setitem(config.config, 'journal', os.path.join(data, 'shared-journal'))
+    applied, backfills = [], []
+
+    def write(project):
+        """append entry of another node"""
+        with open(journal.journal_path(), 'a') as fle:
+            fle.write(json.dumps({'op': 'save', 'project': project, 'branch': '', 'system': '', 'fsdate': '', 'node': 'writer', 'time': time()}) + '\n')
+
+    write('first')
+    journal.follow(lambda entry: applied.append(entry['project']))
+    journal.follow(lambda entry: applied.append(entry['project']))
+    assert applied == ['first']
+
+    os.remove(journal.journal_path()) # rotated
+    write('second')
+    journal.follow(lambda entry: applied.append(entry['project']))
+    assert applied == ['first', 'second']
+
+    with open(journal.journal_path(), 'w'): # truncated
+        pass
+    write('x')
+    journal.follow(lambda entry: applied.append(entry['project']), lambda: backfills.append(True))
+    assert applied == ['first', 'second'] and backfills == [True]
+
+def test_journal_size_limit(monkeypatch):
+    """test journal is rotated once over journal_max_bytes, and followers backfill"""
+    data = mkdtemp()
+    monkeypatch.setattr(config, '_data_path', data)
+    monkeypatch.setattr(journal, '_node', 'writer')
+    monkeypatch.setitem(config.config, 'journal', os.path.join(data, 'shared-journal'))
+    monkeypatch.setitem(config.config, 'journal_max_bytes', 1024)
+    for idx in range(100):
+        journal.append('save', 'project{}'.format(idx))
+        assert journal.size() <= 1024 + 512
+    assert os.path.getsize(journal.journal_path() + '.1') > 1024
+
+    monkeypatch.setattr(journal, '_node', 'follower')
+    backfills = []
+    journal.follow(lambda entry: None, lambda: backfills.append(True))
+    for _ in range(20): # rotated at least once
+        journal.append('save', 'more')
+    journal.follow(lambda entry: None, lambda: backfills.append(True))
+    assert backfills == [True]
+
+#  vim: set ts=8 sw=4 tw=0 :
@@ -0,0 +1,23 @@
+# pylint: disable=C0301, R0904, R0201, W0212
+
+from util import send_build, delete_build, get_json
+from base64 import b64encode
+
+def test_search_logs():
+    """test log search"""
+    delete_build('unittest') # don't care about return
+    log = b64encode(b'compiling\nundefined reference to `glhckInit\'\nlinking failed\n').decode('UTF-8')
+    assert send_build({'force': True, 'client': 'unittest', 'build': {'status': 0, 'log': log}}, 'unittest', 'unittest', 'unittest')
+
+    results = get_json('search/logs', {'q': 'Undefined Reference'})
+    assert results and results[0]['project'] == 'unittest'
+    assert results[0]['stage'] == 'build'
+    assert results[0]['matches'] == [{'line': 2, 'snippet': 'undefined reference to `glhckInit\''}]
+
+    assert not get_json('search/logs', {'q': 'reference to `glhckTerminate'})
+    assert get_json('search/logs', {'q': 'un'}) is None
+
+    assert delete_build('unittest')
+    assert not get_json('search/logs', {'q': 'undefined reference'})
+
+#  vim: set ts=8 sw=4 tw=0 :
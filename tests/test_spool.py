@@ -0,0 +1,101 @@
+# pylint: disable=C0301, R0904, R0201, W0212
+
+import os
+import gzip
+import json
+import time
+from urllib.request import Request, urlopen
+
+from pytest import fixture
+
+import util
+from util import delete_build, get_build_file
+from buildhck import config
+from buildhck.client import client, spool
+from buildhck.client.capture import Capture
+from buildhck.client.services.buildhck import upload
+
+@fixture
+def spooldir(monkeypatch, tmp_path):
+    """spool in a temporary directory"""
+    monkeypatch.setitem(config.config, 'spool_directory', str(tmp_path / 'spool'))
+    return tmp_path / 'spool'
+
+def captured(data):
+    """get capture of data"""
+    capture = Capture(len(data), 0, False)
+    capture.write(data)
+    return capture
+
+def test_save_load(spooldir):
+    """test spooled build is loaded with its logs"""
+    result = {'client': 'unittest', 'commit': 'spooled', 'build': {'status': 1, 'log': captured(b'build log\n')}, 'test': {'status': -1}}
+    path = spool.save({'name': 'unittest'}, result, 'http://server', 'unittest variant', '/src')
+    assert spool.entries() == [path]
+    entry = spool.load(path)
+    assert entry['server'] == 'http://server' and entry['system'] == 'unittest variant' and entry['srcdir'] == '/src'
+    assert entry['attempts'] == 1 and entry['next'] > time.time()
+    assert entry['result']['commit'] == 'spooled' and entry['result']['test'] == {'status': -1}
+    assert b''.join(entry['result']['build']['log'].chunks()) == b'build log\n'
+    assert os.path.dirname(path) == str(spooldir)
+
+def test_load_closed(spooldir, tmp_path):
+    """test loaded logs hold no descriptor unless they're read, and still copy to another spool"""
+    path = spool.save({'name': 'unittest'}, {'commit': 'spooled', 'build': {'status': 1, 'log': captured(b'build log\n')}}, 'http://server')
+    fds = len(os.listdir('/proc/self/fd'))
+    entries = [spool.load(path) for _ in range(10)]
+    assert len(os.listdir('/proc/self/fd')) == fds
+    log = entries[0]['result']['build']['log']
+    assert b''.join(log.chunks()) == b'build log\n'
+    assert len(os.listdir('/proc/self/fd')) == fds
+    log.save(str(tmp_path / 'copy.gz'))
+    with gzip.open(str(tmp_path / 'copy.gz')) as fle:
+        assert fle.read() == b'build log\n'
+
+def test_backoff():
+    """test backoff doubles, jitters and is capped"""
+    for attempts in range(1, 30):
+        delay = min(spool.BACKOFF * 2 ** (attempts - 1), spool.BACKOFF_MAX)
+        assert delay <= spool.backoff(attempts) <= delay * 1.5
+
+def test_flush(spooldir, monkeypatch, tmp_path):
+    """test only due builds are sent, failures back off and are dropped after spool_attempts"""
+    monkeypatch.setitem(config.config, 'spool_attempts', 2)
+    srcdir = str(tmp_path)
+    client.mark_built(srcdir, {'commit': 'dropped'})
+    path = spool.save({'name': 'unittest'}, {'commit': 'dropped', 'build': {'status': 1, 'log': captured(b'log\n')}}, 'http://server', srcdir=srcdir)
+    sent = []
+    assert spool.flush(lambda entry: sent.append(entry) or False) == 1
+    assert not sent # not due yet
+
+    assert spool.flush(lambda entry: sent.append(b''.join(entry['result']['build']['log'].chunks())) or False, force=True) == 1
+    assert sent == [b'log\n']
+    entry = spool.load(path)
+    assert entry['attempts'] == 2 and entry['next'] > time.time() + spool.BACKOFF
+    assert client.built_commit(srcdir) == 'dropped'
+
+    dropped = []
+    assert spool.flush(lambda entry: False, force=True, dropped=lambda entry: dropped.append(entry) or client.drop_spooled(entry)) == 0
+    assert len(dropped) == 1 and not os.path.exists(path)
+    assert client.built_commit(srcdir) is None
+
+    spool.save({'name': 'unittest'}, {'commit': 'sent'}, 'http://server')
+    assert spool.flush(lambda entry: True, force=True) == 0
+    assert not spool.entries()
+
+def test_resumed_from_spool(spooldir):
+    """test spooled build resumes the upload of its log from what the server has"""
+    delete_build('unittest') # don't care about return
+    log = b''.join(b'line %d\n' % idx for idx in range(100000))
+    token = 'cd' * 16
+    result = {'client': 'unittest', 'branch': 'unittest', 'commit': 'spooled', 'build': {'status': 1, 'log': captured(log), 'uploads': {'log': token}}}
+    url = '{}/upload/unittest/{}'.format(util.SERVER, token)
+    assert json.loads(urlopen(Request(url + '?offset=0', log[:100000], method='PUT')).read().decode('UTF-8'))['offset'] == 100000
+    spool.save({'name': 'unittest'}, result, util.SERVER, 'unittest')
+
+    assert spool.flush(lambda entry: upload(entry['recipe'], entry['result'], entry['server'], system=entry['system']), force=True) == 0
+    assert get_build_file('unittest', 'unittest', 'unittest', 'build-log.txt').read() == log.rstrip(b'\n')
+    assert not os.path.exists(config.data_directory('uploads', 'unittest', token))
+    assert delete_build('unittest')
+
+#  vim: set ts=8 sw=4 tw=0 :
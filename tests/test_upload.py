@@ -0,0 +1,142 @@
+# pylint: disable=C0301, R0904, R0201, W0212
+
+import os
+import gzip
+import json
+from threading import Thread
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+import util
+from util import delete_build, get_build_file, get_json
+from buildhck.client.capture import Capture
+from buildhck.client.services.buildhck import upload, upload_resumable
+from buildhck import config
+
+def test_streamed_upload():
+    """test compressed multipart upload with logs in their own parts"""
+    delete_build('unittest') # don't care about return
+    log = b''.join(b'line %d\n' % idx for idx in range(600000)) # spooled to disk by the server
+    capture = Capture(len(log), 0, False)
+    capture.write(log)
+    result = {'client': 'unittest', 'branch': 'unittest', 'commit': 'streamed', 'build': {'status': 1, 'log': capture}}
+    assert upload({'name': 'unittest'}, result, util.SERVER, system='unittest', encoding='gzip')
+    assert get_build_file('unittest', 'unittest', 'unittest', 'build-log.txt').read() == log.rstrip(b'\n')
+    assert get_json('build/unittest/unittest/unittest')['commit'] == 'streamed'
+    assert delete_build('unittest')
+
+def test_multipart_stage_not_in_json():
+    """test files of stages missing from the json don't leak into later builds"""
+    delete_build('unittest') # don't care about return
+    boundary = 'unittestboundary'
+    parts = [('json', 'application/json', json.dumps({'client': 'unittest', 'commit': 'parts', 'build': {'status': 1}}).encode('UTF-8')),
+             ('test.log', 'application/octet-stream', b'test log\n')]
+    body = b''.join('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\nContent-Type: {}\r\n\r\n'.format(boundary, name, name, ctype).encode('UTF-8') + data + b'\r\n' for name, ctype, data in parts)
+    body += '--{}--\r\n'.format(boundary).encode('UTF-8')
+    request = Request('{}/build/unittest/unittest/unittest'.format(util.SERVER), body)
+    request.add_header('Content-Type', 'multipart/form-data; boundary={}'.format(boundary))
+    assert urlopen(request).read() == b'OK!'
+    assert get_build_file('unittest', 'unittest', 'unittest', 'test-log.txt').read() == b'test log'
+
+    request = Request('{}/build/unittest/unittest/unittest'.format(util.SERVER), json.dumps({'client': 'unittest', 'commit': 'plain', 'build': {'status': 1}}).encode('UTF-8'))
+    request.add_header('Content-Type', 'application/json')
+    assert urlopen(request).read() == b'OK!'
+    assert get_json('build/unittest/unittest/unittest')['commit'] == 'plain'
+    assert delete_build('unittest')
+
+def test_upload_encoding():
+    """test unsupported encodings are rejected with the supported ones"""
+    request = Request('{}/build/unittest/unittest/unittest'.format(util.SERVER))
+    request.add_header('Content-Type', 'application/json')
+    request.add_header('Content-Encoding', 'br')
+    try:
+        urlopen(request, b'{}')
+        assert False
+    except HTTPError as exc:
+        assert exc.code == 415
+        assert 'gzip' in exc.headers['Accept-Encoding']
+
+    request = Request('{}/build/unittest/unittest/unittest'.format(util.SERVER))
+    request.add_header('Content-Type', 'application/json')
+    request.add_header('Content-Encoding', 'gzip')
+    assert urlopen(request, gzip.compress(json.dumps({'client': 'unittest', 'commit': 'gzip', 'build': {'status': 1}}).encode('UTF-8'))).read() == b'OK!'
+    assert get_json('build/unittest/unittest/unittest')['commit'] == 'gzip'
+    assert delete_build('unittest')
+
+def test_resumable_upload():
+    """test chunked upload resumes from what the server has"""
+    delete_build('unittest') # don't care about return
+    log = b''.join(b'line %d\n' % idx for idx in range(100000))
+    capture = Capture(len(log), 0, False)
+    capture.write(log)
+    token = 'ab' * 16
+    result = {'client': 'unittest', 'branch': 'unittest', 'commit': 'resumed', 'build': {'status': 1, 'log': capture, 'uploads': {'log': token}}}
+
+    url = '{}/upload/unittest/{}'.format(util.SERVER, token)
+    assert json.loads(urlopen(Request(url + '?offset=0', log[:100000], method='PUT')).read().decode('UTF-8'))['offset'] == 100000
+    try:
+        urlopen(Request(url + '?offset=0', log[:100000], method='PUT'))
+        assert False
+    except HTTPError as exc:
+        assert exc.code == 409
+
+    upload_resumable({'name': 'unittest'}, result, util.SERVER, chunk_size=65536)
+    assert json.loads(urlopen(url).read().decode('UTF-8'))['offset'] == len(log)
+    assert upload({'name': 'unittest'}, result, util.SERVER, system='unittest')
+    assert get_build_file('unittest', 'unittest', 'unittest', 'build-log.txt').read() == log.rstrip(b'\n')
+    assert not os.path.exists(config.data_directory('uploads', 'unittest', token))
+    assert delete_build('unittest')
+
+class LegacyServer(BaseHTTPRequestHandler):
+    """server predating streamed uploads, multipart builds are bad json and there are no resumable uploads"""
+    received = []
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """no resumable uploads"""
+        self.send_error(404)
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """accept plain json builds only"""
+        if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                self.rfile.read(size + 2)
+                if not size:
+                    break
+            self.send_error(400)
+            return
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Type') != 'application/json':
+            self.send_error(400)
+            return
+        LegacyServer.received.append(json.loads(body.decode('UTF-8')))
+        self.send_response(200)
+        self.send_header('Content-Length', '3')
+        self.end_headers()
+        self.wfile.write(b'OK!')
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+def test_legacy_server():
+    """test servers answering streamed uploads with 400 get the build as plain json"""
+    server = HTTPServer(('localhost', 0), LegacyServer)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        capture = Capture(1024, 0, False)
+        capture.write(b'log\n')
+        result = {'client': 'unittest', 'branch': 'unittest', 'commit': 'legacy', 'build': {'status': 1, 'log': capture}}
+        assert upload({'name': 'unittest'}, result, 'http://localhost:{}'.format(server.server_port), encoding='gzip')
+        assert [build['commit'] for build in LegacyServer.received] == ['legacy']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_bad_build_not_retried():
+    """test a streamed build the server rejects with 400 isn't sent again as json"""
+    result = {'client': 'unittest', 'branch': 'unittest', 'commit': 'bad', 'build': {'status': 7}}
+    assert not upload({'name': 'unittest'}, result, util.SERVER, system='unittest', encoding='gzip')
+
+#  vim: set ts=8 sw=4 tw=0 :
@@ -1,14 +1,14 @@
 import json
 import random
 
-from urllib.parse import quote
+from urllib.parse import quote, urlencode
 from urllib.request import Request, urlopen
 from urllib.error import URLError, HTTPError
 
 # FIXME: need to check return status
-def get_file(relative):
+def get_file(relative, query=None):
     """get file from server"""
-    request = Request('{}/{}'.format(SERVER, quote(relative)))
+    request = Request('{}/{}{}'.format(SERVER, quote(relative), '?' + urlencode(query) if query else ''))
     try:
         return urlopen(request)
     except (HTTPError, URLError):
@@ -47,3 +47,12 @@ def get_build_file(project, branch, system, bfile):
         return urlopen(request)
     except (HTTPError, URLError):
         pass
+
+def get_json(relative, query=None):
+    """get json data from server"""
+    request = Request('{}/{}{}'.format(SERVER, quote(relative), '?' + urlencode(query) if query else ''))
+    request.add_header('Accept', 'application/json')
+    try:
+        return json.loads(urlopen(request).read().decode('UTF-8'))
+    except (HTTPError, URLError):
+        pass